@@ -0,0 +1,156 @@
+"""
+Constants and helpers shared by both versions of the RESTful API: application.py and async_application.py.
+"""
+
+from bson import ObjectId
+import metrics
+from config.config import server_conf
+from data.cube import Cube, query_cache
+from persistence.cube import cache_stats
+
+# Status codes constants
+SUCCESS = 200
+NOT_MODIFIED = 304
+BAD_REQUEST = 400
+NOT_FOUND = 404
+PRECONDITION_FAILED = 412
+INTERNAL_SERVER_ERROR = 500
+
+# Content type of newline delimited JSON bodies.
+NDJSON = 'application/x-ndjson'
+
+# Fields of the body of a box add.
+RANGE_ADD_FIELDS = {'x1', 'x2', 'y1', 'y2', 'z1', 'z2', 'delta'}
+
+# Hits, misses, evictions and size of the caches, read when metrics are rendered.
+metrics.registry.register(metrics.Gauge(
+    'cubes_cache', 'Statistics of the cache of cubes and of the cache of query results.',
+    lambda: {(name, stat): value for name, stats in [('cubes', cache_stats()), ('queries', query_cache.stats())]
+             for stat, value in stats.items()},
+    ['cache', 'stat']))
+
+# Optional sampling profiler, whose stacks are served at /debug/profile.
+_profiler_conf = server_conf.get('profiler', {})
+profiler = metrics.SamplingProfiler(interval=_profiler_conf.get('interval_ms', 10) / 1000)
+
+if _profiler_conf.get('enabled'):
+    profiler.start()
+
+
+def profile(limit=None, reset=False):
+    """
+    Reports the stacks seen by the sampling profiler, in the folded format of flame graph tools.
+    :param limit: Maximum number of stacks, most seen first. All of them if None.
+    :param reset: Whether stacks are forgotten after being reported.
+    :return: One line per stack, or None if the profiler isn't enabled in config/server.json.
+    """
+    if not _profiler_conf.get('enabled'):
+        return None
+
+    folded = profiler.folded(limit)
+
+    if reset:
+        profiler.reset()
+
+    return folded
+
+
+def etag(version):
+    """
+    :return: ETag of a version of a cube.
+    """
+    return '"%d"' % version
+
+
+def etag_versions(header):
+    """
+    Parses the ETags of an If-Match or If-None-Match header. Weak ETags are compared like strong ones.
+    :param header: Value of the header.
+    :return: Set of the versions of the cube given in the header, or None if the header is "*" (i.e. any version).
+    """
+    if header.strip() == '*':
+        return None
+
+    versions = set()
+
+    for tag in header.split(','):
+        tag = tag.strip()
+        tag = tag[2:] if tag.startswith('W/') else tag
+        tag = tag.strip('"')
+
+        if tag.isdigit():
+            versions.add(int(tag))
+
+    return versions
+
+
+def etag_matches(header, version):
+    """
+    :return: True if a version of a cube matches an If-Match or If-None-Match header; False otherwise.
+    """
+    versions = etag_versions(header)
+    return versions is None or version in versions
+
+
+def valid_cube_id(c_id):
+    """
+    :return: True if a string is a valid cube identifier (i.e. the string representation of an ObjectId); False
+    otherwise.
+    """
+    return ObjectId.is_valid(c_id)
+
+
+def changes_response(cube_id, since, version, changes, full):
+    """
+    Builds the data of the response of cube_changes.
+    :param cube_id: Identifier of the cube.
+    :param since: Version the changes are relative to.
+    :param version: Current version of the cube.
+    :param changes: dict whose keys are (x, y, z) tuples and its values the elements set.
+    :param full: Whether the changes are the whole cube.
+    :return: dict with the data of the response.
+    """
+    return {'_id': cube_id, 'since': since, 'version': version, 'full': full,
+            'changes': [[x, y, z, value] for (x, y, z), value in sorted(changes.items())]}
+
+
+def slabs(cube, x_init, x_end):
+    """
+    :return: Nested dict with the elements of a cube whose X coordinate falls between x_init and x_end, built from
+    those slabs alone.
+    """
+    elements = {}
+
+    for x, y, z, value in cube.slab_points(x_init, x_end):
+        elements.setdefault(str(x), {}).setdefault(str(y), {})[str(z)] = value
+
+    return elements
+
+
+def range_limits(from_, to_, dimension):
+    """
+    Fills in the missing limits of a range, defaulting to 1 in the case of the lower limits and to N in the case of
+    the upper ones (where N is the cube dimension), and checks the resulting range is valid for the cube (see
+    Cube.validate_query).
+    :param from_: List with the lower limits of X, Y and Z, where any of them may be None.
+    :param to_: List with the upper limits of X, Y and Z, where any of them may be None.
+    :param dimension: Dimension of the cube to be queried.
+    :return: Tuple (x1, x2, y1, y2, z1, z2).
+    """
+    from_, to_ = list(from_), list(to_)
+
+    # Only limits not given are filled in: 0 is a limit too (an invalid one).
+    for i in range(3):  # It's a cube, so we're pretty sure there will always be three dimensions to check.
+        if from_[i] is None:
+            from_[i] = 1
+
+        if to_[i] is None:
+            to_[i] = dimension
+
+    # Unpack range values again into their respective variables.
+    x1, y1, z1 = from_
+    x2, y2, z2 = to_
+
+    Cube(dimension).validate_query(x1, x2, y1, y2, z1, z2)
+
+    return x1, x2, y1, y2, z1, z2
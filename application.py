@@ -2,17 +2,67 @@
 RESTful API methods.
 """
 
-from flask import Flask, request, make_response, jsonify
-from data.cube import Cube, instantiate_from_raw_data
-from persistence.cube import delete, delete_all, get, get_all, store, update
+import json
+import time
+from flask import Flask, Response, g, request, make_response, jsonify, stream_with_context
+import metrics
+from api import BAD_REQUEST, INTERNAL_SERVER_ERROR, NDJSON, NOT_FOUND, NOT_MODIFIED, PRECONDITION_FAILED, \
+    RANGE_ADD_FIELDS, SUCCESS, changes_response, etag, etag_matches, etag_versions, profile, range_limits, slabs, \
+    valid_cube_id
+from config.config import server_conf
+from data import snapshot
+from data.cube import Cube
+from persistence.cube import VersionMismatch, add_range, delete, delete_all, flush, get_changes, get_cube, \
+    get_cube_range, get_dimension, get_version, iter_all, store, update_element, update_elements
 
 app = Flask(__name__)
 
-# Status codes constants
-_SUCCESS = 200
-_BAD_REQUEST = 400
-_NOT_FOUND = 404
-_INTERNAL_SERVER_ERROR = 500
+
+@app.before_request
+def _start_request():
+    """
+    Labels the metrics recorded while serving the request with its route, and starts timing it.
+    """
+    g.start = time.perf_counter()
+    metrics.set_route(_route())
+
+
+@app.after_request
+def _end_request(response):
+    """
+    Records the time taken to serve the request.
+    """
+    metrics.observe_request(_route(), request.method, response.status_code, time.perf_counter() - g.start)
+
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Exposes the performance metrics of this process (request and phase timings, cells scanned per query and cache
+    statistics) in the Prometheus text format.
+    :return: Metrics, as plain text.
+    """
+    return Response(metrics.registry.render(), status=SUCCESS, content_type=metrics.CONTENT_TYPE)
+
+
+@app.route('/debug/profile', methods=['GET'])
+def get_profile():
+    """
+    Reports the stacks seen by the sampling profiler, in the folded format of flame graph tools. Optional query
+    parameters:
+        - limit: Maximum number of stacks, most seen first.
+        - reset: If "true", stacks are forgotten after being reported.
+    :return: One line per stack, as plain text. Not found if the profiler isn't enabled in config/server.json.
+    """
+    limit = request.args.get('limit')
+    folded = profile(int(limit) if limit else None, reset=request.args.get('reset') == 'true')
+
+    if folded is None:
+        return make_response(jsonify(message='The profiler is not enabled'), NOT_FOUND)
+
+    return Response(folded, status=SUCCESS, mimetype='text/plain')
 
 
 @app.route('/cubes', methods=['POST'])
@@ -26,21 +76,61 @@ def create_cube():
 
         # Validate body structure.
         if 'dimension' not in request_body:
-            return make_response(jsonify(message='Bad Request. "dimension" field not provided'), _BAD_REQUEST)
+            return make_response(jsonify(message='Bad Request. "dimension" field not provided'), BAD_REQUEST)
 
         # Persist cube.
         cube = Cube(dimension=request_body['dimension'])
         cube_id = store(cube)
 
-        return make_response(jsonify(message='Cube created successfully', data=cube_id), _SUCCESS)
+        return make_response(jsonify(message='Cube created successfully', data=cube_id), SUCCESS)
     except Exception as e:
-        return make_response(jsonify(message='Internal Server Error. Details: %s' % e), _INTERNAL_SERVER_ERROR)
+        return _internal_error(e)
+
+
+@app.route('/cubes/import', methods=['POST'])
+def import_cube():
+    """
+    Creates a new cube out of a binary snapshot (see data.snapshot), sent as the request body.
+    :return: JSON response with the id of the cube just created.
+    """
+    try:
+        try:
+            cube = snapshot.loads(request.get_data())
+        except (ValueError, AssertionError) as e:
+            return make_response(jsonify(message='Bad Request. %s' % e), BAD_REQUEST)
+
+        cube_id = store(cube)
+
+        return make_response(jsonify(message='Cube imported successfully', data=cube_id), SUCCESS)
+    except Exception as e:
+        return _internal_error(e)
+
+
+@app.route('/cubes/<cube_id>/snapshot', methods=['GET'])
+def export_cube(cube_id):
+    """
+    Exports a cube as a binary snapshot (see data.snapshot), which can be imported back through import_cube.
+    :param cube_id: Identifier of the cube to be exported.
+    :return: Snapshot of the cube.
+    """
+    try:
+        cube = get_cube(cube_id)
+
+        # If cube is None, then nothing was found.
+        if not cube:
+            return make_response(jsonify(message='Not found cube with id %s' % cube_id), NOT_FOUND)
+
+        return Response(snapshot.dumps(cube), mimetype=snapshot.MIME_TYPE,
+                        headers={'Content-Disposition': 'attachment; filename=%s.cube' % cube_id})
+    except Exception as e:
+        return _internal_error(e)
 
 
 @app.route('/cubes/<cube_id>', methods=['PUT'])
 def update_cube(cube_id):
     """
-    Updates a particular element of a cube.
+    Updates a particular element of a cube. With an If-Match header, the cube is only updated if it's still at one of
+    the versions given (i.e. the ETags of detail_cube), and otherwise the response is 412 Precondition Failed.
     :param cube_id: Identifier of the cube to be updated.
     :return: JSON with a message with the operation status.
     """
@@ -49,30 +139,147 @@ def update_cube(cube_id):
 
         # Checks that the body is properly constructed.
         if set(request_body.keys()) != {'x', 'y', 'z', 'value'}:
-            return make_response(jsonify(message='Bad Request. Check x, y, z, and value fields are present'), _BAD_REQUEST)
+            return make_response(jsonify(message='Bad Request. Check x, y, z, and value fields are present'), BAD_REQUEST)
+
+        if_match = request.headers.get('If-Match')
+
+        # Write only the element that changes, in a single atomic operation.
+        successfully_updated = update_element(cube_id, request_body['x'], request_body['y'], request_body['z'],
+                                              request_body['value'],
+                                              expected_versions=etag_versions(if_match) if if_match else None)
+
+        if not successfully_updated:
+            return make_response(jsonify(message='Not found cube with id %s' % cube_id), NOT_FOUND)
+
+        return make_response(jsonify(message='Cube successfully updated.'), SUCCESS)
+    except VersionMismatch as e:
+        return make_response(jsonify(message='Precondition Failed. %s' % e), PRECONDITION_FAILED,
+                             {'ETag': etag(e.version)})
+    except Exception as e:
+        return _internal_error(e)
+
+
+@app.route('/cubes/<cube_id>', methods=['PATCH'])
+def add_to_cube_range(cube_id):
+    """
+    Adds a value to every element of a box of a cube. The body has the value to be added, "delta", and the limits of
+    the box, with the same (optional) fields as the query parameters of detail_cube and the same defaults.
+    :param cube_id: Identifier of the cube to be updated.
+    :return: JSON with a message with the operation status and the number of elements updated.
+    """
+    try:
+        request_body = request.json
+
+        # Checks that the body is properly constructed.
+        if not isinstance(request_body, dict) or 'delta' not in request_body or \
+                not set(request_body.keys()) <= RANGE_ADD_FIELDS:
+            return make_response(jsonify(message='Bad Request. Body must have a delta field, and optionally x1, x2, '
+                                                  'y1, y2, z1 and z2'), BAD_REQUEST)
+
+        dimension = get_dimension(cube_id)
+
+        # If dimension is None, then nothing was found.
+        if not dimension:
+            return make_response(jsonify(message='Not found cube with id %s' % cube_id), NOT_FOUND)
+
+        try:
+            x1, x2, y1, y2, z1, z2 = range_limits(
+                [request_body.get('x1'), request_body.get('y1'), request_body.get('z1')],
+                [request_body.get('x2'), request_body.get('y2'), request_body.get('z2')], dimension)
+            Cube(dimension).validate_add_range(x1, x2, y1, y2, z1, z2, request_body['delta'])
+        except AssertionError as e:
+            return make_response(jsonify(message='Bad Request. %s' % e), BAD_REQUEST)
+
+        with metrics.timer('compute'):
+            successfully_updated = add_range(cube_id, x1, x2, y1, y2, z1, z2, request_body['delta'])
+
+        if not successfully_updated:
+            return make_response(jsonify(message='Not found cube with id %s' % cube_id), NOT_FOUND)
+
+        return make_response(jsonify(message='Cube successfully updated.',
+                                     data=(x2 - x1 + 1) * (y2 - y1 + 1) * (z2 - z1 + 1)), SUCCESS)
+    except Exception as e:
+        return _internal_error(e)
+
+
+@app.route('/cubes/<cube_id>/updates', methods=['POST'])
+def update_cube_elements(cube_id):
+    """
+    Updates a batch of elements of a cube, in order, with a single write. The body is either a JSON array or, when the
+    content type is application/x-ndjson, one JSON object per line. Every element must look like the body of
+    update_cube.
+    :param cube_id: Identifier of the cube to be updated.
+    :return: JSON with a message with the operation status and the number of elements received.
+    """
+    try:
+        if request.mimetype == NDJSON:
+            request_body = [json.loads(line) for line in request.stream if line.strip()]
+        else:
+            request_body = request.json
 
-        raw_cube = get(cube_id)  # Get raw cube representation.
-        cube = instantiate_from_raw_data(raw_cube)  # Create new object from raw data
-        cube.update(request_body['x'], request_body['y'], request_body['z'], request_body['value'])  # Perform update.
+        # Checks that the body is properly constructed.
+        if not isinstance(request_body, list) or \
+                not all(isinstance(e, dict) and set(e.keys()) == {'x', 'y', 'z', 'value'} for e in request_body):
+            return make_response(jsonify(message='Bad Request. Body must be a list of elements with x, y, z, and '
+                                                  'value fields'), BAD_REQUEST)
 
-        successfully_updated = update(cube_id, cube)
+        elements = [(e['x'], e['y'], e['z'], e['value']) for e in request_body]
+        successfully_updated = update_elements(cube_id, elements)
 
         if not successfully_updated:
-            return make_response(jsonify(message='Could not update cube with id %s' % cube_id), _INTERNAL_SERVER_ERROR)
+            return make_response(jsonify(message='Not found cube with id %s' % cube_id), NOT_FOUND)
 
-        return make_response(jsonify(message='Cube successfully updated.'), _SUCCESS)
+        return make_response(jsonify(message='Cube successfully updated.', data=len(elements)), SUCCESS)
+    except json.JSONDecodeError:
+        return make_response(jsonify(message='Bad Request. Malformed NDJSON body'), BAD_REQUEST)
     except Exception as e:
-        return make_response(jsonify(message='Internal Server Error. Details: %s' % e), _INTERNAL_SERVER_ERROR)
+        return _internal_error(e)
 
 
 @app.route('/cubes', methods=['GET'])
 def list_cubes():
     """
-    Retrieves all cubes stored.
+    Retrieves all cubes stored, in id order. Optional query parameters:
+        - limit: Maximum number of cubes to return. If the page is full, the response has a "next" field with the
+        value of "after" to get the next page.
+        - after: Identifier of a cube. Only cubes after it are returned.
+        - fields: If "ids", only the id and dimension of every cube are returned.
+        - format: If "ndjson" (or if application/x-ndjson is the preferred content type of the request), cubes are
+        streamed one per line as they're read from database, instead of returned as a single JSON document.
     :return: List of cubes.
     """
-    cubes = get_all()
-    return make_response(jsonify(data=cubes, message='Cubes retrieved successfully.'), _SUCCESS)
+    try:
+        query_params = request.args
+        limit = int(query_params['limit']) if query_params.get('limit') else None
+        after = query_params.get('after')
+        ids_only = query_params.get('fields') == 'ids'
+
+        if limit is not None and limit <= 0:
+            return make_response(jsonify(message='Bad Request. "limit" must be positive'), BAD_REQUEST)
+
+        if after and not valid_cube_id(after):
+            return make_response(jsonify(message='Bad Request. "after" must be a cube id'), BAD_REQUEST)
+
+        cubes = iter_all(limit=limit, after=after, ids_only=ids_only)
+
+        if query_params.get('format') == 'ndjson' or \
+                request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON:
+            lines = ('%s\n' % json.dumps(cube) for cube in cubes)
+            return Response(stream_with_context(lines), status=SUCCESS, mimetype=NDJSON)
+
+        with metrics.timer('fetch'):
+            cubes = list(cubes)
+        response = {'data': cubes, 'message': 'Cubes retrieved successfully.'}
+
+        if limit is not None and len(cubes) == limit:
+            response['next'] = cubes[-1]['_id']
+
+        with metrics.timer('serialize'):
+            return make_response(jsonify(**response), SUCCESS)
+    except ValueError:
+        return make_response(jsonify(message='Bad Request. "limit" must be an integer'), BAD_REQUEST)
+    except Exception as e:
+        return _internal_error(e)
 
 
 @app.route('/cubes/<cube_id>', methods=['GET'])
@@ -82,11 +289,26 @@ def detail_cube(cube_id):
         - If not range query parameter is provided (x1, x2, y1, y2, z1 or z2) then just returns the raw cube.
         - If there's at least query parameter, then it performs a summation over the cube, using the params passed
         as input, and defaulting to 1 in the case of the lower limits, and to N in the case of the upper bounds (where N
-        is the cube dimension).
+        is the cube dimension). Only the elements within [x1, x2] are read, so the raw cube in the response only has
+        those, along with the summation params and result.
+    Responses have the version of the cube as their ETag. If it matches the If-None-Match header of the request, the
+    response is 304 Not Modified, without reading the cube.
     :param cube_id: Identifier of the cube to be retrieved.
     :return: JSON with the cube details.
     """
     try:
+        # The version is read before the cube, so the ETag is never newer than the response.
+        version = get_version(cube_id)
+
+        # If version is None, then nothing was found.
+        if version is None:
+            return make_response(jsonify(message='Not found cube with id %s' % cube_id), NOT_FOUND)
+
+        if_none_match = request.headers.get('If-None-Match')
+
+        if if_none_match and etag_matches(if_none_match, version):
+            return Response(status=NOT_MODIFIED, headers={'ETag': etag(version)})
+
         # Extract query parameters
         query_params = request.args
         x1 = query_params.get('x1')
@@ -96,48 +318,130 @@ def detail_cube(cube_id):
         z1 = query_params.get('z1')
         z2 = query_params.get('z2')
 
-        # Get cube
-        raw_cube = get(cube_id)
+        # If there's at least one parameter, then we must query the cube instead of returning it
+        if any([x1, x2, y1, y2, z1, z2]):
+            # Only the dimension is needed to fill in the defaults and validate the range.
+            dimension = get_dimension(cube_id)
+
+            # If dimension is None, then nothing was found.
+            if not dimension:
+                return make_response(jsonify(message='Not found cube with id %s' % cube_id), NOT_FOUND)
+
+            # Query parameters given without a value take their defaults too.
+            from_ = [int(limit) if limit else None for limit in [x1, y1, z1]]
+            to_ = [int(limit) if limit else None for limit in [x2, y2, z2]]
+            x1, x2, y1, y2, z1, z2 = range_limits(from_, to_, dimension)
+
+            # Read only the slabs of the cube within the range.
+            cube = get_cube_range(cube_id, x1, x2)
+
+            if not cube:
+                return make_response(jsonify(message='Not found cube with id %s' % cube_id), NOT_FOUND)
+
+            with metrics.timer('compute'):
+                cube_summation = cube.query(x1, x2, y1, y2, z1, z2)
+
+            # The response has the elements of the slabs read, plus the parameters and summation result.
+            with metrics.timer('serialize'):
+                response = {'_id': cube_id, 'cube': slabs(cube, x1, x2), 'dimension': dimension,
+                            'params': {'x1': x1, 'x2': x2, 'y1': y1, 'y2': y2, 'z1': z1, 'z2': z2},
+                            'result': cube_summation}
+        else:
+            # Get cube
+            cube = get_cube(cube_id)
+
+            # If cube is None, then nothing was found.
+            if not cube:
+                return make_response(jsonify(message='Not found cube with id %s' % cube_id), NOT_FOUND)
+
+            with metrics.timer('serialize'):
+                response = {'_id': cube_id, 'cube': cube.cube, 'dimension': cube.dimension}
+
+        with metrics.timer('serialize'):
+            return make_response(jsonify(message='Cube retrieved successfully', data=response), SUCCESS,
+                                 {'ETag': etag(version)})
+    except Exception as e:
+        return _internal_error(e)
 
-        # If cube is None, then nothing was found.
-        if not raw_cube:
-            return make_response(jsonify(message='Not found cube with id %s' % cube_id), _NOT_FOUND)
 
-        response = raw_cube
+@app.route('/cubes/<cube_id>/changes', methods=['GET'])
+def cube_changes(cube_id):
+    """
+    Gets the elements of a cube updated after a given version (the ETag of detail_cube), so a copy of the cube can be
+    kept up to date without reading it whole. Query parameters:
+        - since: Version of the copy of the cube.
+    If the updates since that version aren't known anymore, every element of the cube is returned, and the response
+    has "full" set to true: the copy must then be replaced rather than updated.
+    :param cube_id: Identifier of the cube.
+    :return: JSON with the current version of the cube and the elements updated, as [x, y, z, value] lists.
+    """
+    try:
+        since = request.args.get('since', '')
 
-        # If there's at least one parameter, then we must query the cube before returning it
-        if any([x1, x2, y1, y2, z1, z2]):
-            cube = instantiate_from_raw_data(raw_cube)  # Create cube
+        if not since.isdigit():
+            return make_response(jsonify(message='Bad Request. "since" must be a version'), BAD_REQUEST)
 
-            # Put initial and final range values in a list so we can add defaults more easily.
-            from_ = [x1, y1, z1]
-            to_ = [x2, y2, z2]
+        since = int(since)
+        changes = get_changes(cube_id, since)
 
-            # This loop adds defaults and cast to int already present values
-            for i in range(3):  # It's a cube, so we're pretty sure there will always be three dimensions to check.
-                if not from_[i]:
-                    from_[i] = 1
-                else:
-                    from_[i] = int(from_[i])
+        # If changes is None, then nothing was found.
+        if changes is None:
+            return make_response(jsonify(message='Not found cube with id %s' % cube_id), NOT_FOUND)
 
-                if not to_[i]:
-                    to_[i] = cube.dimension
+        with metrics.timer('serialize'):
+            return make_response(jsonify(message='Cube changes retrieved successfully',
+                                         data=changes_response(cube_id, since, *changes)), SUCCESS,
+                                 {'ETag': etag(changes[0])})
+    except Exception as e:
+        return _internal_error(e)
+
+
+@app.route('/cubes/<cube_id>/queries', methods=['POST'])
+def query_cube(cube_id):
+    """
+    Performs many summations over a cube, loading it only once. The body is a JSON array of boxes, where every box is
+    either a list [x1, x2, y1, y2, z1, z2] or an object with the same (optional) fields as the query parameters of
+    detail_cube, with the same defaults.
+    :param cube_id: Identifier of the cube to be queried.
+    :return: JSON with the parameters and result of every summation, in input order.
+    """
+    try:
+        request_body = request.json
+
+        # Checks that the body is properly constructed.
+        if not isinstance(request_body, list) or \
+                not all(isinstance(box, dict) or (isinstance(box, list) and len(box) == 6) for box in request_body):
+            return make_response(jsonify(message='Bad Request. Body must be a list of boxes'), BAD_REQUEST)
+
+        cube = get_cube(cube_id)
+
+        # If cube is None, then nothing was found.
+        if not cube:
+            return make_response(jsonify(message='Not found cube with id %s' % cube_id), NOT_FOUND)
+
+        boxes = []
+        for i, box in enumerate(request_body):
+            try:
+                if isinstance(box, dict):
+                    box = range_limits([box.get('x1'), box.get('y1'), box.get('z1')],
+                                       [box.get('x2'), box.get('y2'), box.get('z2')], cube.dimension)
                 else:
-                    to_[i] = int(to_[i])
+                    cube.validate_query(*box)
+            except AssertionError as e:
+                return make_response(jsonify(message='Bad Request. Box %d: %s' % (i, e)), BAD_REQUEST)
 
-            # Unpack range values again into their respective variables.
-            x1, y1, z1 = from_
-            x2, y2, z2 = to_
+            boxes.append(box)
 
-            cube_summation = cube.query(x1, x2, y1, y2, z1, z2)
+        with metrics.timer('compute'):
+            summations = cube.query_many(boxes)
 
-            # Complement the response with the parameters and summation result
-            response['params'] = {'x1': x1, 'x2': x2, 'y1': y1, 'y2': y2, 'z1': z1, 'z2': z2}
-            response['result'] = cube_summation
+        response = [{'params': dict(zip(['x1', 'x2', 'y1', 'y2', 'z1', 'z2'], box)), 'result': summation}
+                    for box, summation in zip(boxes, summations)]
 
-        return make_response(jsonify(message='Cube retrieved successfully', data=response), _SUCCESS)
+        with metrics.timer('serialize'):
+            return make_response(jsonify(message='Cube queried successfully', data=response), SUCCESS)
     except Exception as e:
-        return make_response(jsonify(message='Internal Server Error. Details: %s' % e), _INTERNAL_SERVER_ERROR)
+        return _internal_error(e)
 
 
 @app.route('/cubes', methods=['DELETE'])
@@ -148,7 +452,21 @@ def delete_all_cubes():
     """
     elements_removed = delete_all()
 
-    return make_response(jsonify(message='%d cubes were removed.' % elements_removed), _SUCCESS)
+    return make_response(jsonify(message='%d cubes were removed.' % elements_removed), SUCCESS)
+
+
+@app.route('/cubes/flush', methods=['POST'])
+def flush_cubes():
+    """
+    Writes to database every element update buffered by this process (see write_behind in config/persistence.json).
+    :return: JSON with a message notifying the number of elements written.
+    """
+    try:
+        written = flush()
+
+        return make_response(jsonify(message='%d buffered elements were written.' % written, data=written), SUCCESS)
+    except Exception as e:
+        return _internal_error(e)
 
 
 @app.route('/cubes/<cube_id>', methods=['DELETE'])
@@ -163,15 +481,35 @@ def delete_cube(cube_id):
 
         if not successfully_removed:
             return make_response(jsonify(message='Could not remove cube with id %s' % cube_id),
-                                 _INTERNAL_SERVER_ERROR)
+                                 INTERNAL_SERVER_ERROR)
 
-        return make_response(jsonify(message='Cube successfully removed'), _SUCCESS)
+        return make_response(jsonify(message='Cube successfully removed'), SUCCESS)
     except Exception as e:
-        return make_response(jsonify(message='Internal Server Error. Details %s' % e), _INTERNAL_SERVER_ERROR)
+        return _internal_error(e)
 
 
-if __name__ == '__main__':
-    from config.config import server_conf
+# ===============================
+# Private helper functions.
+# ===============================
+def _internal_error(e):
+    """
+    Builds the response to an unexpected error, after logging it with its traceback and counting it.
+    :param e: Exception raised while serving the request.
+    :return: JSON response with the error details and status 500.
+    """
+    app.logger.exception('Error serving %s %s', request.method, request.path)
+    metrics.request_errors.inc((_route(),))
 
+    return make_response(jsonify(message='Internal Server Error. Details: %s' % e), INTERNAL_SERVER_ERROR)
+
+
+def _route():
+    """
+    :return: Route of the current request (e.g. /cubes/<cube_id>), which labels its metrics.
+    """
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+if __name__ == '__main__':
     # If you want to change these configurations, head to /config/server.json
     app.run(host=server_conf['host'], port=server_conf['port'])
@@ -0,0 +1,554 @@
+"""
+Asynchronous version of the RESTful API (see application.py), served by aiohttp on a single event loop. It exposes the
+same routes, with the same requests and responses, but requests don't hold a thread while they wait: database access
+runs on a pool of I/O threads and sums (and any other CPU-heavy work) on a separate, smaller pool, so slow queries
+never starve database access and thousands of connections can be kept open at once. Usage:
+
+    python async_application.py
+
+Requires aiohttp.
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+from aiohttp import web
+import metrics
+from api import BAD_REQUEST, INTERNAL_SERVER_ERROR, NDJSON, NOT_FOUND, NOT_MODIFIED, PRECONDITION_FAILED, \
+    RANGE_ADD_FIELDS, SUCCESS, changes_response, etag, etag_matches, etag_versions, profile, range_limits, slabs, \
+    valid_cube_id
+from config.config import server_conf
+from data import snapshot
+from data.cube import Cube
+from persistence.cube import VersionMismatch, add_range, delete, delete_all, flush, get_changes, get_cube, \
+    get_cube_range, get_dimension, get_version, iter_all, store, update_element, update_elements
+
+# Number of cubes read from database at once when streaming a list of cubes.
+_STREAM_BATCH_SIZE = 100
+
+_async_conf = server_conf.get('async', {})
+
+# Threads that access the database.
+_io_executor = ThreadPoolExecutor(max_workers=_async_conf.get('io_threads', 32), thread_name_prefix='cubes-io')
+
+# Threads that compute sums and serialize cubes.
+_cpu_executor = ThreadPoolExecutor(max_workers=_async_conf.get('cpu_threads', os.cpu_count()),
+                                   thread_name_prefix='cubes-cpu')
+
+routes = web.RouteTableDef()
+
+
+@routes.post('/cubes')
+async def create_cube(request):
+    """
+    Creates a new cube of the dimension provided in the input.
+    :return: JSON response with the id of the cube just created.
+    """
+    request_body = await request.json()
+
+    # Validate body structure.
+    if 'dimension' not in request_body:
+        return _json_response(BAD_REQUEST, message='Bad Request. "dimension" field not provided')
+
+    # Persist cube.
+    cube = Cube(dimension=request_body['dimension'])
+    cube_id = await _io(store, cube)
+
+    return _json_response(SUCCESS, message='Cube created successfully', data=cube_id)
+
+
+@routes.post('/cubes/import')
+async def import_cube(request):
+    """
+    Creates a new cube out of a binary snapshot (see data.snapshot), sent as the request body.
+    :return: JSON response with the id of the cube just created.
+    """
+    data = await request.read()
+
+    try:
+        cube = await _cpu(snapshot.loads, data)
+    except (ValueError, AssertionError) as e:
+        return _json_response(BAD_REQUEST, message='Bad Request. %s' % e)
+
+    cube_id = await _io(store, cube)
+
+    return _json_response(SUCCESS, message='Cube imported successfully', data=cube_id)
+
+
+@routes.get('/cubes/{cube_id}/snapshot')
+async def export_cube(request):
+    """
+    Exports a cube as a binary snapshot (see data.snapshot), which can be imported back through import_cube.
+    :return: Snapshot of the cube.
+    """
+    cube_id = request.match_info['cube_id']
+    cube = await _io(get_cube, cube_id)
+
+    # If cube is None, then nothing was found.
+    if not cube:
+        return _json_response(NOT_FOUND, message='Not found cube with id %s' % cube_id)
+
+    data = await _cpu(snapshot.dumps, cube)
+
+    return web.Response(body=data, content_type=snapshot.MIME_TYPE,
+                        headers={'Content-Disposition': 'attachment; filename=%s.cube' % cube_id})
+
+
+@routes.put('/cubes/{cube_id}')
+async def update_cube(request):
+    """
+    Updates a particular element of a cube, only if the cube is at one of the versions of the If-Match header, if any
+    (see application.update_cube).
+    :return: JSON with a message with the operation status.
+    """
+    cube_id = request.match_info['cube_id']
+    request_body = await request.json()
+
+    # Checks that the body is properly constructed.
+    if set(request_body.keys()) != {'x', 'y', 'z', 'value'}:
+        return _json_response(BAD_REQUEST, message='Bad Request. Check x, y, z, and value fields are present')
+
+    if_match = request.headers.get('If-Match')
+
+    try:
+        successfully_updated = await _io(update_element, cube_id, request_body['x'], request_body['y'],
+                                         request_body['z'], request_body['value'],
+                                         expected_versions=etag_versions(if_match) if if_match else None)
+    except VersionMismatch as e:
+        return _json_response(PRECONDITION_FAILED, headers={'ETag': etag(e.version)},
+                              message='Precondition Failed. %s' % e)
+
+    if not successfully_updated:
+        return _json_response(NOT_FOUND, message='Not found cube with id %s' % cube_id)
+
+    return _json_response(SUCCESS, message='Cube successfully updated.')
+
+
+@routes.patch('/cubes/{cube_id}')
+async def add_to_cube_range(request):
+    """
+    Adds a value to every element of a box of a cube. The body has the value to be added, "delta", and the limits of
+    the box, with the same (optional) fields as the query parameters of detail_cube and the same defaults.
+    :return: JSON with a message with the operation status and the number of elements updated.
+    """
+    cube_id = request.match_info['cube_id']
+    request_body = await request.json()
+
+    # Checks that the body is properly constructed.
+    if not isinstance(request_body, dict) or 'delta' not in request_body or \
+            not set(request_body.keys()) <= RANGE_ADD_FIELDS:
+        return _json_response(BAD_REQUEST, message='Bad Request. Body must have a delta field, and optionally x1, '
+                                                    'x2, y1, y2, z1 and z2')
+
+    dimension = await _io(get_dimension, cube_id)
+
+    # If dimension is None, then nothing was found.
+    if not dimension:
+        return _json_response(NOT_FOUND, message='Not found cube with id %s' % cube_id)
+
+    try:
+        x1, x2, y1, y2, z1, z2 = range_limits([request_body.get('x1'), request_body.get('y1'), request_body.get('z1')],
+                                               [request_body.get('x2'), request_body.get('y2'), request_body.get('z2')],
+                                               dimension)
+        Cube(dimension).validate_add_range(x1, x2, y1, y2, z1, z2, request_body['delta'])
+    except AssertionError as e:
+        return _json_response(BAD_REQUEST, message='Bad Request. %s' % e)
+
+    # The cube may have to be read from database, so it runs on the I/O threads.
+    successfully_updated = await _io(_timed, 'compute', add_range, cube_id, x1, x2, y1, y2, z1, z2,
+                                     request_body['delta'])
+
+    if not successfully_updated:
+        return _json_response(NOT_FOUND, message='Not found cube with id %s' % cube_id)
+
+    return _json_response(SUCCESS, message='Cube successfully updated.',
+                          data=(x2 - x1 + 1) * (y2 - y1 + 1) * (z2 - z1 + 1))
+
+
+@routes.post('/cubes/{cube_id}/updates')
+async def update_cube_elements(request):
+    """
+    Updates a batch of elements of a cube, in order, with a single write. The body is either a JSON array or, when the
+    content type is application/x-ndjson, one JSON object per line.
+    :return: JSON with a message with the operation status and the number of elements received.
+    """
+    cube_id = request.match_info['cube_id']
+
+    try:
+        if request.content_type == NDJSON:
+            request_body = [json.loads(line) for line in (await request.text()).splitlines() if line.strip()]
+        else:
+            request_body = await request.json()
+    except json.JSONDecodeError:
+        return _json_response(BAD_REQUEST, message='Bad Request. Malformed NDJSON body')
+
+    # Checks that the body is properly constructed.
+    if not isinstance(request_body, list) or \
+            not all(isinstance(e, dict) and set(e.keys()) == {'x', 'y', 'z', 'value'} for e in request_body):
+        return _json_response(BAD_REQUEST, message='Bad Request. Body must be a list of elements with x, y, z, '
+                                                    'and value fields')
+
+    elements = [(e['x'], e['y'], e['z'], e['value']) for e in request_body]
+    successfully_updated = await _io(update_elements, cube_id, elements)
+
+    if not successfully_updated:
+        return _json_response(NOT_FOUND, message='Not found cube with id %s' % cube_id)
+
+    return _json_response(SUCCESS, message='Cube successfully updated.', data=len(elements))
+
+
+@routes.get('/cubes')
+async def list_cubes(request):
+    """
+    Retrieves all cubes stored, in id order. Takes the same query parameters as application.list_cubes.
+    :return: List of cubes.
+    """
+    query_params = request.query
+
+    try:
+        limit = int(query_params['limit']) if query_params.get('limit') else None
+    except ValueError:
+        return _json_response(BAD_REQUEST, message='Bad Request. "limit" must be an integer')
+
+    if limit is not None and limit <= 0:
+        return _json_response(BAD_REQUEST, message='Bad Request. "limit" must be positive')
+
+    if query_params.get('after') and not valid_cube_id(query_params['after']):
+        return _json_response(BAD_REQUEST, message='Bad Request. "after" must be a cube id')
+
+    cubes = await _io(iter_all, limit=limit, after=query_params.get('after'),
+                      ids_only=query_params.get('fields') == 'ids')
+
+    if query_params.get('format') == 'ndjson' or _prefers_ndjson(request):
+        response = web.StreamResponse(status=SUCCESS, headers={'Content-Type': NDJSON})
+        await response.prepare(request)
+
+        # Cubes are read from database a batch at a time, and sent as soon as they're read.
+        while True:
+            batch = await _io(lambda: list(islice(cubes, _STREAM_BATCH_SIZE)))
+
+            if not batch:
+                break
+
+            await response.write(''.join('%s\n' % json.dumps(cube) for cube in batch).encode('utf8'))
+
+        await response.write_eof()
+        return response
+
+    cubes = await _io(list, cubes)
+    response = {'data': cubes, 'message': 'Cubes retrieved successfully.'}
+
+    if limit is not None and len(cubes) == limit:
+        response['next'] = cubes[-1]['_id']
+
+    return _json_response(SUCCESS, **response)
+
+
+@routes.get('/cubes/{cube_id}')
+async def detail_cube(request):
+    """
+    Gets the details of a cube, or a summation over it if there's at least one range query parameter, with the version
+    of the cube as ETag (see application.detail_cube).
+    :return: JSON with the cube details.
+    """
+    cube_id = request.match_info['cube_id']
+
+    # The version is read before the cube, so the ETag is never newer than the response.
+    version = await _io(get_version, cube_id)
+
+    # If version is None, then nothing was found.
+    if version is None:
+        return _json_response(NOT_FOUND, message='Not found cube with id %s' % cube_id)
+
+    if_none_match = request.headers.get('If-None-Match')
+
+    if if_none_match and etag_matches(if_none_match, version):
+        return web.Response(status=NOT_MODIFIED, headers={'ETag': etag(version)})
+
+    query_params = request.query
+    x1, x2, y1, y2, z1, z2 = (query_params.get(p) for p in ['x1', 'x2', 'y1', 'y2', 'z1', 'z2'])
+
+    # If there's at least one parameter, then we must query the cube instead of returning it
+    if any([x1, x2, y1, y2, z1, z2]):
+        dimension = await _io(get_dimension, cube_id)
+
+        # If dimension is None, then nothing was found.
+        if not dimension:
+            return _json_response(NOT_FOUND, message='Not found cube with id %s' % cube_id)
+
+        # Query parameters given without a value take their defaults too.
+        from_ = [int(limit) if limit else None for limit in [x1, y1, z1]]
+        to_ = [int(limit) if limit else None for limit in [x2, y2, z2]]
+        x1, x2, y1, y2, z1, z2 = range_limits(from_, to_, dimension)
+
+        # Read only the slabs of the cube within the range.
+        cube = await _io(get_cube_range, cube_id, x1, x2)
+
+        if not cube:
+            return _json_response(NOT_FOUND, message='Not found cube with id %s' % cube_id)
+
+        cube_summation = await _cpu(_timed, 'compute', cube.query, x1, x2, y1, y2, z1, z2)
+
+        response = {'_id': cube_id, 'cube': await _cpu(_timed, 'serialize', slabs, cube, x1, x2),
+                    'dimension': dimension, 'params': {'x1': x1, 'x2': x2, 'y1': y1, 'y2': y2, 'z1': z1, 'z2': z2},
+                    'result': cube_summation}
+    else:
+        cube = await _io(get_cube, cube_id)
+
+        # If cube is None, then nothing was found.
+        if not cube:
+            return _json_response(NOT_FOUND, message='Not found cube with id %s' % cube_id)
+
+        response = {'_id': cube_id, 'cube': await _cpu(_timed, 'serialize', lambda: cube.cube),
+                    'dimension': cube.dimension}
+
+    return _json_response(SUCCESS, headers={'ETag': etag(version)}, message='Cube retrieved successfully',
+                          data=response)
+
+
+@routes.get('/cubes/{cube_id}/changes')
+async def cube_changes(request):
+    """
+    Gets the elements of a cube updated after the version given in the "since" query parameter, or every element of
+    the cube if those updates aren't known anymore (see application.cube_changes).
+    :return: JSON with the current version of the cube and the elements updated.
+    """
+    cube_id = request.match_info['cube_id']
+    since = request.query.get('since', '')
+
+    if not since.isdigit():
+        return _json_response(BAD_REQUEST, message='Bad Request. "since" must be a version')
+
+    since = int(since)
+    changes = await _io(get_changes, cube_id, since)
+
+    # If changes is None, then nothing was found.
+    if changes is None:
+        return _json_response(NOT_FOUND, message='Not found cube with id %s' % cube_id)
+
+    data = await _cpu(_timed, 'serialize', changes_response, cube_id, since, *changes)
+
+    return _json_response(SUCCESS, headers={'ETag': etag(changes[0])},
+                          message='Cube changes retrieved successfully', data=data)
+
+
+@routes.post('/cubes/{cube_id}/queries')
+async def query_cube(request):
+    """
+    Performs many summations over a cube, loading it only once (see application.query_cube).
+    :return: JSON with the parameters and result of every summation, in input order.
+    """
+    cube_id = request.match_info['cube_id']
+    request_body = await request.json()
+
+    # Checks that the body is properly constructed.
+    if not isinstance(request_body, list) or \
+            not all(isinstance(box, dict) or (isinstance(box, list) and len(box) == 6) for box in request_body):
+        return _json_response(BAD_REQUEST, message='Bad Request. Body must be a list of boxes')
+
+    cube = await _io(get_cube, cube_id)
+
+    # If cube is None, then nothing was found.
+    if not cube:
+        return _json_response(NOT_FOUND, message='Not found cube with id %s' % cube_id)
+
+    boxes = []
+    for i, box in enumerate(request_body):
+        try:
+            if isinstance(box, dict):
+                box = range_limits([box.get('x1'), box.get('y1'), box.get('z1')],
+                                   [box.get('x2'), box.get('y2'), box.get('z2')], cube.dimension)
+            else:
+                cube.validate_query(*box)
+        except AssertionError as e:
+            return _json_response(BAD_REQUEST, message='Bad Request. Box %d: %s' % (i, e))
+
+        boxes.append(box)
+
+    summations = await _cpu(_timed, 'compute', cube.query_many, boxes)
+
+    response = [{'params': dict(zip(['x1', 'x2', 'y1', 'y2', 'z1', 'z2'], box)), 'result': summation}
+                for box, summation in zip(boxes, summations)]
+
+    return _json_response(SUCCESS, message='Cube queried successfully', data=response)
+
+
+@routes.get('/metrics')
+async def get_metrics(request):
+    """
+    Exposes the performance metrics of this process in the Prometheus text format (see application.get_metrics).
+    :return: Metrics, as plain text.
+    """
+    return web.Response(text=metrics.registry.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+@routes.get('/debug/profile')
+async def get_profile(request):
+    """
+    Reports the stacks seen by the sampling profiler, in the folded format of flame graph tools. Takes the same query
+    parameters as application.get_profile.
+    :return: One line per stack, as plain text. Not found if the profiler isn't enabled in config/server.json.
+    """
+    limit = request.query.get('limit')
+    folded = profile(int(limit) if limit else None, reset=request.query.get('reset') == 'true')
+
+    if folded is None:
+        return _json_response(NOT_FOUND, message='The profiler is not enabled')
+
+    return web.Response(text=folded, content_type='text/plain')
+
+
+@routes.delete('/cubes')
+async def delete_all_cubes(request):
+    """
+    Deletes all cubes.
+    :return: JSON with a message notifying the number of cubes removed.
+    """
+    elements_removed = await _io(delete_all)
+
+    return _json_response(SUCCESS, message='%d cubes were removed.' % elements_removed)
+
+
+@routes.post('/cubes/flush')
+async def flush_cubes(request):
+    """
+    Writes to database every element update buffered by this process (see write_behind in config/persistence.json).
+    :return: JSON with a message notifying the number of elements written.
+    """
+    written = await _io(flush)
+
+    return _json_response(SUCCESS, message='%d buffered elements were written.' % written, data=written)
+
+
+@routes.delete('/cubes/{cube_id}')
+async def delete_cube(request):
+    """
+    Deletes a particular cube.
+    :return: JSON with message related to the operation status.
+    """
+    cube_id = request.match_info['cube_id']
+    successfully_removed = await _io(delete, cube_id)
+
+    if not successfully_removed:
+        return _json_response(INTERNAL_SERVER_ERROR, message='Could not remove cube with id %s' % cube_id)
+
+    return _json_response(SUCCESS, message='Cube successfully removed')
+
+
+def create_app():
+    """
+    Creates the aiohttp application with every route of the API.
+    :return: New aiohttp Application instance.
+    """
+    app = web.Application(middlewares=[_timing, _internal_errors])
+    app.add_routes(routes)
+
+    return app
+
+
+# ===============================
+# Private helper functions.
+# ===============================
+@web.middleware
+async def _timing(request, handler):
+    """
+    Labels the metrics recorded while serving a request with its route, and records the time taken to serve it.
+    """
+    route = _route(request)
+    metrics.set_route(route)
+    start = time.perf_counter()
+    status = INTERNAL_SERVER_ERROR
+
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        metrics.observe_request(route, request.method, status, time.perf_counter() - start)
+
+
+@web.middleware
+async def _internal_errors(request, handler):
+    """
+    Turns any unexpected error of a handler into a JSON response with status 500, like every route of application.py,
+    after logging it with its traceback and counting it.
+    """
+    try:
+        return await handler(request)
+    except web.HTTPException:
+        raise
+    except Exception as e:
+        logging.getLogger(__name__).exception('Error serving %s %s', request.method, request.path)
+        metrics.request_errors.inc((_route(request),))
+        return _json_response(INTERNAL_SERVER_ERROR, message='Internal Server Error. Details: %s' % e)
+
+
+def _json_response(status, headers=None, **body):
+    """
+    :return: JSON response with the given status, headers and fields.
+    """
+    return web.json_response(body, status=status, headers=headers)
+
+
+def _route(request):
+    """
+    :return: Route of a request (e.g. /cubes/{cube_id}), which labels its metrics.
+    """
+    resource = request.match_info.route.resource
+    return resource.canonical if resource is not None else 'unmatched'
+
+
+def _prefers_ndjson(request):
+    """
+    :return: True if the request accepts application/x-ndjson but not application/json.
+    """
+    accept = request.headers.get('Accept', '')
+    return NDJSON in accept and 'application/json' not in accept
+
+
+def _timed(phase, function, *args, **kwargs):
+    """
+    Calls a function, timing it as a phase of the current request (see metrics.timer).
+    :return: Result of the function.
+    """
+    with metrics.timer(phase):
+        return function(*args, **kwargs)
+
+
+async def _io(function, *args, **kwargs):
+    """
+    Runs a blocking function (e.g. one that accesses the database) on the I/O threads.
+    :return: Result of the function.
+    """
+    return await _run(_io_executor, function, *args, **kwargs)
+
+
+async def _cpu(function, *args, **kwargs):
+    """
+    Runs a CPU-heavy function (e.g. a sum) on the CPU threads.
+    :return: Result of the function.
+    """
+    return await _run(_cpu_executor, function, *args, **kwargs)
+
+
+async def _run(executor, function, *args, **kwargs):
+    """
+    Runs a function on an executor, without blocking the event loop. The function sees the context variables of the
+    caller (e.g. the route metrics are labeled with).
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(context.run, function, *args, **kwargs))
+
+
+if __name__ == '__main__':
+    # If you want to change these configurations, head to /config/server.json
+    web.run_app(create_app(), host=server_conf['host'], port=server_conf['port'])
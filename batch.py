@@ -0,0 +1,155 @@
+"""
+Command line runner of cube operations in the HackerRank input format:
+
+    T               <- Number of test cases.
+    N M             <- Dimension of the cube and number of operations of the first test case.
+    UPDATE x y z W  <- M operations.
+    QUERY x1 y1 z1 x2 y2 z2
+    ...
+    N M             <- Second test case, and so on.
+
+Input is read line by line and the result of every QUERY is written as soon as it's known, so memory use doesn't depend
+on the size of the input. Test cases are independent, so they can also be run by a pool of processes, in which case a
+few of them per process are read ahead. Usage:
+
+    python batch.py [--engine ENGINE] [--processes P] < input > output
+"""
+
+import argparse
+import sys
+from itertools import islice
+from multiprocessing import get_context
+import metrics
+from data.cube import Cube
+from data.engines import DEFAULT_ENGINE, ENGINES
+
+# Size of the output buffer, in bytes.
+_OUTPUT_BUFFER_SIZE = 1 << 16
+
+# Number of test cases read ahead per process when running in parallel.
+_CASES_PER_PROCESS = 4
+
+
+def run(in_stream, out_stream, engine=None):
+    """
+    Runs every test case read from the input stream, writing the result of each query to the output stream, one per
+    line.
+    :param in_stream: Iterable of input lines (e.g. a text file).
+    :param out_stream: Text stream where results are written.
+    :param engine: Optional name of the storage engine of the cubes (see data.engines.ENGINES).
+    """
+    lines = iter(in_stream)
+    tests = int(next(lines))
+
+    for _ in range(tests):
+        dimension, operations = (int(e) for e in next(lines).split())
+        cube = Cube(dimension, engine=engine)
+
+        for _ in range(operations):
+            result = run_operation(cube, next(lines))
+
+            if result is not None:
+                out_stream.write('%d\n' % result)
+
+
+def run_parallel(in_stream, out_stream, processes, engine=None):
+    """
+    Same as run, but test cases are spread across a pool of processes. Results are written in input order.
+    :param in_stream: Iterable of input lines (e.g. a text file).
+    :param out_stream: Text stream where results are written.
+    :param processes: Number of processes.
+    :param engine: Optional name of the storage engine of the cubes (see data.engines.ENGINES).
+    """
+    test_cases = read_test_cases(in_stream)
+
+    # Spawned processes start clean, without any state (e.g. database connections) of this one.
+    with get_context('spawn').Pool(processes) as pool:
+        while True:
+            # Only a window of test cases is read at a time, so memory use stays bounded.
+            window = [(dimension, operations, engine)
+                      for dimension, operations in islice(test_cases, processes * _CASES_PER_PROCESS)]
+
+            if not window:
+                break
+
+            for output in pool.imap(_run_test_case, window):
+                out_stream.write(output)
+
+
+def read_test_cases(in_stream):
+    """
+    Splits the input in test cases.
+    :param in_stream: Iterable of input lines (e.g. a text file).
+    :return: Generator of (dimension, operations) tuples, where operations is the list of lines of the test case.
+    """
+    lines = iter(in_stream)
+    tests = int(next(lines))
+
+    for _ in range(tests):
+        dimension, operations = (int(e) for e in next(lines).split())
+        yield dimension, list(islice(lines, operations))
+
+
+def run_operation(cube, line):
+    """
+    Runs a single UPDATE or QUERY operation over a cube.
+    :param cube: Cube to be updated or queried.
+    :param line: Line with the operation, e.g. "UPDATE 2 2 2 4" or "QUERY 1 1 1 3 3 3".
+    :return: Result of the query, or None for updates.
+    """
+    operation, *arguments = line.split()
+    arguments = [int(a) for a in arguments]
+
+    if operation == 'UPDATE':
+        assert len(arguments) == 4, 'UPDATE takes 4 arguments: x y z W'
+        cube.update(*arguments)
+        return None
+
+    if operation == 'QUERY':
+        assert len(arguments) == 6, 'QUERY takes 6 arguments: x1 y1 z1 x2 y2 z2'
+        x1, y1, z1, x2, y2, z2 = arguments
+        return cube.query(x1, x2, y1, y2, z1, z2)
+
+    raise ValueError('Unknown operation %s' % operation)
+
+
+def main(argv=None):
+    """
+    Command line entry point. Reads from stdin and writes to stdout.
+    :param argv: Command line arguments. Defaults to sys.argv.
+    """
+    parser = argparse.ArgumentParser(description='Runs cube operations in the HackerRank input format.')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default=DEFAULT_ENGINE,
+                        help='Storage engine of the cubes (default: %(default)s).')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Number of processes test cases are spread across (default: %(default)s).')
+    arguments = parser.parse_args(argv)
+
+    # Nobody reads the metrics of a command line run, so they're not recorded.
+    metrics.enabled = False
+
+    with open(sys.stdout.fileno(), 'w', buffering=_OUTPUT_BUFFER_SIZE, closefd=False) as out_stream:
+        if arguments.processes > 1:
+            run_parallel(sys.stdin, out_stream, arguments.processes, engine=arguments.engine)
+        else:
+            run(sys.stdin, out_stream, engine=arguments.engine)
+
+
+# ===============================
+# Private helper functions.
+# ===============================
+def _run_test_case(test_case):
+    """
+    Runs a single test case. Meant to be run by a pool of processes.
+    :param test_case: (dimension, operations, engine) tuple.
+    :return: Results of the queries, one per line.
+    """
+    dimension, operations, engine = test_case
+    cube = Cube(dimension, engine=engine)
+    results = (run_operation(cube, line) for line in operations)
+
+    return ''.join('%d\n' % result for result in results if result is not None)
+
+
+if __name__ == '__main__':
+    main()
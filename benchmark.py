@@ -0,0 +1,234 @@
+"""
+Benchmark of the Cube storage engines and of the REST API. Generates a synthetic workload of updates and queries, runs it
+against every engine (and optionally against the API), and prints a JSON report with the throughput, latency
+percentiles and peak memory of each run, so reports of different releases can be compared. Usage:
+
+    python benchmark.py [--dimension N] [--operations M] [--update-ratio R] [--box-size {point,small,uniform,full}]
+                        [--sparsity S] [--engines E [E ...]] [--api] [--backend BACKEND] [--output FILE]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+import metrics
+from data import engines
+from data.cube import Cube, query_cache
+from persistence.backends import BACKENDS
+
+# Box size distributions. Each one draws the side of a box along one axis, given the dimension of the cube.
+_BOX_SIDES = {
+    'point': lambda n: 1,
+    'small': lambda n: random.randint(1, max(1, n // 10)),
+    'uniform': lambda n: random.randint(1, n),
+    'full': lambda n: n
+}
+
+
+def generate_workload(dimension, operations, update_ratio=0.5, box_size='uniform', sparsity=0.01, seed=42):
+    """
+    Generates a random workload.
+    :param dimension: Dimension of the cube, between 1 and 100.
+    :param operations: Number of operations.
+    :param update_ratio: Fraction of the operations that are updates. The rest are queries.
+    :param box_size: Distribution of the size of the queried boxes (see _BOX_SIDES).
+    :param sparsity: Fraction of the points of the cube that updates touch.
+    :param seed: Seed of the random generator, so workloads can be generated again.
+    :return: List of ('UPDATE', (x, y, z, value)) and ('QUERY', (x1, x2, y1, y2, z1, z2)) tuples.
+    """
+    random.seed(seed)
+
+    # Updates only touch a pool of points, whose size depends on the sparsity.
+    pool_size = max(1, int(sparsity * dimension ** 3))
+    points = [tuple(random.randint(1, dimension) for _ in range(3)) for _ in range(pool_size)]
+    box_side = _BOX_SIDES[box_size]
+
+    workload = []
+    for _ in range(operations):
+        if random.random() < update_ratio:
+            workload.append(('UPDATE', random.choice(points) + (random.randint(-10 ** 9, 10 ** 9),)))
+        else:
+            box = []
+            for _ in range(3):
+                side = box_side(dimension)
+                start = random.randint(1, dimension - side + 1)
+                box += [start, start + side - 1]
+            workload.append(('QUERY', tuple(box)))
+
+    return workload
+
+
+def bench_engine(engine, dimension, workload):
+    """
+    Runs a workload against a cube backed by the given engine.
+    :param engine: Name of the storage engine.
+    :param dimension: Dimension of the cube.
+    :param workload: List of operations, as returned by generate_workload.
+    :return: dict with the results (see _summarize), plus the peak memory in bytes.
+    """
+    def run(cube):
+        latencies = []
+        for operation, arguments in workload:
+            start = time.perf_counter()
+            if operation == 'UPDATE':
+                cube.update(*arguments)
+            else:
+                cube.query(*arguments)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    latencies = run(Cube(dimension, engine=engine))
+
+    # Memory is measured on a second run, as tracing allocations slows everything down.
+    tracemalloc.start()
+    try:
+        run(Cube(dimension, engine=engine))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    result = _summarize(latencies)
+    result['peak_memory_bytes'] = peak
+    return result
+
+
+def bench_api(dimension, workload):
+    """
+    Runs a workload against the REST API, through a Flask test client, using a single cube.
+    :param dimension: Dimension of the cube.
+    :param workload: List of operations, as returned by generate_workload.
+    :return: dict with the results (see _summarize).
+    """
+    from application import app
+
+    client = app.test_client()
+    cube_id = client.post('/cubes', json={'dimension': dimension}).get_json()['data']
+
+    latencies = []
+    try:
+        for operation, arguments in workload:
+            start = time.perf_counter()
+            if operation == 'UPDATE':
+                response = client.put('/cubes/%s' % cube_id, json=dict(zip(['x', 'y', 'z', 'value'], arguments)))
+            else:
+                query = '&'.join('%s=%d' % p for p in zip(['x1', 'x2', 'y1', 'y2', 'z1', 'z2'], arguments))
+                response = client.get('/cubes/%s?%s' % (cube_id, query))
+            latencies.append(time.perf_counter() - start)
+
+            assert response.status_code == 200, response.get_json()
+    finally:
+        client.delete('/cubes/%s' % cube_id)
+
+    return _summarize(latencies)
+
+
+def main(argv=None):
+    """
+    Command line entry point. Prints the JSON report to stdout, or writes it to a file.
+    :param argv: Command line arguments. Defaults to sys.argv.
+    """
+    available_engines = sorted(name for name, engine in engines.ENGINES.items()
+                               if engine is not engines.NumpyEngine or engines.numpy is not None)
+
+    parser = argparse.ArgumentParser(description='Benchmarks the Cube storage engines and the REST API.')
+    parser.add_argument('--dimension', type=int, default=100, help='Dimension of the cube (default: %(default)s).')
+    parser.add_argument('--operations', type=int, default=10000, help='Number of operations (default: %(default)s).')
+    parser.add_argument('--update-ratio', type=float, default=0.5,
+                        help='Fraction of the operations that are updates (default: %(default)s).')
+    parser.add_argument('--box-size', choices=sorted(_BOX_SIDES), default='uniform',
+                        help='Distribution of the size of the queried boxes (default: %(default)s).')
+    parser.add_argument('--sparsity', type=float, default=0.01,
+                        help='Fraction of the points of the cube that updates touch (default: %(default)s).')
+    parser.add_argument('--seed', type=int, default=42, help='Seed of the workload (default: %(default)s).')
+    parser.add_argument('--engines', nargs='+', choices=available_engines, default=available_engines,
+                        help='Engines to benchmark (default: all of them).')
+    parser.add_argument('--query-cache', action='store_true',
+                        help='Keep the query cache enabled. By default it is disabled so engines are compared.')
+    parser.add_argument('--api', action='store_true', help='Benchmark the REST API as well.')
+    parser.add_argument('--backend', choices=sorted(BACKENDS),
+                        help='Storage backend used by the API benchmark. Defaults to the one in '
+                             'config/persistence.json.')
+    parser.add_argument('--output', help='File the report is written to. Defaults to stdout.')
+    arguments = parser.parse_args(argv)
+
+    workload = generate_workload(arguments.dimension, arguments.operations, arguments.update_ratio,
+                                 arguments.box_size, arguments.sparsity, arguments.seed)
+
+    # The query cache and metrics are process-wide settings, restored once done so the caller isn't affected.
+    max_entries, metrics_enabled = query_cache.max_entries, metrics.enabled
+    try:
+        if not arguments.query_cache:
+            query_cache.max_entries = 0
+
+        # Engines are compared without the overhead of recording metrics, which only the API records.
+        metrics.enabled = False
+
+        report = {
+            'python': sys.version.split()[0],
+            'workload': {
+                'dimension': arguments.dimension,
+                'operations': arguments.operations,
+                'update_ratio': arguments.update_ratio,
+                'box_size': arguments.box_size,
+                'sparsity': arguments.sparsity,
+                'seed': arguments.seed,
+                'query_cache': arguments.query_cache
+            },
+            'engines': {engine: bench_engine(engine, arguments.dimension, workload) for engine in arguments.engines}
+        }
+
+        if arguments.api:
+            metrics.enabled = True
+
+            if arguments.backend:
+                _use_backend(arguments.backend)
+            report['api_backend'] = arguments.backend or 'configured'
+            report['api'] = bench_api(arguments.dimension, workload)
+
+        if arguments.output:
+            with open(arguments.output, 'w') as out:
+                json.dump(report, out, indent=2, sort_keys=True)
+        else:
+            json.dump(report, sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write('\n')
+    finally:
+        query_cache.max_entries = max_entries
+        metrics.enabled = metrics_enabled
+
+
+# ===============================
+# Private helper functions.
+# ===============================
+def _summarize(latencies):
+    """
+    Summarizes the latencies of a run.
+    :param latencies: List with the latency of every operation, in seconds.
+    :return: dict with the number of operations, operations per second and the p50 and p99 latencies in microseconds.
+    """
+    total = sum(latencies)
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1e6 if latencies else 0.0
+
+    return {
+        'operations': len(latencies),
+        'ops_per_sec': len(latencies) / total if total else 0.0,
+        'p50_us': percentile(0.5),
+        'p99_us': percentile(0.99)
+    }
+
+
+def _use_backend(name):
+    """
+    Makes the persistence layer use the given storage backend. Must be called before config is loaded.
+    """
+    assert 'config.config' not in sys.modules, 'The backend must be picked before config is loaded'
+    os.environ['CUBES_BACKEND'] = name
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+"""
+Multi-process server mode. Starts a number of worker processes, each one running the API on its own port, and a router
+that forwards every request to a worker, so every core is used:
+
+    - Requests about a particular cube (/cubes/<cube_id>...) always go to the same worker, picked by hashing the cube
+    id. Hence each cube is cached (and written) by a single process, and caches stay coherent.
+    - Requests that create cubes are spread across workers in turn. Later requests about those cubes may go to another
+    worker, which reads them from database, so the backend must be shared by every process (i.e. not memory).
+    - Requests that delete every cube, or that flush buffered updates, go to every worker, so all of them drop their
+    caches or write their buffers.
+    - Any other request (e.g. listing cubes) goes to the first worker. In write-behind mode, the other workers write
+    their buffered updates before cubes are listed, so the list has every update acknowledged.
+
+Responses of the workers are streamed back as they're read.
+
+Usage:
+
+    python cluster.py [--workers W]
+"""
+
+import argparse
+import http.client
+import os
+from itertools import count
+from multiprocessing import get_context
+from zlib import crc32
+from werkzeug.serving import run_simple
+from werkzeug.wrappers import Request, Response
+
+# Headers that only make sense between two hops, so they're not forwarded.
+_HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers',
+                       'transfer-encoding', 'upgrade', 'host', 'content-length'}
+
+# Paths under /cubes that don't name a cube.
+_COLLECTION_PATHS = {'import', 'flush'}
+
+# Backends whose cubes only live in the process that stored them, so workers can't share them.
+_PROCESS_BACKENDS = {'memory'}
+
+# Size of the chunks of the responses of the workers, in bytes.
+_CHUNK_SIZE = 65536
+
+
+def worker_for(cube_id, workers):
+    """
+    Picks the worker that owns a cube. The same cube id always maps to the same worker, in every process.
+    :param cube_id: Identifier of the cube.
+    :param workers: Number of workers.
+    :return: Index of the worker, between 0 and workers - 1.
+    """
+    return crc32(cube_id.encode('utf8')) % workers
+
+
+class Router:
+    """
+    WSGI application that forwards requests to the worker processes.
+    """
+
+    def __init__(self, host, ports, write_behind=False):
+        """
+        Creates a new router.
+        :param host: Host the workers listen on.
+        :param ports: List with the port of every worker.
+        :param write_behind: Whether workers buffer element updates (see persistence.cube), so they must write them
+        before another worker reads every cube.
+        :return: New Router instance.
+        """
+        self.host = host
+        self.ports = ports
+        self.write_behind = write_behind
+        self._turns = count()
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        body = request.get_data()
+
+        for target in self.flush_targets(request.method, request.path):
+            self._flush(self.ports[target])
+
+        # When broadcasting, the first worker is the one that actually does the work, so its response is the one sent.
+        responses = [self._forward(request, body, self.ports[target])
+                     for target in self.targets(request.method, request.path)]
+
+        for response in responses[1:]:
+            response.close()
+
+        return responses[0](environ, start_response)
+
+    def targets(self, method, path):
+        """
+        Picks the workers a request must be forwarded to.
+        :param method: HTTP method of the request.
+        :param path: Path of the request.
+        :return: List of indexes of workers.
+        """
+        segments = path.strip('/').split('/')
+        workers = len(self.ports)
+
+        if segments[0] == 'cubes' and len(segments) > 1 and segments[1] not in _COLLECTION_PATHS:
+            return [worker_for(segments[1], workers)]
+
+        if segments == ['cubes', 'flush'] or (segments == ['cubes'] and method == 'DELETE'):
+            return list(range(workers))
+
+        if segments[0] == 'cubes' and (len(segments) > 1 or method == 'POST'):
+            return [next(self._turns) % workers]
+
+        return [0]
+
+    def flush_targets(self, method, path):
+        """
+        Picks the workers that must write their buffered updates before a request is forwarded, because it reads cubes
+        owned by any worker. The worker the request is forwarded to writes its own.
+        :param method: HTTP method of the request.
+        :param path: Path of the request.
+        :return: List of indexes of workers.
+        """
+        if self.write_behind and method == 'GET' and path.strip('/') == 'cubes':
+            return list(range(1, len(self.ports)))
+
+        return []
+
+    # ========================
+    # Private helper functions
+    # ========================
+    def _forward(self, request, body, port):
+        """
+        Sends a request to a worker.
+        :return: Response of the worker, whose body is streamed from the worker as it's sent.
+        """
+        headers = {name: value for name, value in request.headers.items() if name.lower() not in _HOP_BY_HOP_HEADERS}
+        path = request.full_path if request.query_string else request.path
+
+        connection = http.client.HTTPConnection(self.host, port)
+        try:
+            connection.request(request.method, path, body=body, headers=headers)
+            response = connection.getresponse()
+        except Exception:
+            connection.close()
+            raise
+
+        return Response(_stream(connection, response), status=response.status,
+                        headers=[(name, value) for name, value in response.getheaders()
+                                 if name.lower() not in _HOP_BY_HOP_HEADERS])
+
+    def _flush(self, port):
+        """
+        Makes a worker write its buffered updates to database.
+        """
+        connection = http.client.HTTPConnection(self.host, port)
+        try:
+            connection.request('POST', '/cubes/flush')
+            connection.getresponse().read()
+        finally:
+            connection.close()
+
+
+def serve(host, port, workers):
+    """
+    Starts the workers and then the router, which serves until interrupted.
+    :param host: Host the router listens on.
+    :param port: Port the router listens on. Workers listen on the following ones.
+    :param workers: Number of worker processes.
+    """
+    from config.config import persistence_conf
+
+    assert persistence_conf['backend'] not in _PROCESS_BACKENDS, \
+        'Backend %s can not be shared by workers' % persistence_conf['backend']
+
+    ports = [port + 1 + i for i in range(workers)]
+
+    # Spawned processes start clean, without any state (e.g. database connections) of this one.
+    context = get_context('spawn')
+    processes = [context.Process(target=_serve_worker, args=('127.0.0.1', worker_port), daemon=True)
+                 for worker_port in ports]
+
+    for process in processes:
+        process.start()
+
+    write_behind = persistence_conf.get('write_behind', {}).get('enabled', False)
+
+    try:
+        run_simple(host, port, Router('127.0.0.1', ports, write_behind), threaded=True)
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+# ===============================
+# Private helper functions.
+# ===============================
+def _stream(connection, response):
+    """
+    Reads the body of the response of a worker, a chunk at a time, and closes the connection once it's read (or once
+    the response is closed).
+    """
+    try:
+        for chunk in iter(lambda: response.read(_CHUNK_SIZE), b''):
+            yield chunk
+    finally:
+        connection.close()
+
+
+def _serve_worker(host, port):
+    """
+    Runs the API in a worker process.
+    """
+    from application import app
+
+    app.run(host=host, port=port, threaded=True)
+
+
+if __name__ == '__main__':
+    from config.config import server_conf
+
+    parser = argparse.ArgumentParser(description='Runs the API on many processes, partitioning cubes among them.')
+    parser.add_argument('--workers', type=int, default=server_conf.get('workers', os.cpu_count()),
+                        help='Number of worker processes (default: %(default)s).')
+    arguments = parser.parse_args()
+
+    # If you want to change these configurations, head to /config/server.json
+    serve(server_conf['host'], server_conf['port'], arguments.workers)
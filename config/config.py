@@ -1,10 +1,56 @@
 """
 Loads the configuration data present in the filesystem into memory.
+
+The MongoDB client is only created when first needed, and once per process: processes forked afterwards create their
+own instead of using the one inherited from their parent, which is not fork-safe.
 """
 
 import json
-from pymongo import MongoClient
 import os
+from threading import Lock
+
+# MongoDB client of this process and pid of the process that created it.
+_client = None
+_client_pid = None
+_client_lock = Lock()
+
+
+def get_client():
+    """
+    Gets the MongoDB client of the current process, creating it if needed. The client doesn't connect until the first
+    operation.
+    :return: MongoClient instance.
+    """
+    global _client, _client_pid
+
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            from pymongo import MongoClient  # Imported here, as it's slow to import and not every backend needs it.
+
+            pool_conf = persistence_conf.get('pool', {})
+            _client = MongoClient(persistence_conf['host'], persistence_conf['port'], connect=False,
+                                  maxPoolSize=pool_conf.get('max_pool_size', 100),
+                                  minPoolSize=pool_conf.get('min_pool_size', 0),
+                                  connectTimeoutMS=pool_conf.get('connect_timeout_ms', 20000),
+                                  serverSelectionTimeoutMS=pool_conf.get('server_selection_timeout_ms', 30000),
+                                  socketTimeoutMS=pool_conf.get('socket_timeout_ms'))
+            _client_pid = os.getpid()
+
+        return _client
+
+
+def get_database():
+    """
+    :return: MongoDB database of the cubes, from the client of the current process.
+    """
+    return get_client()[persistence_conf['db']]
+
+
+def get_collection():
+    """
+    :return: MongoDB collection of the cubes, from the client of the current process.
+    """
+    return get_database()[persistence_conf['collection']]
 
 
 def _load_persistence_config():
@@ -16,11 +62,10 @@ def _load_persistence_config():
     with open('%s/persistence.json' % parent_dir) as f:
         configuration = json.load(f)
 
-    c = MongoClient(configuration['host'], configuration['port'])  # Client.
-    db = c[configuration['db']]  # Database
-    col = db[configuration['collection']]  # Collection
+    # The backend can be overridden from the environment, e.g. to run the tests without a MongoDB server.
+    configuration['backend'] = os.environ.get('CUBES_BACKEND', configuration.get('backend', 'mongo'))
 
-    return c, db, col
+    return configuration
 
 
 def _load_server_config():
@@ -34,6 +79,31 @@ def _load_server_config():
 
     return configuration
 
+
+def _forget_client():
+    """
+    Drops the client inherited by a forked process, without closing it, as its sockets are shared with the parent.
+    """
+    global _client, _client_lock
+
+    _client = None
+    _client_lock = Lock()  # It could have been held by another thread of the parent when forking.
+
+
+def __getattr__(name):
+    """
+    Keeps client, database and collection importable from this module, creating them on first access.
+    """
+    factories = {'client': get_client, 'database': get_database, 'collection': get_collection}
+
+    if name in factories:
+        return factories[name]()
+
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+os.register_at_fork(after_in_child=_forget_client)
+
 # Exportable values.
-client, database, collection = _load_persistence_config()
+persistence_conf = _load_persistence_config()
 server_conf = _load_server_config()
@@ -3,14 +3,36 @@ Defines the Cube class used to
 process the incoming requests at runtime.
 """
 
+from itertools import count
+from numbers import Integral
+from threading import RLock
+import metrics
+from data.engines import DEFAULT_ENGINE, get_engine_class
+from data.lru import LRUCache
 
-def instantiate_from_raw_data(dictionary):
+# Results of Cube.query, shared by all cubes and keyed by (cube uid, cube version, box). Every update bumps the version
+# of a cube, so results of older versions are never read again and just wait to be evicted. Resize it by setting
+# max_entries, and look at its hit rate through query_cache.stats().
+query_cache = LRUCache(max_entries=4096)
+
+# Source of unique identifiers for Cube instances, so results of different cubes never mix up in the query cache.
+_uids = count()
+
+
+def instantiate_from_raw_data(dictionary, engine=None):
     """
     Factory method that creates a new cube from raw data from database.
     :param dictionary: dict instance.
-    :return: new Cube filled with the data received in the input.
+    :param engine: Optional name of the storage engine to use (see data.engines.ENGINES).
+    :return: new Cube filled with the data received in the input. If the raw data has an index (see
+    Cube.export_index) the cube loads it as well.
     """
-    return Cube(dictionary['dimension'], dictionary['cube'])
+    cube = Cube(dictionary['dimension'], dictionary['cube'], engine=engine)
+
+    if dictionary.get('index') is not None:
+        cube.load_index(dictionary['index'])
+
+    return cube
 
 
 class Cube:
@@ -18,35 +40,45 @@ class Cube:
     Provides an abstraction of a Cube of integers.
     """
 
+    __slots__ = ('dimension', 'version', '_engine', '_lock', '_uid')
+
     # NOTE ABOUT INNER REPRESENTATION:
     # ------------------------------------
-    # A cube is represented as a dictionary (a.k.a. hash table) for accessibility speed and ease. At first, a cube has
-    # all its elements set to 0. Given that we only query the cube by summing the elements within a given range and
-    # provided that 0 is the neutral element of the sum, there's no use in storing it. Hence, only the positions with a
-    # non-zero value has a (key, value) pair in the dictionary. Example:
+    # A cube delegates the storage of its elements to a storage engine (see data/engines.py). The Cube itself only
+    # validates the input and keeps the public API stable, so the engine can be picked depending on the workload.
+    # The default engine keeps only the non-zero points keyed by an integer linear index. Regardless of the engine,
+    # a cube is exchanged with the outside world (i.e. persisted) as a dictionary (a.k.a. hash table). At
+    # first, a cube has all its elements set to 0. Given that we only query the cube by summing the elements within a
+    # given range and provided that 0 is the neutral element of the sum, there's no use in storing it. Hence, only the
+    # positions with a non-zero value has a (key, value) pair in the dictionary. Example:
     # * 100-dimensional matrix with 5 at position (1, 56, 9):
     #       {'1': {'56': {'9': 5}}}
     # Here's how dimensions are represented:
     #   row: dict; key: int (z-coordinate); value: int (actual element).
     #   matrix: dict; key: int (y-coordinate); value: row.
     #   cube: dict; key: int (x-coordinate); value: matrix.
+    # Cubes are shared between request threads once cached, so every access to the engine holds the cube's lock.
+    # The version of a cube starts at 0 and increases by one with every element updated, and with every box add.
 
-    def __init__(self, dimension, cube=None):
+    def __init__(self, dimension, cube=None, engine=None):
         """
         Creates a new Cube instance of the specified dimension.
         :param dimension: integer between 1 and 100, inclusive.
+        :param cube: Optional dict with the initial elements of the cube.
+        :param engine: Optional name of the storage engine to use (see data.engines.ENGINES).
         :return: New Cube instance.
         """
         assert isinstance(dimension, int), 'dimension must be of type int.'
         assert 1 <= dimension <= 100, 'dimension must fall in the range [0, 100]'
 
-        self.dimension = dimension
-
         if cube:
             assert isinstance(cube, dict), 'cube must be of type dict'
-            self.cube = cube
-        else:
-            self.cube = {}  # This represents a cube with all its elements equal to 0.
+
+        self.dimension = dimension
+        self._engine = get_engine_class(engine or DEFAULT_ENGINE)(dimension, cube)
+        self._lock = RLock()
+        self._uid = next(_uids)
+        self.version = 0
 
     def __str__(self):
         """
@@ -54,6 +86,31 @@ class Cube:
         """
         return 'Cube(dimension=%d,cube=%s)' % (self.dimension, self.cube)
 
+    @property
+    def cube(self):
+        """
+        Builds the dict representation of the cube, with string keys so it can be stored as BSON. Meant to be used at
+        the persistence boundary, as the engines keep their own (cheaper) representation.
+        :return: dict representation of the cube ({'x': {'y': {'z': value}}}).
+        """
+        with self._lock:
+            return self._engine.to_dict()
+
+    @property
+    def engine(self):
+        """
+        :return: Name of the storage engine used by this cube.
+        """
+        return self._engine.name
+
+    @property
+    def memory_size(self):
+        """
+        :return: Rough estimate of the memory taken by the cube's elements, in bytes.
+        """
+        with self._lock:
+            return self._engine.memory_size()
+
     def update(self, x, y, z, value):
         """
         Replaces the element at point (x,y,z) with the input value.
@@ -62,17 +119,22 @@ class Cube:
         :param z: Z coordinate. Must be between 1 and N, where N is the dimension of the cube.
         :param value: Value to be set at the (X,Y,Z) point.
         """
-        self._validate_integers([x, y, z, value], ['X', 'Y', 'Z', 'value'])
-        self._elements_in_range([x, y, z], ['X', 'Y', 'Z'])
+        self.validate_update(x, y, z, value)
 
-        x, y, z = str(x), str(y), str(z)  # Stringify coordinates.
-        matrix = self.cube.get(x, {})  # Extract the matrix if it exists, or create a new one.
-        row = matrix.get(y, {})  # Extract a row if it exists, or create a new one.
+        with self._lock:
+            self._engine.set(int(x), int(y), int(z), int(value))
+            self.version += 1
 
-        # Update the row, matrix and cube.
-        row[z] = value
-        matrix[y] = row
-        self.cube[x] = matrix
+    def validate_update(self, x, y, z, value):
+        """
+        Checks that the input describes a valid update of this cube, without performing it.
+        :param x: X coordinate. Must be between 1 and N, where N is the dimension of the cube.
+        :param y: Y coordinate. Must be between 1 and N, where N is the dimension of the cube.
+        :param z: Z coordinate. Must be between 1 and N, where N is the dimension of the cube.
+        :param value: Value to be set at the (X,Y,Z) point.
+        """
+        self._validate_integers([x, y, z, value], ['X', 'Y', 'Z', 'value'])
+        self._elements_in_range([x, y, z], ['X', 'Y', 'Z'])
 
     def query(self, x_init, x_end, y_init, y_end, z_init, z_end):
         """
@@ -83,72 +145,209 @@ class Cube:
         :param y_end: Final Y coordinate.
         :param z_init: Initial Z coordinate.
         :param z_end: Final Z coordinate.
-        :return: Sum of elements that fall inside the range.
+        :return: Sum of elements that fall inside the range. Results are memoized in query_cache until the cube changes.
         """
-        # Lists used for validation.
-        from_ = [x_init, y_init, z_init]
-        from_names = ['x_init', 'y_init', 'z_init']
-        to_ = [x_end, y_end, z_end]
-        to_names = ['x_end', 'y_end', 'z_end']
+        self.validate_query(x_init, x_end, y_init, y_end, z_init, z_end)
 
-        # Validate input.
-        self._validate_integers(from_ + to_, from_names + to_names)
-        self._elements_in_range(from_ + to_, from_names + to_names)
-        self._validate_range(from_, to_, from_names, to_names)
+        box = (int(x_init), int(x_end), int(y_init), int(y_end), int(z_init), int(z_end))
 
-        return self._sum_cube(x_init, x_end, y_init, y_end, z_init, z_end)
+        with self._lock:
+            key = (self._uid, self.version, box)
+            result = query_cache.get(key)
 
-    # ========================
-    # Private helper functions
-    # ========================
-    def _sum_cube(self, x_init, x_end, y_init, y_end, z_init, z_end):
+            if result is None:
+                if metrics.enabled:
+                    metrics.observe_cells_scanned(self._engine.name, self._engine.cells_scanned(*box))
+
+                result = self._engine.sum(*box)
+                query_cache.put(key, result)
+
+            return result
+
+    def add_range(self, x_init, x_end, y_init, y_end, z_init, z_end, delta):
+        """
+        Adds delta to every element that falls inside the space described by the input parameters. The cost depends
+        on the storage engine: the range engine takes O(log^3 N) no matter the size of the box, while the others
+        update each element of the box.
+        :param x_init: Initial X coordinate.
+        :param x_end: Final X coordinate.
+        :param y_init: Initial Y coordinate.
+        :param y_end: Final Y coordinate.
+        :param z_init: Initial Z coordinate.
+        :param z_end: Final Z coordinate.
+        :param delta: Value to be added to every element.
+        """
+        self.validate_add_range(x_init, x_end, y_init, y_end, z_init, z_end, delta)
+
+        box = (int(x_init), int(x_end), int(y_init), int(y_end), int(z_init), int(z_end))
+
+        with self._lock:
+            self._engine.add_range(*box, int(delta))
+            self.version += 1
+
+    def validate_add_range(self, x_init, x_end, y_init, y_end, z_init, z_end, delta):
+        """
+        Checks that the input describes a valid box add of this cube, without performing it.
+        :param x_init: Initial X coordinate.
+        :param x_end: Final X coordinate.
+        :param y_init: Initial Y coordinate.
+        :param y_end: Final Y coordinate.
+        :param z_init: Initial Z coordinate.
+        :param z_end: Final Z coordinate.
+        :param delta: Value to be added to every element.
+        """
+        self.validate_query(x_init, x_end, y_init, y_end, z_init, z_end)
+        self._validate_integers([delta], ['delta'])
+
+    def box_points(self, x_init, x_end, y_init, y_end, z_init, z_end):
+        """
+        :return: List of (x, y, z, value) tuples with every point that falls inside the space described by the input
+        parameters (which must be valid, see validate_query), zeros included, in X, Y, Z order.
+        """
+        with self._lock:
+            return list(self._engine.box_points(int(x_init), int(x_end), int(y_init), int(y_end), int(z_init),
+                                                int(z_end)))
+
+    def update_many(self, xs, ys, zs, values):
+        """
+        Replaces the elements at points (xs[i], ys[i], zs[i]) with values[i]. Updates are applied in order, so if a
+        point appears more than once the last value wins, as if update had been called for each of them.
+        :param xs: Sequence of X coordinates.
+        :param ys: Sequence of Y coordinates.
+        :param zs: Sequence of Z coordinates.
+        :param values: Sequence of values to be set.
+        """
+        xs, ys, zs, values = list(xs), list(ys), list(zs), list(values)
+        assert len(xs) == len(ys) == len(zs) == len(values), 'xs, ys, zs and values must have the same length'
+
+        for x, y, z, value in zip(xs, ys, zs, values):
+            self.validate_update(x, y, z, value)
+
+        # Get rid of foreign integer types (e.g. numpy.int64) so engines only store Python ints.
+        xs, ys, zs, values = ([int(e) for e in seq] for seq in (xs, ys, zs, values))
+
+        with self._lock:
+            self._engine.set_many(xs, ys, zs, values)
+            self.version += len(values)
+
+    def query_many(self, boxes):
+        """
+        Sums the elements inside each one of the input boxes.
+        :param boxes: Iterable of (x_init, x_end, y_init, y_end, z_init, z_end) tuples, in the same order as the
+        arguments of query.
+        :return: List with the sum of every box, in input order.
+        """
+        boxes = [tuple(box) for box in boxes]
+
+        for box in boxes:
+            assert len(box) == 6, 'Each box must have six coordinates: x_init, x_end, y_init, y_end, z_init, z_end'
+            self.validate_query(*box)
+
+        boxes = [tuple(int(e) for e in box) for box in boxes]
+
+        with self._lock:
+            results = [query_cache.get((self._uid, self.version, box)) for box in boxes]
+            missing = [i for i, result in enumerate(results) if result is None]
+
+            # Only boxes not found in the query cache are summed, all at once.
+            if missing:
+                summations = self._engine.sum_many([boxes[i] for i in missing])
+                for i, summation in zip(missing, summations):
+                    results[i] = summation
+                    query_cache.put((self._uid, self.version, boxes[i]), summation)
+
+            return results
+
+    def export_index(self, build=False):
+        """
+        Exports the index the storage engine keeps to speed up queries (e.g. the table of the prefix engine), so it can
+        be persisted along with the cube.
+        :param build: Whether to build the index first if it isn't built yet (e.g. by a query).
+        :return: bytes with the index, or None if the engine doesn't keep one, it isn't built (and build is False) or
+        the cube is empty.
+        """
+        with self._lock:
+            return self._engine.export_index(build)
+
+    def load_index(self, data):
         """
-         Sums elements that complies with the specified range.
+        Loads an index exported by a cube with the same elements and engine. Ignored by engines without an index.
+        :param data: bytes returned by export_index.
         """
+        with self._lock:
+            self._engine.load_index(bytes(data))
 
-        # =============================================================================================
-        # Inner helper functions. Defined here because their only purpose is to do their parent's work.
-        # =============================================================================================
+    def points(self):
+        """
+        :return: List of (x, y, z, value) tuples with the elements stored, in no particular order.
+        """
+        with self._lock:
+            return list(self._engine.points())
 
-        def sum_matrix(matrix):
-            """
-            Sums all matrix's elements.
-            """
-            matrix_total = 0
-            y = y_init
+    def slab_points(self, x_init, x_end):
+        """
+        :return: List of (x, y, z, value) tuples with the elements stored whose X coordinate falls between x_init and
+        x_end, inclusive, in no particular order. Only those slabs are visited (by most engines).
+        """
+        with self._lock:
+            return list(self._engine.slab_points(int(x_init), int(x_end)))
 
-            while y <= y_end:
-                y_key = str(y)
-                if y_key in matrix:
-                    matrix_total += sum_row(matrix[y_key])
-                y += 1
-            return matrix_total
+    def load_dense(self, values):
+        """
+        Fills an empty cube with the elements of a flat buffer of N^3 values, where point (x,y,z) lives at
+        ((x - 1) * N + y - 1) * N + z - 1. Some engines keep the buffer as their storage, so it must not be modified
+        afterwards.
+        :param values: Sequence of ints (e.g. a memoryview of int64).
+        """
+        assert len(values) == self.dimension ** 3, 'values must have N^3 elements'
 
-        def sum_row(row):
-            """
-            Sums all row's elements.
-            """
-            row_total = 0
-            z = z_init
+        with self._lock:
+            assert self.version == 0, 'Only empty cubes can be loaded'
+            self._engine.load_dense(values)
+            self.version += 1
 
-            while z <= z_end:
-                z_key = str(z)
-                row_total += row.get(z_key, 0)
-                z += 1
+    def load_sparse(self, indexes, values):
+        """
+        Fills an empty cube with the given elements, where point (x,y,z) is given by its linear index
+        ((x - 1) * N + y - 1) * N + z - 1 (see load_dense).
+        :param indexes: Sequence of distinct linear indexes, in ascending order.
+        :param values: Sequence of ints, as long as indexes.
+        """
+        assert len(indexes) == len(values), 'indexes and values must have the same length'
 
-            return row_total
+        if len(indexes):
+            assert 0 <= indexes[0] and indexes[-1] < self.dimension ** 3, 'Linear index out of range'
+            assert all(a < b for a, b in zip(indexes, indexes[1:])), 'indexes must be ascending and distinct'
 
-        cube_total = 0
-        x = x_init  # Iterator var
+        with self._lock:
+            assert self.version == 0, 'Only empty cubes can be loaded'
+            self._engine.load_sparse(indexes, values)
+            self.version += 1
 
-        while x <= x_end:
-            x_key = str(x)
-            if x_key in self.cube:
-                cube_total += sum_matrix(self.cube[x_key])
-            x += 1
+    def validate_query(self, x_init, x_end, y_init, y_end, z_init, z_end):
+        """
+        Checks that the input describes a valid query of this cube, without performing it.
+        :param x_init: Initial X coordinate.
+        :param x_end: Final X coordinate.
+        :param y_init: Initial Y coordinate.
+        :param y_end: Final Y coordinate.
+        :param z_init: Initial Z coordinate.
+        :param z_end: Final Z coordinate.
+        """
+        # Lists used for validation.
+        from_ = [x_init, y_init, z_init]
+        from_names = ['x_init', 'y_init', 'z_init']
+        to_ = [x_end, y_end, z_end]
+        to_names = ['x_end', 'y_end', 'z_end']
 
-        return cube_total
+        # Validate input.
+        self._validate_integers(from_ + to_, from_names + to_names)
+        self._elements_in_range(from_ + to_, from_names + to_names)
+        self._validate_range(from_, to_, from_names, to_names)
 
+    # ========================
+    # Private helper functions
+    # ========================
     def _elements_in_range(self, elements, elements_names):
         """
          Validates elements are within the cube's limits.
@@ -172,5 +371,6 @@ class Cube:
         """
         error_message = '%s must be instance of int'
 
+        # Booleans are integers to Python, but not to clients.
         for var_name, var_value in zip(elements_names, elements):
-            assert isinstance(var_value, int), error_message % var_name
+            assert isinstance(var_value, Integral) and not isinstance(var_value, bool), error_message % var_name
@@ -0,0 +1,1123 @@
+"""
+Defines the storage engines a Cube can delegate its inner representation to.
+
+Every engine exposes the same small surface (get, set, sum and to_dict, plus their batch counterparts set_many and
+sum_many) and deals only with 1-based integer coordinates that have already been validated by the Cube that owns it.
+"""
+
+from array import array
+from itertools import accumulate
+from operator import add
+from sys import byteorder, getsizeof
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional. Only the numpy engine needs it (the prefix engine is just faster with it).
+    numpy = None
+
+
+class StorageEngine:
+    """
+    Base class of every Cube storage engine.
+    """
+
+    __slots__ = ('dimension',)
+
+    name = None
+
+    def __init__(self, dimension, cube=None):
+        """
+        Creates a new engine able to hold a cube of the specified dimension.
+        :param dimension: Dimension of the cube.
+        :param cube: Optional nested dict ({'x': {'y': {'z': value}}}) used to fill the engine.
+        """
+        self.dimension = dimension
+
+    def get(self, x, y, z):
+        """
+        :return: Value stored at point (x,y,z).
+        """
+        raise NotImplementedError
+
+    def set(self, x, y, z, value):
+        """
+        Replaces the element at point (x,y,z) with the input value.
+        """
+        raise NotImplementedError
+
+    def sum(self, x_init, x_end, y_init, y_end, z_init, z_end):
+        """
+        :return: Sum of the elements that fall inside the (inclusive) range.
+        """
+        raise NotImplementedError
+
+    def add_range(self, x_init, x_end, y_init, y_end, z_init, z_end, delta):
+        """
+        Adds delta to every element that falls inside the (inclusive) range.
+        """
+        for x, y, z, value in list(self.box_points(x_init, x_end, y_init, y_end, z_init, z_end)):
+            self.set(x, y, z, value + delta)
+
+    def box_points(self, x_init, x_end, y_init, y_end, z_init, z_end):
+        """
+        :return: Iterable of (x, y, z, value) tuples with every point that falls inside the (inclusive) range, zeros
+        included.
+        """
+        get = self.get
+        return ((x, y, z, get(x, y, z)) for x in range(x_init, x_end + 1) for y in range(y_init, y_end + 1)
+                for z in range(z_init, z_end + 1))
+
+    def cells_scanned(self, x_init, x_end, y_init, y_end, z_init, z_end):
+        """
+        Estimates the work of sum for a box, without performing it.
+        :return: Number of cells (or table entries) sum would visit.
+        """
+        return (x_end - x_init + 1) * (y_end - y_init + 1) * (z_end - z_init + 1)
+
+    def to_dict(self):
+        """
+        :return: Nested dict with string keys ({'x': {'y': {'z': value}}}) that represents the engine's content.
+        """
+        raise NotImplementedError
+
+    def memory_size(self):
+        """
+        :return: Rough estimate of the memory taken by the engine, in bytes.
+        """
+        raise NotImplementedError
+
+    def points(self):
+        """
+        :return: Iterable of (x, y, z, value) tuples with the elements stored.
+        """
+        return ((int(x), int(y), int(z), value)
+                for x, matrix in self.to_dict().items() for y, row in matrix.items() for z, value in row.items())
+
+    def slab_points(self, x_init, x_end):
+        """
+        :return: Iterable of (x, y, z, value) tuples with the elements stored whose X coordinate falls between x_init
+        and x_end, inclusive.
+        """
+        return ((x, y, z, value) for x, y, z, value in self.points() if x_init <= x <= x_end)
+
+    def load_dense(self, values):
+        """
+        Replaces the elements of an empty engine with the ones of a flat buffer of N^3 values, where point (x,y,z) lives
+        at ((x - 1) * N + y - 1) * N + z - 1.
+        :param values: Sequence of ints (e.g. a memoryview of int64), which may be kept by the engine.
+        """
+        n = self.dimension
+        for i, value in enumerate(values):
+            if value:
+                xy, z = divmod(i, n)
+                x, y = divmod(xy, n)
+                self.set(x + 1, y + 1, z + 1, value)
+
+    def load_sparse(self, indexes, values):
+        """
+        Replaces the elements of an empty engine with the given ones, where point (x,y,z) is given by its linear index
+        ((x - 1) * N + y - 1) * N + z - 1 (see load_dense).
+        :param indexes: Sequence of linear indexes, without repetitions.
+        :param values: Sequence of ints, as long as indexes.
+        """
+        n = self.dimension
+        xs, ys, zs = [], [], []
+
+        for index in indexes:
+            xy, z = divmod(index, n)
+            x, y = divmod(xy, n)
+            xs.append(x + 1)
+            ys.append(y + 1)
+            zs.append(z + 1)
+
+        self.set_many(xs, ys, zs, values)
+
+    def export_index(self, build=False):
+        """
+        :param build: Whether to build the index first if it isn't built yet.
+        :return: bytes with the index kept by the engine, or None if the engine doesn't keep one, it isn't built (and
+        build is False) or the cube is empty.
+        """
+        return None
+
+    def load_index(self, data):
+        """
+        Loads an index previously exported by an engine of the same class and content. Engines without an index
+        ignore it.
+        :param data: bytes returned by export_index.
+        """
+
+    def set_many(self, xs, ys, zs, values):
+        """
+        Replaces the elements at points (xs[i], ys[i], zs[i]) with values[i], in order.
+        """
+        for x, y, z, value in zip(xs, ys, zs, values):
+            self.set(x, y, z, value)
+
+    def sum_many(self, boxes):
+        """
+        :param boxes: Iterable of (x_init, x_end, y_init, y_end, z_init, z_end) tuples.
+        :return: List with the sum of every box.
+        """
+        return [self.sum(*box) for box in boxes]
+
+
+class NestedDictEngine(StorageEngine):
+    """
+    Stores the cube as a nested dict with stringified coordinates as keys, which is the same layout persisted in
+    database. Updates are O(1), but queries walk every point of the range.
+    """
+
+    __slots__ = ('cube',)
+
+    name = 'dict'
+
+    def __init__(self, dimension, cube=None):
+        super().__init__(dimension, cube)
+
+        if cube:
+            assert isinstance(cube, dict), 'cube must be of type dict'
+            self.cube = cube
+        else:
+            self.cube = {}  # This represents a cube with all its elements equal to 0.
+
+    def get(self, x, y, z):
+        return self.cube.get(str(x), {}).get(str(y), {}).get(str(z), 0)
+
+    def set(self, x, y, z, value):
+        x, y, z = str(x), str(y), str(z)  # Stringify coordinates.
+        matrix = self.cube.get(x, {})  # Extract the matrix if it exists, or create a new one.
+        row = matrix.get(y, {})  # Extract a row if it exists, or create a new one.
+
+        # Update the row, matrix and cube.
+        row[z] = value
+        matrix[y] = row
+        self.cube[x] = matrix
+
+    def sum(self, x_init, x_end, y_init, y_end, z_init, z_end):
+        # =============================================================================================
+        # Inner helper functions. Defined here because their only purpose is to do their parent's work.
+        # =============================================================================================
+
+        def sum_matrix(matrix):
+            """
+            Sums all matrix's elements.
+            """
+            matrix_total = 0
+            y = y_init
+
+            while y <= y_end:
+                y_key = str(y)
+                if y_key in matrix:
+                    matrix_total += sum_row(matrix[y_key])
+                y += 1
+            return matrix_total
+
+        def sum_row(row):
+            """
+            Sums all row's elements.
+            """
+            row_total = 0
+            z = z_init
+
+            while z <= z_end:
+                z_key = str(z)
+                row_total += row.get(z_key, 0)
+                z += 1
+
+            return row_total
+
+        cube_total = 0
+        x = x_init  # Iterator var
+
+        while x <= x_end:
+            x_key = str(x)
+            if x_key in self.cube:
+                cube_total += sum_matrix(self.cube[x_key])
+            x += 1
+
+        return cube_total
+
+    def to_dict(self):
+        return self.cube
+
+    def slab_points(self, x_init, x_end):
+        for x in range(x_init, x_end + 1):
+            for y, row in self.cube.get(str(x), {}).items():
+                for z, value in row.items():
+                    yield x, int(y), int(z), value
+
+    def memory_size(self):
+        size = getsizeof(self.cube)
+        for matrix in self.cube.values():
+            size += getsizeof(matrix)
+            for row in matrix.values():
+                size += _points_size(row)
+        return size
+
+
+class SparseEngine(StorageEngine):
+    """
+    Stores only the points of the cube that were set, in a dict per slab (i.e. per X coordinate) keyed by an integer
+    linear index. Updates are O(1), and queries visit min(points in the box, points stored) entries of every slab in
+    their X range.
+    """
+
+    # NOTE ABOUT INNER REPRESENTATION:
+    # ------------------------------------
+    # Point (x, y, z) is stored in the dict of slab x under the key y * S + z, with S = N + 1, so (x * S + y) * S + z
+    # is the linear index of the point. Integer keys are cheaper to hash and to build than the stringified ones of
+    # NestedDictEngine, and a single level of dicts per slab saves an allocation per point. Points explicitly set to 0
+    # are kept, like with NestedDictEngine, so they're listed by to_dict.
+    # Example: 100-dimensional cube with 5 at position (1, 56, 9) -> [{}, {5665: 5}, {}, ...]
+
+    __slots__ = ('_stride', '_slabs')
+
+    name = 'sparse'
+
+    def __init__(self, dimension, cube=None):
+        super().__init__(dimension, cube)
+
+        self._stride = dimension + 1
+        self._slabs = [{} for _ in range(self._stride)]
+
+        if cube:
+            assert isinstance(cube, dict), 'cube must be of type dict'
+            for x, matrix in cube.items():
+                for y, row in matrix.items():
+                    for z, value in row.items():
+                        self.set(int(x), int(y), int(z), value)
+
+    def get(self, x, y, z):
+        return self._slabs[x].get(y * self._stride + z, 0)
+
+    def set(self, x, y, z, value):
+        self._slabs[x][y * self._stride + z] = value
+
+    def sum(self, x_init, x_end, y_init, y_end, z_init, z_end):
+        stride = self._stride
+        area = (y_end - y_init + 1) * (z_end - z_init + 1)
+        total = 0
+
+        for slab in self._slabs[x_init:x_end + 1]:
+            # Small rectangle: probe each one of its points.
+            if area <= len(slab):
+                get = slab.get
+                for y in range(y_init, y_end + 1):
+                    base = y * stride
+                    for key in range(base + z_init, base + z_end + 1):
+                        total += get(key, 0)
+
+            # Big rectangle: visit each one of the points stored in the slab.
+            else:
+                for key, value in slab.items():
+                    y, z = divmod(key, stride)
+                    if y_init <= y <= y_end and z_init <= z <= z_end:
+                        total += value
+
+        return total
+
+    def add_range(self, x_init, x_end, y_init, y_end, z_init, z_end, delta):
+        # Keys are walked directly, rather than decoded by box_points and encoded again by set.
+        stride = self._stride
+
+        for slab in self._slabs[x_init:x_end + 1]:
+            get = slab.get
+            for y in range(y_init, y_end + 1):
+                base = y * stride
+                for key in range(base + z_init, base + z_end + 1):
+                    slab[key] = get(key, 0) + delta
+
+    def cells_scanned(self, x_init, x_end, y_init, y_end, z_init, z_end):
+        area = (y_end - y_init + 1) * (z_end - z_init + 1)
+        return sum(min(area, len(slab)) for slab in self._slabs[x_init:x_end + 1])
+
+    def memory_size(self):
+        return getsizeof(self._slabs) + sum(_points_size(slab) for slab in self._slabs)
+
+    def to_dict(self):
+        cube = {}
+        for x, y, z, value in self.points():
+            cube.setdefault(str(x), {}).setdefault(str(y), {})[str(z)] = value
+        return cube
+
+    def load_sparse(self, indexes, values):
+        n, stride, slabs = self.dimension, self._stride, self._slabs
+
+        # Linear indexes of the snapshot are 0-based with stride N; the ones of this engine are 1-based with N + 1.
+        for index, value in zip(indexes, values):
+            xy, z = divmod(index, n)
+            x, y = divmod(xy, n)
+            slabs[x + 1][(y + 1) * stride + z + 1] = value
+
+    def points(self):
+        return self.slab_points(1, self.dimension)
+
+    def slab_points(self, x_init, x_end):
+        stride = self._stride
+        for x in range(x_init, x_end + 1):
+            for key, value in self._slabs[x].items():
+                y, z = divmod(key, stride)
+                yield x, y, z, value
+
+
+class PrefixSumEngine(SparseEngine):
+    """
+    Stores the cube like SparseEngine, plus a table of 3D prefix sums that answers any query with 8 lookups. The table
+    is built on the first query, and either patched (if NumPy is installed) or dropped on every update. Meant for
+    read-mostly cubes.
+    """
+
+    # NOTE ABOUT INNER REPRESENTATION:
+    # ------------------------------------
+    # The table is an array of (N + 1)^3 int64, where the element at (x * S + y) * S + z (S = N + 1, the same linear
+    # index SparseEngine uses) is the sum of the box that goes from (1,1,1) to (x,y,z). Elements with a 0 coordinate
+    # are always 0, so no query needs special cases. Sums must fit in an int64.
+
+    __slots__ = ('_table',)
+
+    name = 'prefix'
+
+    def __init__(self, dimension, cube=None):
+        self._table = None
+        super().__init__(dimension, cube)
+
+    def set(self, x, y, z, value):
+        delta = value - self.get(x, y, z)
+        super().set(x, y, z, value)
+
+        if self._table is None or not delta:
+            return
+
+        if numpy is not None:
+            # Every prefix sum whose box contains (x, y, z) changes by delta.
+            self._table_view()[x:, y:, z:] += delta
+        else:
+            self._table = None  # Patching in pure Python costs as much as building the table again.
+
+    def sum(self, x_init, x_end, y_init, y_end, z_init, z_end):
+        table, stride = self._prefix_sums(), self._stride
+        x0, y0, z0 = x_init - 1, y_init - 1, z_init - 1
+
+        def prefix(x, y, z):
+            return table[(x * stride + y) * stride + z]
+
+        # Inclusion-exclusion over the eight corners of the box.
+        return (prefix(x_end, y_end, z_end)
+                - prefix(x0, y_end, z_end) - prefix(x_end, y0, z_end) - prefix(x_end, y_end, z0)
+                + prefix(x0, y0, z_end) + prefix(x0, y_end, z0) + prefix(x_end, y0, z0)
+                - prefix(x0, y0, z0))
+
+    def add_range(self, x_init, x_end, y_init, y_end, z_init, z_end, delta):
+        # The table is built again on the next query, rather than patched once per element.
+        self._table = None
+        super().add_range(x_init, x_end, y_init, y_end, z_init, z_end, delta)
+
+    def sum_many(self, boxes):
+        return [self.sum(*box) for box in boxes]
+
+    def cells_scanned(self, x_init, x_end, y_init, y_end, z_init, z_end):
+        # Eight lookups, plus building the table if there isn't one.
+        return 8 if self._table is not None else 8 + self._stride ** 3
+
+    def memory_size(self):
+        size = super().memory_size()
+        if self._table is not None:
+            size += self._table.itemsize * len(self._table)
+        return size
+
+    def export_index(self, build=False):
+        # The table of an empty cube is all zeros, and not worth persisting.
+        if not any(self._slabs) or (self._table is None and not build):
+            return None
+
+        table = array('q', self._prefix_sums())
+
+        if byteorder == 'big':
+            table.byteswap()  # Exported tables are always little-endian.
+        return table.tobytes()
+
+    def load_index(self, data):
+        table = array('q')
+        table.frombytes(data)
+        assert len(table) == self._stride ** 3, 'Index does not match the dimension of the cube'
+
+        if byteorder == 'big':
+            table.byteswap()
+        self._table = table
+
+    # ========================
+    # Private helper functions
+    # ========================
+    def _prefix_sums(self):
+        """
+        :return: Table of prefix sums, building it first if needed.
+        """
+        if self._table is None:
+            stride = self._stride
+            table = array('q', bytes(8 * stride ** 3))
+
+            for x, slab in enumerate(self._slabs):
+                base = x * stride * stride
+                for key, value in slab.items():
+                    table[base + key] = value
+
+            _accumulate(table, stride)
+            self._table = table
+
+        return self._table
+
+    def _table_view(self):
+        """
+        :return: NumPy (N + 1) x (N + 1) x (N + 1) view of the table of prefix sums, sharing its memory.
+        """
+        return numpy.frombuffer(self._table, dtype=numpy.int64).reshape((self._stride,) * 3)
+
+
+class FenwickEngine(StorageEngine):
+    """
+    Stores the cube as a 3D binary indexed (Fenwick) tree, so both updates and range sums cost O(log^3 N).
+    """
+
+    # NOTE ABOUT INNER REPRESENTATION:
+    # ------------------------------------
+    # The tree is a flat list of (N + 1)^3 partial sums, where the node (i, j, k) lives at ((i * S) + j) * S + k, with
+    # S = N + 1 (index 0 of every axis is unused, as usual with Fenwick trees). A Fenwick tree only knows how to add
+    # deltas, so the values set so far are also tracked in a dict keyed by (x, y, z) in order to keep the replace
+    # semantics of Cube.update: setting v where u was stored adds v - u to the tree.
+
+    __slots__ = ('_stride', '_tree', '_values')
+
+    name = 'fenwick'
+
+    def __init__(self, dimension, cube=None):
+        super().__init__(dimension, cube)
+
+        self._stride = dimension + 1
+        self._tree = [0] * (self._stride ** 3)
+        self._values = {}
+
+        if cube:
+            assert isinstance(cube, dict), 'cube must be of type dict'
+            for x, matrix in cube.items():
+                for y, row in matrix.items():
+                    for z, value in row.items():
+                        self.set(int(x), int(y), int(z), value)
+
+    def get(self, x, y, z):
+        return self._values.get((x, y, z), 0)
+
+    def set(self, x, y, z, value):
+        delta = value - self._values.get((x, y, z), 0)
+        self._values[(x, y, z)] = value
+
+        if delta:
+            self._add(x, y, z, delta)
+
+    def sum(self, x_init, x_end, y_init, y_end, z_init, z_end):
+        # Inclusion-exclusion over the eight corners of the box.
+        x0, y0, z0 = x_init - 1, y_init - 1, z_init - 1
+        prefix = self._prefix
+
+        return (prefix(x_end, y_end, z_end)
+                - prefix(x0, y_end, z_end) - prefix(x_end, y0, z_end) - prefix(x_end, y_end, z0)
+                + prefix(x0, y0, z_end) + prefix(x0, y_end, z0) + prefix(x_end, y0, z0)
+                - prefix(x0, y0, z0))
+
+    def to_dict(self):
+        cube = {}
+        for (x, y, z), value in self._values.items():
+            cube.setdefault(str(x), {}).setdefault(str(y), {})[str(z)] = value
+        return cube
+
+    def points(self):
+        return ((x, y, z, value) for (x, y, z), value in self._values.items())
+
+    def cells_scanned(self, x_init, x_end, y_init, y_end, z_init, z_end):
+        # Each of the eight prefix sums visits up to log(N) nodes per axis.
+        return 8 * self.dimension.bit_length() ** 3
+
+    def memory_size(self):
+        # Tree nodes are mostly references to small ints that Python shares, so count just the references.
+        return getsizeof(self._tree) + _points_size(self._values)
+
+    # ========================
+    # Private helper functions
+    # ========================
+    def _add(self, x, y, z, delta):
+        """
+        Adds delta to every tree node responsible for point (x,y,z).
+        """
+        tree, stride, n = self._tree, self._stride, self.dimension
+
+        i = x
+        while i <= n:
+            j = y
+            while j <= n:
+                base = (i * stride + j) * stride
+                k = z
+                while k <= n:
+                    tree[base + k] += delta
+                    k += k & -k
+                j += j & -j
+            i += i & -i
+
+    def _prefix(self, x, y, z):
+        """
+        Sums the elements of the box that goes from (1,1,1) to (x,y,z).
+        """
+        if not (x and y and z):
+            return 0
+
+        tree, stride = self._tree, self._stride
+        total = 0
+
+        i = x
+        while i > 0:
+            j = y
+            while j > 0:
+                base = (i * stride + j) * stride
+                k = z
+                while k > 0:
+                    total += tree[base + k]
+                    k -= k & -k
+                j -= j & -j
+            i -= i & -i
+
+        return total
+
+
+class NumpyEngine(StorageEngine):
+    """
+    Stores the cube in NumPy, either as a dict of points (sparse) or as a dense int64 array, and supports vectorized
+    batch updates and queries. The engine starts sparse and switches to dense storage once the fraction of points set
+    goes over DENSE_FILL_RATIO.
+    """
+
+    # NOTE ABOUT INNER REPRESENTATION:
+    # ------------------------------------
+    # Sparse: dict keyed by (x, y, z) like FenwickEngine._values.
+    # Dense: N x N x N int64 array with the values (0-based, so point (x, y, z) lives at [x - 1, y - 1, z - 1]) and a
+    # boolean array of the same shape that tells which points were set, so explicit zeros survive a round trip through
+    # to_dict. Values must fit in an int64.
+    # Batch queries share a (N + 1)^3 prefix sum table that is built on demand and dropped on every write.
+
+    __slots__ = ('_values', '_dense', '_present', '_prefix')
+
+    name = 'numpy'
+
+    # Fraction of the N^3 points that must be set before moving to dense storage. A sparse entry takes over a hundred
+    # bytes, while a dense one takes 9, so dense storage is smaller well before the cube is full.
+    DENSE_FILL_RATIO = 0.05
+
+    def __init__(self, dimension, cube=None):
+        assert numpy is not None, 'numpy engine requires NumPy to be installed'
+        super().__init__(dimension, cube)
+
+        self._values = {}
+        self._dense = None
+        self._present = None
+        self._prefix = None
+
+        if cube:
+            assert isinstance(cube, dict), 'cube must be of type dict'
+            for x, matrix in cube.items():
+                for y, row in matrix.items():
+                    for z, value in row.items():
+                        self._values[(int(x), int(y), int(z))] = value
+            self._maybe_densify()
+
+    @property
+    def is_dense(self):
+        """
+        :return: True if the engine is currently using dense storage.
+        """
+        return self._dense is not None
+
+    def get(self, x, y, z):
+        if self._dense is not None:
+            return int(self._dense[x - 1, y - 1, z - 1])
+        return self._values.get((x, y, z), 0)
+
+    def set(self, x, y, z, value):
+        self._prefix = None
+
+        if self._dense is not None:
+            self._dense[x - 1, y - 1, z - 1] = value
+            self._present[x - 1, y - 1, z - 1] = True
+        else:
+            self._values[(x, y, z)] = value
+            self._maybe_densify()
+
+    def set_many(self, xs, ys, zs, values):
+        if self._dense is None:
+            # Point by point, as the engine may go dense halfway (set takes care of that).
+            super().set_many(xs, ys, zs, values)
+            return
+
+        self._prefix = None
+        xs, ys, zs = (numpy.asarray(c, dtype=numpy.intp) - 1 for c in (xs, ys, zs))
+        values = numpy.asarray(values, dtype=numpy.int64)
+
+        # NumPy doesn't guarantee which write wins when an index is repeated, so keep only the last one of each point.
+        linear = numpy.ravel_multi_index((xs, ys, zs), self._dense.shape)
+        _, last = numpy.unique(linear[::-1], return_index=True)
+        last = len(linear) - 1 - last
+
+        self._dense[xs[last], ys[last], zs[last]] = values[last]
+        self._present[xs[last], ys[last], zs[last]] = True
+
+    def add_range(self, x_init, x_end, y_init, y_end, z_init, z_end, delta):
+        if self._dense is None:
+            # Point by point, as the engine may go dense halfway (set takes care of that).
+            super().add_range(x_init, x_end, y_init, y_end, z_init, z_end, delta)
+            return
+
+        self._prefix = None
+        box = (slice(x_init - 1, x_end), slice(y_init - 1, y_end), slice(z_init - 1, z_end))
+
+        self._dense[box] += delta
+        self._present[box] = True
+
+    def sum(self, x_init, x_end, y_init, y_end, z_init, z_end):
+        if self._dense is not None:
+            return int(self._dense[x_init - 1:x_end, y_init - 1:y_end, z_init - 1:z_end].sum())
+
+        return sum(value for (x, y, z), value in self._values.items()
+                   if x_init <= x <= x_end and y_init <= y <= y_end and z_init <= z <= z_end)
+
+    def cells_scanned(self, x_init, x_end, y_init, y_end, z_init, z_end):
+        if self._dense is not None:
+            return super().cells_scanned(x_init, x_end, y_init, y_end, z_init, z_end)
+        return len(self._values)
+
+    def sum_many(self, boxes):
+        boxes = numpy.asarray(boxes, dtype=numpy.intp).reshape(-1, 6)
+        prefix = self._prefix_sums()
+
+        x1, x2, y1, y2, z1, z2 = boxes.T
+        x1, y1, z1 = x1 - 1, y1 - 1, z1 - 1
+
+        # Inclusion-exclusion over the eight corners of every box at once.
+        totals = (prefix[x2, y2, z2]
+                  - prefix[x1, y2, z2] - prefix[x2, y1, z2] - prefix[x2, y2, z1]
+                  + prefix[x1, y1, z2] + prefix[x1, y2, z1] + prefix[x2, y1, z1]
+                  - prefix[x1, y1, z1])
+
+        return [int(total) for total in totals]
+
+    def to_dict(self):
+        cube = {}
+        for x, y, z, value in self.points():
+            cube.setdefault(str(x), {}).setdefault(str(y), {})[str(z)] = value
+        return cube
+
+    def points(self):
+        if self._dense is not None:
+            xs, ys, zs = numpy.nonzero(self._present)
+            return zip((xs + 1).tolist(), (ys + 1).tolist(), (zs + 1).tolist(), self._dense[xs, ys, zs].tolist())
+
+        return ((x, y, z, value) for (x, y, z), value in self._values.items())
+
+    def slab_points(self, x_init, x_end):
+        if self._dense is not None:
+            xs, ys, zs = numpy.nonzero(self._present[x_init - 1:x_end])
+            xs += x_init - 1
+            return zip((xs + 1).tolist(), (ys + 1).tolist(), (zs + 1).tolist(), self._dense[xs, ys, zs].tolist())
+
+        return super().slab_points(x_init, x_end)
+
+    def load_dense(self, values):
+        # The buffer becomes the dense array as is, unless it's read-only, in which case it's copied.
+        dense = numpy.frombuffer(values, dtype=numpy.int64).reshape((self.dimension,) * 3)
+
+        self._dense = dense if dense.flags.writeable else dense.copy()
+        self._present = self._dense != 0
+        self._values = {}
+        self._prefix = None
+
+    def memory_size(self):
+        size = _points_size(self._values)
+        for array in (self._dense, self._present, self._prefix):
+            if array is not None:
+                size += array.nbytes
+        return size
+
+    # ========================
+    # Private helper functions
+    # ========================
+    def _maybe_densify(self):
+        """
+        Moves to dense storage if enough points have been set.
+        """
+        if len(self._values) <= self.DENSE_FILL_RATIO * self.dimension ** 3:
+            return
+
+        shape = (self.dimension,) * 3
+        self._dense = numpy.zeros(shape, dtype=numpy.int64)
+        self._present = numpy.zeros(shape, dtype=bool)
+
+        if self._values:
+            coordinates = numpy.array(list(self._values.keys()), dtype=numpy.intp) - 1
+            xs, ys, zs = coordinates.T
+            self._dense[xs, ys, zs] = list(self._values.values())
+            self._present[xs, ys, zs] = True
+
+        self._values = {}
+
+    def _prefix_sums(self):
+        """
+        :return: (N + 1)^3 array whose [x, y, z] element is the sum of the box from (1,1,1) to (x,y,z).
+        """
+        if self._prefix is None:
+            n = self.dimension
+            prefix = numpy.zeros((n + 1,) * 3, dtype=numpy.int64)
+
+            if self._dense is not None:
+                prefix[1:, 1:, 1:] = self._dense
+            elif self._values:
+                coordinates = numpy.array(list(self._values.keys()), dtype=numpy.intp)
+                prefix[coordinates[:, 0], coordinates[:, 1], coordinates[:, 2]] = list(self._values.values())
+
+            for axis in range(3):
+                numpy.cumsum(prefix, axis=axis, out=prefix)
+
+            self._prefix = prefix
+
+        return self._prefix
+
+
+class RangeFenwickEngine(StorageEngine):
+    """
+    Stores the cube as 3D binary indexed (Fenwick) trees over its difference array, so both box adds (see add_range)
+    and box sums cost O(log^3 N), no matter how big the box is. Meant for cubes updated mostly by box adds; updates of
+    single elements cost a lookup plus a box add, and listing the elements rebuilds them all, which costs O(N^3).
+    """
+
+    # NOTE ABOUT INNER REPRESENTATION:
+    # ------------------------------------
+    # A box add of v is recorded as +v/-v at the eight corners (x_init or x_end + 1, y_init or y_end + 1, z_init or
+    # z_end + 1) of the difference array d, so the element at (x, y, z) is the sum of d over the box from (1,1,1) to
+    # (x,y,z). Corners beyond N never reach an element, so they're dropped. Expanding the sum of the elements of the
+    # box from (1,1,1) to (x,y,z) gives
+    #   sum of d(i, j, k) * (x + 1 - i) * (y + 1 - j) * (z + 1 - k) over i <= x, j <= y, k <= z
+    # which is a combination of the prefix sums of eight arrays: d, d*i, d*j, d*k, d*i*j, d*i*k, d*j*k and d*i*j*k.
+    # Those eight Fenwick trees share their nodes: a dict keyed by the linear index (i * S + j) * S + k (S = N + 1)
+    # whose values are lists of the eight partial sums. Only the nodes ever touched are stored.
+    # The non-zero entries of d are kept as well, in a dict with the same keys, to rebuild the elements when they're
+    # listed. Elements are rebuilt into a table of (N + 1)^3 int64 (laid out like the one of PrefixSumEngine), which
+    # is kept until the next write, so values must fit in an int64. The keys of the points explicitly set to 0 are
+    # kept in a set, so they're listed as well, like with the other engines.
+
+    __slots__ = ('_stride', '_tree', '_deltas', '_table', '_zeros')
+
+    name = 'range'
+
+    def __init__(self, dimension, cube=None):
+        super().__init__(dimension, cube)
+
+        self._stride = dimension + 1
+        self._tree = {}
+        self._deltas = {}
+        self._table = None
+        self._zeros = set()
+
+        if cube:
+            assert isinstance(cube, dict), 'cube must be of type dict'
+            self._load((int(x), int(y), int(z), value)
+                       for x, matrix in cube.items() for y, row in matrix.items() for z, value in row.items())
+
+    def get(self, x, y, z):
+        if self._table is not None:
+            return self._table[(x * self._stride + y) * self._stride + z]
+
+        # Sum of the difference array over the box from (1,1,1) to (x,y,z), i.e. the prefix sum of the first tree.
+        tree, stride = self._tree, self._stride
+        total = 0
+
+        i = x
+        while i > 0:
+            j = y
+            while j > 0:
+                base = (i * stride + j) * stride
+                k = z
+                while k > 0:
+                    node = tree.get(base + k)
+                    if node is not None:
+                        total += node[0]
+                    k -= k & -k
+                j -= j & -j
+            i -= i & -i
+
+        return total
+
+    def set(self, x, y, z, value):
+        key = (x * self._stride + y) * self._stride + z
+
+        if value:
+            self._zeros.discard(key)
+        else:
+            self._zeros.add(key)
+
+        delta = value - self.get(x, y, z)
+
+        if delta:
+            self.add_range(x, x, y, y, z, z, delta)
+
+    def add_range(self, x_init, x_end, y_init, y_end, z_init, z_end, delta):
+        if not delta:
+            return
+
+        self._table = None
+        n, stride, deltas = self.dimension, self._stride, self._deltas
+
+        for i, x_sign in ((x_init, delta), (x_end + 1, -delta)):
+            for j, y_sign in ((y_init, x_sign), (y_end + 1, -x_sign)):
+                for k, d in ((z_init, y_sign), (z_end + 1, -y_sign)):
+                    if i > n or j > n or k > n:
+                        continue
+
+                    key = (i * stride + j) * stride + k
+                    value = deltas.get(key, 0) + d
+                    if value:
+                        deltas[key] = value
+                    else:
+                        del deltas[key]
+
+                    self._add(i, j, k, d)
+
+    def sum(self, x_init, x_end, y_init, y_end, z_init, z_end):
+        # Inclusion-exclusion over the eight corners of the box.
+        x0, y0, z0 = x_init - 1, y_init - 1, z_init - 1
+        prefix = self._prefix
+
+        return (prefix(x_end, y_end, z_end)
+                - prefix(x0, y_end, z_end) - prefix(x_end, y0, z_end) - prefix(x_end, y_end, z0)
+                + prefix(x0, y0, z_end) + prefix(x0, y_end, z0) + prefix(x_end, y0, z0)
+                - prefix(x0, y0, z0))
+
+    def cells_scanned(self, x_init, x_end, y_init, y_end, z_init, z_end):
+        # Each of the eight prefix sums visits up to log(N) nodes per axis.
+        return 8 * self.dimension.bit_length() ** 3
+
+    def box_points(self, x_init, x_end, y_init, y_end, z_init, z_end):
+        table, stride = self._elements(), self._stride
+        return ((x, y, z, table[(x * stride + y) * stride + z]) for x in range(x_init, x_end + 1)
+                for y in range(y_init, y_end + 1) for z in range(z_init, z_end + 1))
+
+    def points(self):
+        return self.slab_points(1, self.dimension)
+
+    def slab_points(self, x_init, x_end):
+        table, stride, zeros = self._elements(), self._stride, self._zeros
+        plane = stride * stride
+
+        for key in range(x_init * plane, (x_end + 1) * plane):
+            value = table[key]
+            if value or key in zeros:
+                xy, z = divmod(key, stride)
+                x, y = divmod(xy, stride)
+                yield x, y, z, value
+
+    def to_dict(self):
+        cube = {}
+        for x, y, z, value in self.points():
+            cube.setdefault(str(x), {}).setdefault(str(y), {})[str(z)] = value
+        return cube
+
+    def load_dense(self, values):
+        n = self.dimension
+        self._load(((i // (n * n) + 1, i // n % n + 1, i % n + 1, value) for i, value in enumerate(values) if value))
+
+    def load_sparse(self, indexes, values):
+        n = self.dimension
+        self._load(((i // (n * n) + 1, i // n % n + 1, i % n + 1, value) for i, value in zip(indexes, values)))
+
+    def memory_size(self):
+        # Every node is a list of eight ints, most of them not shared.
+        size = getsizeof(self._tree) + 360 * len(self._tree) + _points_size(self._deltas) + getsizeof(self._zeros)
+        if self._table is not None:
+            size += self._table.itemsize * len(self._table)
+        return size
+
+    # ========================
+    # Private helper functions
+    # ========================
+    def _add(self, i, j, k, d):
+        """
+        Adds the contribution of d at (i,j,k) of the difference array to every tree node responsible for it.
+        """
+        tree, stride, n = self._tree, self._stride, self.dimension
+        terms = _range_terms(i, j, k, d)
+
+        x = i
+        while x <= n:
+            y = j
+            while y <= n:
+                base = (x * stride + y) * stride
+                z = k
+                while z <= n:
+                    node = tree.get(base + z)
+                    if node is None:
+                        tree[base + z] = list(terms)
+                    else:
+                        node[:] = map(add, node, terms)
+                    z += z & -z
+                y += y & -y
+            x += x & -x
+
+    def _prefix(self, x, y, z):
+        """
+        Sums the elements of the box that goes from (1,1,1) to (x,y,z).
+        """
+        if not (x and y and z):
+            return 0
+
+        tree, stride = self._tree, self._stride
+        s = [0] * 8
+
+        i = x
+        while i > 0:
+            j = y
+            while j > 0:
+                base = (i * stride + j) * stride
+                k = z
+                while k > 0:
+                    node = tree.get(base + k)
+                    if node is not None:
+                        s = list(map(add, s, node))
+                    k -= k & -k
+                j -= j & -j
+            i -= i & -i
+
+        x, y, z = x + 1, y + 1, z + 1
+        return (x * y * z * s[0] - y * z * s[1] - x * z * s[2] - x * y * s[3]
+                + z * s[4] + y * s[5] + x * s[6] - s[7])
+
+    def _load(self, points):
+        """
+        Fills an empty engine with the given (x, y, z, value) points. The trees are built bottom-up, in time linear in
+        the number of nodes, rather than adding the points one by one.
+        """
+        n, stride = self.dimension, self._stride
+        deltas = {}
+        self._zeros = set()
+
+        # Every point contributes to the eight corners of its own single-point box.
+        for x, y, z, value in points:
+            if not value:
+                self._zeros.add((x * stride + y) * stride + z)
+                continue
+            for i, x_sign in ((x, value), (x + 1, -value)):
+                for j, y_sign in ((y, x_sign), (y + 1, -x_sign)):
+                    for k, d in ((z, y_sign), (z + 1, -y_sign)):
+                        if i <= n and j <= n and k <= n:
+                            key = (i * stride + j) * stride + k
+                            deltas[key] = deltas.get(key, 0) + d
+
+        self._deltas = {key: d for key, d in deltas.items() if d}
+        self._table = None
+        tree = self._tree = {}
+
+        for key, d in self._deltas.items():
+            ij, k = divmod(key, stride)
+            i, j = divmod(ij, stride)
+            tree[key] = _range_terms(i, j, k, d)
+
+        # Push every node into its parent along X, then along Y and finally along Z. Nodes are visited by ascending
+        # coordinate of the axis, and parents come after their children, so every node is complete when it's pushed.
+        for weight in (stride * stride, stride, 1):
+            by_coordinate = {}
+            for key in tree:
+                by_coordinate.setdefault(key // weight % stride, []).append(key)
+
+            for c in range(1, n + 1):
+                parent = c + (c & -c)
+                if parent > n:
+                    continue
+
+                for key in by_coordinate.get(c, ()):
+                    node, parent_key = tree[key], key + (parent - c) * weight
+                    parent_node = tree.get(parent_key)
+
+                    if parent_node is None:
+                        tree[parent_key] = list(node)
+                        by_coordinate.setdefault(parent, []).append(parent_key)
+                    else:
+                        for t in range(8):
+                            parent_node[t] += node[t]
+
+    def _elements(self):
+        """
+        :return: Table with every element, rebuilding it first if needed.
+        """
+        if self._table is None:
+            table = array('q', bytes(8 * self._stride ** 3))
+
+            for key, d in self._deltas.items():
+                table[key] = d
+
+            _accumulate(table, self._stride)
+            self._table = table
+
+        return self._table
+
+
+# Engines available to a Cube, by name.
+ENGINES = {engine.name: engine for engine in (SparseEngine, NestedDictEngine, PrefixSumEngine, FenwickEngine,
+                                              NumpyEngine, RangeFenwickEngine)}
+DEFAULT_ENGINE = SparseEngine.name
+
+
+def _accumulate(table, stride):
+    """
+    Turns a flat table of stride^3 int64 values into its 3D prefix sums, in place: the element at (x * S + y) * S + z
+    (S = stride) ends up being the sum of the box that goes from (0,0,0) to (x,y,z).
+    :param table: array('q') of stride^3 elements.
+    :param stride: Length of every axis.
+    """
+    if numpy is not None:
+        view = numpy.frombuffer(table, dtype=numpy.int64).reshape((stride,) * 3)
+        for axis in range(3):
+            numpy.cumsum(view, axis=axis, out=view)
+        return
+
+    # Accumulate along Z (every row), then along Y (every matrix) and finally along X.
+    for start in range(0, len(table), stride):
+        table[start:start + stride] = array('q', accumulate(table[start:start + stride]))
+
+    for x in range(stride):
+        for y in range(1, stride):
+            start = (x * stride + y) * stride
+            table[start:start + stride] = array('q', map(add, table[start:start + stride],
+                                                         table[start - stride:start]))
+
+    plane = stride * stride
+    for start in range(plane, len(table), plane):
+        table[start:start + plane] = array('q', map(add, table[start:start + plane], table[start - plane:start]))
+
+
+def _range_terms(i, j, k, d):
+    """
+    :return: List with the contributions of d at (i,j,k) of the difference array to each one of the eight trees of
+    RangeFenwickEngine.
+    """
+    return [d, d * i, d * j, d * k, d * i * j, d * i * k, d * j * k, d * i * j * k]
+
+
+def _points_size(points):
+    """
+    Estimates the memory taken by a dict of points, counting its keys and values as well.
+    """
+    # Every point needs a key and an int object, of roughly 32 bytes each.
+    return getsizeof(points) + 64 * len(points)
+
+
+def get_engine_class(name):
+    """
+    Retrieves a storage engine class by its name.
+    :param name: Name of the engine (see ENGINES).
+    :return: StorageEngine subclass.
+    """
+    assert name in ENGINES, 'Unknown engine %s. Must be one of: %s' % (name, ', '.join(sorted(ENGINES)))
+    return ENGINES[name]
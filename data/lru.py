@@ -0,0 +1,156 @@
+"""
+Defines a thread safe, bounded, least recently used (LRU) cache.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache:
+    """
+    Dict-like cache that evicts the least recently used entries once it holds more than max_entries entries or, if a
+    sizeof function is given, more than max_bytes bytes. Keeps track of hits, misses and evictions.
+    """
+
+    def __init__(self, max_entries=128, max_bytes=None, sizeof=None):
+        """
+        Creates a new, empty, cache.
+        :param max_entries: Maximum number of entries to keep. None means no limit, and 0 disables the cache.
+        :param max_bytes: Maximum number of bytes to keep, as reported by sizeof. None means no limit.
+        :param sizeof: Function that estimates the size in bytes of a value. Required if max_bytes is given.
+        :return: New LRUCache instance.
+        """
+        assert max_bytes is None or sizeof is not None, 'sizeof must be provided along with max_bytes'
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self._lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """
+        Retrieves a value, marking it as the most recently used.
+        :param key: Key of the value.
+        :param default: Value returned if the key isn't cached.
+        :return: Cached value or default.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def peek(self, key, default=None):
+        """
+        Retrieves a value without marking it as used nor counting the lookup.
+        :param key: Key of the value.
+        :param default: Value returned if the key isn't cached.
+        :return: Cached value or default.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry else default
+
+    def put(self, key, value):
+        """
+        Caches a value as the most recently used one, evicting others if needed.
+        :param key: Key of the value.
+        :param value: Value to be cached.
+        """
+        if self.max_entries == 0:
+            return
+
+        size = self._sizeof(value) if self._sizeof else 0
+
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+
+            self._entries[key] = (value, size)
+            self._bytes += size
+            self._evict()
+
+    def resize(self, key):
+        """
+        Measures again the size of a cached value, after it has changed in place.
+        :param key: Key of the value.
+        """
+        if not self._sizeof:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                value, size = self._entries[key]
+                new_size = self._sizeof(value)
+                self._entries[key] = (value, new_size)
+                self._bytes += new_size - size
+                self._evict()
+
+    def pop(self, key, default=None):
+        """
+        Removes a value from the cache.
+        :param key: Key of the value.
+        :param default: Value returned if the key isn't cached.
+        :return: Removed value or default.
+        """
+        with self._lock:
+            if key not in self._entries:
+                return default
+
+            value, size = self._entries.pop(key)
+            self._bytes -= size
+            return value
+
+    def clear(self):
+        """
+        Removes every value from the cache. Counters are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        :return: dict with the counters and current size of the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._bytes
+            }
+
+    # ========================
+    # Private helper functions
+    # ========================
+    def _evict(self):
+        """
+        Evicts least recently used entries until the cache is within its limits. The most recently used entry is
+        always kept. Must be called with the lock held.
+        """
+        while len(self._entries) > 1 and \
+                ((self.max_entries is not None and len(self._entries) > self.max_entries) or
+                 (self.max_bytes is not None and self._bytes > self.max_bytes)):
+            _, (_, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
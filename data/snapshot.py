@@ -0,0 +1,160 @@
+"""
+Compact binary snapshots of cubes, to move and back them up cheaply. A snapshot is a 16 bytes header followed by the
+elements, every number in little-endian:
+
+    magic       4 bytes     b'CUBE'
+    version     uint8       Format version (1).
+    layout      uint8       0: dense, 1: sparse.
+    dimension   uint16      Dimension N of the cube.
+    count       uint64      Number of elements that follow.
+
+    dense:      N^3 int64 values, where point (x,y,z) lives at ((x - 1) * N + y - 1) * N + z - 1.
+    sparse:     count int64 linear indexes (same as above, ascending), then count int64 values.
+
+The smaller layout is picked when dumping. Loading reads the elements straight from the input buffer, without parsing
+or copying them first, and files are memory-mapped. Elements must fit in an int64.
+"""
+
+import mmap
+import struct
+from array import array
+from sys import byteorder
+from data.cube import Cube
+
+_MAGIC = b'CUBE'
+_VERSION = 1
+_DENSE, _SPARSE = 0, 1
+_HEADER = struct.Struct('<4sBBHQ')
+_INT64_SIZE = 8
+
+# Content type of snapshots.
+MIME_TYPE = 'application/vnd.cube-snapshot'
+
+
+# Size of the header, i.e. the bytes needed by dimension.
+HEADER_SIZE = _HEADER.size
+
+
+def dumps(cube):
+    """
+    Builds the snapshot of a cube.
+    :param cube: Cube to be dumped.
+    :return: bytes with the snapshot.
+    """
+    n = cube.dimension
+    points = cube.points()
+
+    # Dense takes 8 bytes per point of the cube, sparse 16 bytes per element stored.
+    if 2 * len(points) >= n ** 3:
+        values = array('q', bytes(_INT64_SIZE * n ** 3))
+        for x, y, z, value in points:
+            values[((x - 1) * n + y - 1) * n + z - 1] = value
+
+        return _HEADER.pack(_MAGIC, _VERSION, _DENSE, n, len(values)) + _to_little_endian(values)
+
+    points = sorted((((x - 1) * n + y - 1) * n + z - 1, value) for x, y, z, value in points if value)
+    indexes = array('q', (index for index, _ in points))
+    values = array('q', (value for _, value in points))
+
+    return _HEADER.pack(_MAGIC, _VERSION, _SPARSE, n, len(values)) + _to_little_endian(indexes) + \
+        _to_little_endian(values)
+
+
+def dump(cube, path):
+    """
+    Writes the snapshot of a cube to a file.
+    :param cube: Cube to be dumped.
+    :param path: Path of the file.
+    """
+    with open(path, 'wb') as f:
+        f.write(dumps(cube))
+
+
+def loads(data, engine=None):
+    """
+    Builds a cube out of a snapshot.
+    :param data: bytes-like object with the snapshot (e.g. bytes or mmap).
+    :param engine: Optional name of the storage engine of the cube (see data.engines.ENGINES).
+    :return: New Cube instance.
+    """
+    view = memoryview(data)
+
+    if len(view) < _HEADER.size:
+        raise ValueError('Invalid snapshot: too short')
+
+    magic, version, layout, n, count = _HEADER.unpack_from(view)
+
+    if magic != _MAGIC or version != _VERSION or layout not in (_DENSE, _SPARSE):
+        raise ValueError('Invalid snapshot: unknown format')
+
+    expected = count * _INT64_SIZE * (1 if layout == _DENSE else 2)
+    if len(view) != _HEADER.size + expected or (layout == _DENSE and count != n ** 3):
+        raise ValueError('Invalid snapshot: wrong size')
+
+    cube = Cube(n, engine=engine)
+    body = view[_HEADER.size:]
+
+    if layout == _DENSE:
+        cube.load_dense(_int64s(body))
+    else:
+        cube.load_sparse(_int64s(body[:count * _INT64_SIZE]), _int64s(body[count * _INT64_SIZE:]))
+
+    return cube
+
+
+def load(path, engine=None):
+    """
+    Builds a cube out of a snapshot file, which is memory-mapped rather than read.
+    :param path: Path of the file.
+    :param engine: Optional name of the storage engine of the cube (see data.engines.ENGINES).
+    :return: New Cube instance.
+    """
+    with open(path, 'rb') as f:
+        # Copy-on-write mapping, so engines that keep the buffer (e.g. numpy) can modify it without touching the file.
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    return loads(data, engine=engine)
+
+
+def dimension(data):
+    """
+    Reads the dimension of the cube of a snapshot, without loading it.
+    :param data: bytes-like object with (at least) the first bytes of the snapshot.
+    :return: Dimension of the cube.
+    """
+    if len(data) < _HEADER.size:
+        raise ValueError('Invalid snapshot: too short')
+
+    magic, version, _, n, _ = _HEADER.unpack_from(data)
+
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError('Invalid snapshot: unknown format')
+
+    return n
+
+
+# ===============================
+# Private helper functions.
+# ===============================
+def _to_little_endian(values):
+    """
+    :return: bytes of an array of int64 values, in little-endian.
+    """
+    if byteorder == 'big':
+        values = array('q', values)
+        values.byteswap()
+
+    return values.tobytes()
+
+
+def _int64s(view):
+    """
+    Reads little-endian int64 values from a memoryview. Values are not copied unless the machine is big-endian.
+    :return: Sequence of int64 values.
+    """
+    if byteorder == 'big':
+        values = array('q', view.tobytes())
+        values.byteswap()
+        return values
+
+    return view.cast('q')
@@ -2,8 +2,12 @@
 pip install pymongo
 pip install flask
 pip install nose
+pip install numpy
+pip install aiohttp
 
 # Uncomment these lines if you have both Python 2 and Python 3 in your machine
 #pip3 install pymongo
 #pip3 install flask
-#pip3 install nose
\ No newline at end of file
+#pip3 install nose
+#pip3 install numpy
+#pip3 install aiohttp
\ No newline at end of file
@@ -0,0 +1,383 @@
+"""
+Performance instrumentation: counters, histograms and gauges rendered in the Prometheus text format (served at
+GET /metrics), plus an optional sampling profiler.
+
+Time spent by a request is split in phases (see timer): fetch (reading from the storage backend), hydrate (building
+Cube instances out of what was read), compute (updates and sums) and serialize (building the response). Phases are
+labeled with the route of the request being served, which the servers set with set_route.
+"""
+
+import sys
+import time
+from bisect import bisect_left
+from collections import Counter as _Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock, Thread, get_ident
+
+# Upper bounds of the buckets of latency histograms, in seconds.
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Upper bounds of the buckets of the histogram of cells scanned per query.
+CELLS_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+# Metrics are only recorded while enabled (e.g. command line tools disable them).
+enabled = True
+
+# Route of the request being served by the current thread or task.
+_route = ContextVar('route', default='')
+
+
+class Counter:
+    """
+    Monotonically increasing value, by labels.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, description, label_names=()):
+        """
+        Creates a new counter.
+        :param name: Name of the metric.
+        :param description: Help text of the metric.
+        :param label_names: Names of the labels, in order.
+        :return: New Counter instance.
+        """
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = Lock()
+
+    def inc(self, labels=(), amount=1):
+        """
+        Increases the counter.
+        :param labels: Tuple with the values of the labels, in the same order as label_names.
+        :param amount: Amount to be added.
+        """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        """
+        :return: Current value of the counter for the given labels.
+        """
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        """
+        :return: List of (suffix, labels dict, value) tuples with the current values.
+        """
+        with self._lock:
+            return [('', dict(zip(self.label_names, labels)), value) for labels, value in sorted(self._values.items())]
+
+
+class Histogram:
+    """
+    Distribution of observed values, by labels, counted in buckets.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, label_names=(), buckets=LATENCY_BUCKETS):
+        """
+        Creates a new histogram.
+        :param name: Name of the metric.
+        :param description: Help text of the metric.
+        :param label_names: Names of the labels, in order.
+        :param buckets: Ascending upper bounds of the buckets. A +Inf bucket is always added.
+        :return: New Histogram instance.
+        """
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = Lock()
+
+    def observe(self, value, labels=()):
+        """
+        Records a value.
+        :param value: Value observed.
+        :param labels: Tuple with the values of the labels, in the same order as label_names.
+        """
+        with self._lock:
+            counts = self._values.get(labels)
+
+            if counts is None:
+                # One count per bucket, plus +Inf, plus the sum of the values.
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0]
+
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def count(self, labels=()):
+        """
+        :return: Number of values observed for the given labels.
+        """
+        counts = self._values.get(labels)
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        """
+        :return: List of (suffix, labels dict, value) tuples with the cumulative buckets, sum and count.
+        """
+        samples = []
+
+        with self._lock:
+            for labels, counts in sorted(self._values.items()):
+                labels = dict(zip(self.label_names, labels))
+                cumulative = 0
+
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    samples.append(('_bucket', dict(labels, le=_format_value(bound)), cumulative))
+
+                samples.append(('_sum', labels, counts[-1]))
+                samples.append(('_count', labels, cumulative))
+
+        return samples
+
+
+class Gauge:
+    """
+    Value read when metrics are rendered, by labels.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, description, read, label_names=()):
+        """
+        Creates a new gauge.
+        :param name: Name of the metric.
+        :param description: Help text of the metric.
+        :param read: Function that returns a dict whose keys are tuples with the values of the labels and its values
+        the current values.
+        :param label_names: Names of the labels, in order.
+        :return: New Gauge instance.
+        """
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._read = read
+
+    def samples(self):
+        """
+        :return: List of (suffix, labels dict, value) tuples with the current values.
+        """
+        return [('', dict(zip(self.label_names, labels)), value) for labels, value in sorted(self._read().items())]
+
+
+class Registry:
+    """
+    Set of metrics rendered together.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        """
+        Adds a metric, or returns the one already registered with the same name.
+        :param metric: Counter, Histogram or Gauge.
+        :return: Metric registered.
+        """
+        return self._metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        """
+        :return: Every metric, in the Prometheus text exposition format.
+        """
+        lines = []
+
+        for name, metric in sorted(self._metrics.items()):
+            lines.append('# HELP %s %s' % (name, metric.description))
+            lines.append('# TYPE %s %s' % (name, metric.kind))
+
+            for suffix, labels, value in metric.samples():
+                lines.append('%s%s%s %s' % (name, suffix, _format_labels(labels), _format_value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+
+# Default registry, and the metrics every part of the application records.
+registry = Registry()
+
+requests = registry.register(Histogram('cubes_request_seconds', 'Time spent serving requests.',
+                                       ['route', 'method', 'status']))
+request_errors = registry.register(Counter('cubes_request_errors_total', 'Requests that failed unexpectedly.',
+                                           ['route']))
+phases = registry.register(Histogram('cubes_phase_seconds', 'Time spent in each phase of a request.',
+                                     ['route', 'phase']))
+cells_scanned = registry.register(Histogram('cubes_query_cells_scanned', 'Cells of a cube visited to sum a box.',
+                                            ['engine'], buckets=CELLS_BUCKETS))
+
+# Content type of the Prometheus text exposition format.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def set_route(route):
+    """
+    Sets the route of the request being served by the current thread or task, which labels the phases timed.
+    :param route: Route, e.g. /cubes/<cube_id>.
+    """
+    _route.set(route)
+
+
+@contextmanager
+def timer(phase):
+    """
+    Times a phase of the current request, e.g. "with timer('fetch'): ...".
+    :param phase: Name of the phase.
+    """
+    if not enabled:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases.observe(time.perf_counter() - start, (_route.get(), phase))
+
+
+def observe_request(route, method, status, seconds):
+    """
+    Records a request served.
+    :param route: Route of the request, e.g. /cubes/<cube_id>.
+    :param method: HTTP method.
+    :param status: Status code of the response.
+    :param seconds: Time taken to serve it.
+    """
+    if enabled:
+        requests.observe(seconds, (route, method, str(status)))
+
+
+def observe_cells_scanned(engine, cells):
+    """
+    Records the number of cells visited by a sum.
+    :param engine: Name of the storage engine of the cube.
+    :param cells: Number of cells visited.
+    """
+    if enabled:
+        cells_scanned.observe(cells, (engine,))
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler: a background thread takes a snapshot of the stack of every other thread at a fixed interval,
+    and counts how many times each stack was seen. The overhead doesn't depend on the code being profiled, so it can
+    run in production. Stacks are reported in the folded format used by flame graph tools.
+    """
+
+    def __init__(self, interval=0.01, max_depth=64):
+        """
+        Creates a new profiler. It doesn't sample until started.
+        :param interval: Seconds between samples.
+        :param max_depth: Maximum number of frames per stack.
+        :return: New SamplingProfiler instance.
+        """
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = 0
+        self._stacks = _Counter()
+        self._lock = Lock()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """
+        Starts sampling, unless already started.
+        """
+        if self._running:
+            return
+
+        self._running = True
+        self._thread = Thread(target=self._sample_periodically, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops sampling. Stacks seen so far are kept.
+        """
+        self._running = False
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def reset(self):
+        """
+        Forgets the stacks seen so far.
+        """
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+
+    def folded(self, limit=None):
+        """
+        :param limit: Maximum number of stacks to report, most seen first. None means every stack.
+        :return: Text with one line per stack: frames from the outermost, separated by ';', and the times it was seen.
+        """
+        with self._lock:
+            stacks = self._stacks.most_common(limit)
+
+        return ''.join('%s %d\n' % (stack, count) for stack, count in stacks)
+
+    # ========================
+    # Private helper functions
+    # ========================
+    def _sample_periodically(self):
+        """
+        Body of the sampling thread.
+        """
+        own = get_ident()
+
+        while self._running:
+            frames = sys._current_frames()
+
+            with self._lock:
+                for thread_id, frame in frames.items():
+                    if thread_id != own:
+                        self._stacks[self._fold(frame)] += 1
+                self.samples += 1
+
+            time.sleep(self.interval)
+
+    def _fold(self, frame):
+        """
+        :return: Stack of a frame, in folded format.
+        """
+        names = []
+
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append('%s (%s:%d)' % (code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+
+        return ';'.join(reversed(names))
+
+
+# ===============================
+# Private helper functions.
+# ===============================
+def _format_labels(labels):
+    """
+    :return: Labels in the Prometheus format, e.g. {route="/cubes",method="GET"}.
+    """
+    if not labels:
+        return ''
+
+    escaped = ('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in labels.items())
+    return '{%s}' % ','.join(escaped)
+
+
+def _format_value(value):
+    """
+    :return: Number in the Prometheus format.
+    """
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -0,0 +1,27 @@
+"""
+Moves the cubes stored in MongoDB with one document per cube (the mongo backend) to one document per slab (the
+mongo_slabs backend). It can run while the servers are up, once they use the mongo_slabs backend, and it can be
+interrupted and run again at any time. Usage:
+
+    python migrate.py
+"""
+
+import argparse
+from config.config import persistence_conf
+from persistence.backends import MongoSlabBackend
+
+
+def main(argv=None):
+    """
+    Command line entry point.
+    :param argv: Command line arguments. Defaults to sys.argv.
+    """
+    parser = argparse.ArgumentParser(description='Moves cubes stored in MongoDB to one document per slab.')
+    parser.parse_args(argv)
+
+    backend = MongoSlabBackend(persistence_conf)
+    print('%d cubes migrated to %s' % (backend.migrate(), backend.slabs.name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1466 @@
+"""
+Defines the storage backends where cube documents are persisted.
+
+Every backend exposes the same surface (store, get, get_all, update, delete and delete_all, plus update_elements,
+add_range, store_index, get_metadata and get_slabs) and deals with cube documents: dicts with the '_id' (string),
+'dimension', 'version' (int), 'cube' (nested dict with string keys, see data.cube.Cube) and, optionally, 'index' (bytes)
+fields. The version of a cube starts at 1 and is increased by every write, atomically with the write itself; cubes
+stored before versions existed are read as version 0. Element updates may be conditional on the version, checked by the
+backend when it writes. Validation and caching are up to persistence.cube, which is the module meant to be used by the
+rest of the application.
+"""
+
+import logging
+import os
+import shutil
+import sqlite3
+import struct
+import time
+from itertools import islice, product
+from threading import Lock, Thread
+from bson import ObjectId
+from bson.errors import InvalidId
+from data import snapshot
+from data.cube import Cube
+
+# Number of cubes whose slabs are fetched at once when listing cubes of the mongo_slabs backend.
+_PAGE_SIZE = 100
+
+# Largest box whose elements are increased with a single $inc of a cube document. The update has a field per element,
+# so it would be larger than the cube itself (and than the 16 MB limit of MongoDB) for the largest boxes.
+_MAX_INCREMENTS = 100000
+
+# Record of the operation log of the log backend: x, y, z (uint16) and value (int64), little-endian. Records with x = 0
+# aren't elements: with y = _VERSION_RECORD they increase the version of the cube by their value, and with
+# y = _RANGE_RECORD they add their value to every element of the box whose corners are the x, y and z of the next two
+# records.
+_LOG_RECORD = struct.Struct('<HHHq')
+_VERSION_RECORD = 0
+_RANGE_RECORD = 1
+
+
+class VersionMismatch(Exception):
+    """
+    Raised by conditional writes when the cube isn't at any of the expected versions.
+    """
+
+    def __init__(self, c_id, version):
+        super().__init__('Cube %s is at version %d' % (c_id, version))
+        self.version = version
+
+
+class StorageBackend:
+    """
+    Base class of every storage backend.
+    """
+
+    name = None
+
+    def __init__(self, conf):
+        """
+        Creates a new backend.
+        :param conf: Persistence configuration (see config/persistence.json).
+        :return: New StorageBackend instance.
+        """
+        pass
+
+    def store(self, document):
+        """
+        Stores a new cube document, at version 1.
+        :param document: dict with the 'dimension', 'cube' and, optionally, 'index' fields.
+        :return: Identifier of the cube just stored.
+        """
+        raise NotImplementedError
+
+    def get(self, c_id):
+        """
+        :return: Cube document if found or None otherwise.
+        """
+        raise NotImplementedError
+
+    def get_all(self, limit=None, after=None, ids_only=False):
+        """
+        Iterates over the cube documents in id order, without their index.
+        :param limit: Maximum number of cubes to retrieve. None means no limit.
+        :param after: Identifier of a cube. If given, only cubes after it are retrieved.
+        :param ids_only: If True, documents only have the '_id', 'dimension' and 'version' fields.
+        :return: Iterator of cube documents.
+        """
+        raise NotImplementedError
+
+    def get_metadata(self, c_id):
+        """
+        :return: Cube document without its 'cube' and 'index' fields (i.e. with its '_id', 'dimension' and 'version')
+        if found or None otherwise.
+        """
+        raise NotImplementedError
+
+    def get_slabs(self, c_id, x_init, x_end):
+        """
+        :return: Cube document with only the elements whose X coordinate falls between x_init and x_end (and no index)
+        if found or None otherwise.
+        """
+        raise NotImplementedError
+
+    def update(self, c_id, document, versions=1):
+        """
+        Replaces the content of a cube.
+        :param c_id: Identifier of the cube to be updated.
+        :param document: dict with the 'dimension', 'cube' and, optionally, 'index' fields. If there's no 'index', the
+        stored one (if any) is removed.
+        :param versions: Amount the version of the cube is increased by.
+        :return: True if the cube was updated; False otherwise.
+        """
+        raise NotImplementedError
+
+    def update_elements(self, c_id, values, versions=1, expected_versions=None):
+        """
+        Replaces some elements of a cube, in a single atomic operation, and removes its stored index (if any).
+        :param c_id: Identifier of the cube to be updated.
+        :param values: dict whose keys are (x, y, z) tuples and its values the elements to be set.
+        :param versions: Amount the version of the cube is increased by (e.g. the number of buffered updates written
+        at once).
+        :param expected_versions: Collection of versions the cube must be at to be updated, checked along with the
+        write. None means any version.
+        :return: True if the cube exists and was updated; False otherwise.
+        :raise VersionMismatch: If the cube isn't at any of the expected versions.
+        """
+        raise NotImplementedError
+
+    def add_range(self, c_id, x_init, x_end, y_init, y_end, z_init, z_end, delta):
+        """
+        Adds delta to every element of a box of a cube (elements not set included), increases its version by one and
+        removes its stored index (if any).
+        :param c_id: Identifier of the cube to be updated.
+        :param x_init: Initial X coordinate.
+        :param x_end: Final X coordinate.
+        :param y_init: Initial Y coordinate.
+        :param y_end: Final Y coordinate.
+        :param z_init: Initial Z coordinate.
+        :param z_end: Final Z coordinate.
+        :param delta: Value to be added to every element.
+        :return: True if the cube exists and was updated; False otherwise.
+        """
+        raise NotImplementedError
+
+    def store_index(self, c_id, index, version):
+        """
+        Stores the index of a cube, unless the cube changed since the version the index was built from. Its version
+        isn't increased.
+        :param c_id: Identifier of the cube.
+        :param index: bytes with the index (see data.cube.Cube.export_index).
+        :param version: Version of the cube the index was built from.
+        :return: True if the index was stored; False otherwise.
+        """
+        raise NotImplementedError
+
+    def delete(self, c_id):
+        """
+        :return: True if the cube was deleted; False otherwise.
+        """
+        raise NotImplementedError
+
+    def delete_all(self):
+        """
+        :return: Number of cubes deleted.
+        """
+        raise NotImplementedError
+
+    # ========================
+    # Private helper functions
+    # ========================
+    def _mismatch(self, c_id):
+        """
+        Tells a missing cube from one at an unexpected version, after a conditional write didn't match the cube.
+        :return: False if the cube doesn't exist.
+        :raise VersionMismatch: If the cube exists.
+        """
+        metadata = self.get_metadata(c_id)
+
+        if metadata is None:
+            return False
+
+        raise VersionMismatch(c_id, metadata['version'])
+
+
+class MongoBackend(StorageBackend):
+    """
+    Stores each cube as a single MongoDB document.
+    """
+
+    name = 'mongo'
+
+    @property
+    def collection(self):
+        """
+        Collection of the cubes, from the MongoDB client of the current process (see config.config.get_client).
+        """
+        from config.config import get_collection
+
+        return get_collection()
+
+    def store(self, document):
+        result = self.collection.insert_one(dict(document, version=1))
+        return str(result.inserted_id)
+
+    def get(self, c_id):
+        cube = self.collection.find_one({'_id': _object_id(c_id)})
+        return _stringify_id(cube) if cube else None
+
+    def get_all(self, limit=None, after=None, ids_only=False):
+        query = {'_id': {'$gt': _object_id(after)}} if after else {}
+        projection = {'dimension': True, 'version': True} if ids_only else {'index': False}
+        cubes = self.collection.find(query, projection).sort('_id', 1)
+
+        if limit:
+            cubes = cubes.limit(limit)
+
+        return (_stringify_id(cube) for cube in cubes)
+
+    def get_metadata(self, c_id):
+        cube = self.collection.find_one({'_id': _object_id(c_id)}, {'cube': False, 'index': False})
+        return _stringify_id(cube) if cube else None
+
+    def get_slabs(self, c_id, x_init, x_end):
+        projection = {'cube.%d' % x: True for x in range(x_init, x_end + 1)}
+        projection.update(dimension=True, version=True)
+
+        cube = self.collection.find_one({'_id': _object_id(c_id)}, projection)
+
+        if cube:
+            cube.setdefault('cube', {})  # Not there if there are no elements in the slabs.
+            return _stringify_id(cube)
+
+        return None
+
+    def update(self, c_id, document, versions=1):
+        query = {'_id': _object_id(c_id)}
+        updates = {'$set': {'dimension': document['dimension'], 'cube': document['cube']},
+                   '$inc': {'version': versions}}
+
+        if document.get('index') is not None:
+            updates['$set']['index'] = document['index']
+        else:
+            updates['$unset'] = {'index': True}
+
+        result = self.collection.update_one(query, updates)
+        return result.modified_count == 1
+
+    def update_elements(self, c_id, values, versions=1, expected_versions=None):
+        query = dict(_version_query(expected_versions), _id=_object_id(c_id))
+        updates = {'$set': {'cube.%d.%d.%d' % point: value for point, value in values.items()},
+                   '$unset': {'index': True},  # A persisted index is no longer valid.
+                   '$inc': {'version': versions}}
+
+        result = self.collection.update_one(query, updates)
+
+        if result.matched_count != 1 and expected_versions is not None:
+            return self._mismatch(c_id)
+
+        return result.matched_count == 1
+
+    def add_range(self, c_id, x_init, x_end, y_init, y_end, z_init, z_end, delta):
+        box = (x_init, x_end, y_init, y_end, z_init, z_end)
+
+        # Elements of small boxes are increased in place.
+        if _volume(*box) <= _MAX_INCREMENTS:
+            increments = {'cube.%d.%d.%d' % point: delta for point in _box(*box)}
+            increments['version'] = 1
+
+            result = self.collection.update_one({'_id': _object_id(c_id)},
+                                                {'$inc': increments, '$unset': {'index': True}})
+            return result.matched_count == 1
+
+        # Otherwise the whole cube is written, unless it was updated since it was read, in which case it's read again.
+        while True:
+            cube = self.collection.find_one({'_id': _object_id(c_id)}, {'cube': True, 'version': True})
+
+            if cube is None:
+                return False
+
+            _add_to_box(cube['cube'], *box, delta)
+
+            query = dict(_version_query({cube.get('version', 0)}), _id=cube['_id'])
+            result = self.collection.update_one(query, {'$set': {'cube': cube['cube']}, '$unset': {'index': True},
+                                                        '$inc': {'version': 1}})
+
+            if result.matched_count == 1:
+                return True
+
+    def store_index(self, c_id, index, version):
+        query = dict(_version_query({version}), _id=_object_id(c_id))
+        result = self.collection.update_one(query, {'$set': {'index': index}})
+        return result.matched_count == 1
+
+    def delete(self, c_id):
+        result = self.collection.delete_one({'_id': _object_id(c_id)})
+        return result.deleted_count == 1
+
+    def delete_all(self):
+        result = self.collection.delete_many({})
+        return result.deleted_count
+
+
+class MongoSlabBackend(StorageBackend):
+    """
+    Stores each cube in MongoDB as a metadata document (in the same collection and with the same fields as MongoBackend,
+    but without the elements) plus one document per non-empty slab, i.e. per X coordinate, in a second collection.
+    Documents stay small whatever the size of the cube, reads of a range of slabs only fetch those slabs and element
+    updates only touch the slabs involved.
+
+    Cubes stored by MongoBackend are still read as they are, and migrate moves them to this layout.
+    """
+
+    # NOTE ABOUT INNER REPRESENTATION:
+    # ------------------------------------
+    # Slab documents look like {'cube_id': ObjectId, 'x': int, 'elements': {'y': {'z': value}}}, and are unique by
+    # (cube_id, x). Writes that touch many documents are not atomic: a reader may see some slabs of a full update
+    # before the others, just like with concurrent element updates, and the new version of a conditional write before
+    # its slabs.
+
+    name = 'mongo_slabs'
+
+    def __init__(self, conf):
+        self._slabs_collection_name = conf.get('slabs_collection', '%s_slabs' % conf.get('collection', 'cubes'))
+        self._indexed_pid = None
+
+    @property
+    def collection(self):
+        """
+        Collection of the cube metadata documents.
+        """
+        from config.config import get_collection
+
+        return get_collection()
+
+    @property
+    def slabs(self):
+        """
+        Collection of the slab documents, indexed by (cube_id, x) the first time it's used by a process.
+        """
+        from config.config import get_database
+
+        slabs = get_database()[self._slabs_collection_name]
+
+        if self._indexed_pid != os.getpid():
+            slabs.create_index([('cube_id', 1), ('x', 1)], unique=True)
+            self._indexed_pid = os.getpid()
+
+        return slabs
+
+    def store(self, document):
+        metadata = {field: value for field, value in document.items() if field != 'cube'}
+        metadata['version'] = 1
+        result = self.collection.insert_one(metadata)
+
+        self._insert_slabs(result.inserted_id, document['cube'])
+        return str(result.inserted_id)
+
+    def get(self, c_id):
+        cube = self.collection.find_one({'_id': _object_id(c_id)})
+
+        if cube and 'cube' not in cube:
+            cube['cube'] = self._read_slabs({'cube_id': cube['_id']})
+
+        return _stringify_id(cube) if cube else None
+
+    def get_all(self, limit=None, after=None, ids_only=False):
+        query = {'_id': {'$gt': _object_id(after)}} if after else {}
+        projection = {'dimension': True, 'version': True} if ids_only else {'index': False}
+        cubes = self.collection.find(query, projection).sort('_id', 1)
+
+        if limit:
+            cubes = cubes.limit(limit)
+
+        return (_stringify_id(cube) for cube in (cubes if ids_only else self._with_elements(cubes)))
+
+    def get_metadata(self, c_id):
+        cube = self.collection.find_one({'_id': _object_id(c_id)}, {'cube': False, 'index': False})
+        return _stringify_id(cube) if cube else None
+
+    def get_slabs(self, c_id, x_init, x_end):
+        cube_id = _object_id(c_id)
+        projection = {'cube.%d' % x: True for x in range(x_init, x_end + 1)}
+        projection.update(dimension=True, version=True)
+
+        cube = self.collection.find_one({'_id': cube_id}, projection)
+
+        if not cube:
+            return None
+
+        if 'cube' not in cube:
+            cube['cube'] = self._read_slabs({'cube_id': cube_id, 'x': {'$gte': x_init, '$lte': x_end}})
+
+        return _stringify_id(cube)
+
+    def update(self, c_id, document, versions=1):
+        cube_id = _object_id(c_id)
+        updates = {'$set': {'dimension': document['dimension']}, '$unset': {'cube': True},
+                   '$inc': {'version': versions}}
+
+        if document.get('index') is not None:
+            updates['$set']['index'] = document['index']
+        else:
+            updates['$unset']['index'] = True
+
+        result = self.collection.update_one({'_id': cube_id}, updates)
+
+        if result.matched_count != 1:
+            return False
+
+        self.slabs.delete_many({'cube_id': cube_id})
+        self._insert_slabs(cube_id, document['cube'])
+        return True
+
+    def update_elements(self, c_id, values, versions=1, expected_versions=None):
+        by_slab = {}
+        for (x, y, z), value in values.items():
+            by_slab.setdefault(x, {})['elements.%d.%d' % (y, z)] = value
+
+        return self._write(c_id, lambda: {'$set': {'cube.%d.%d.%d' % point: value for point, value in values.items()}},
+                           {x: {'$set': fields} for x, fields in by_slab.items()}, versions, expected_versions)
+
+    def add_range(self, c_id, x_init, x_end, y_init, y_end, z_init, z_end, delta):
+        # Cubes not migrated yet are increased in place, with a field per element, unless the box is too large for that.
+        if _volume(x_init, x_end, y_init, y_end, z_init, z_end) > _MAX_INCREMENTS:
+            self._migrate_cube(_object_id(c_id))
+
+        # One increase per slab, of at most N^2 elements.
+        increments = {'elements.%d.%d' % (y, z): delta for y, z in product(range(y_init, y_end + 1),
+                                                                           range(z_init, z_end + 1))}
+
+        return self._write(c_id, lambda: {'$inc': {'cube.%d.%d.%d' % point: delta
+                                                   for point in _box(x_init, x_end, y_init, y_end, z_init, z_end)}},
+                           {x: {'$inc': increments} for x in range(x_init, x_end + 1)}, 1)
+
+    def store_index(self, c_id, index, version):
+        query = dict(_version_query({version}), _id=_object_id(c_id))
+        result = self.collection.update_one(query, {'$set': {'index': index}})
+        return result.matched_count == 1
+
+    def delete(self, c_id):
+        cube_id = _object_id(c_id)
+        result = self.collection.delete_one({'_id': cube_id})
+        self.slabs.delete_many({'cube_id': cube_id})
+
+        return result.deleted_count == 1
+
+    def delete_all(self):
+        result = self.collection.delete_many({})
+        self.slabs.delete_many({})
+
+        return result.deleted_count
+
+    def migrate(self):
+        """
+        Moves every cube stored by MongoBackend (i.e. with its elements in its own document) to the slab layout, one
+        cube at a time. It can run while the application is up and be interrupted and resumed at any time, provided
+        that every process writing cubes uses this backend.
+        :return: Number of cubes migrated.
+        """
+        migrated = 0
+
+        for cube in self.collection.find({'cube': {'$exists': True}}, {'_id': True}):
+            migrated += self._migrate_cube(cube['_id'])
+
+        return migrated
+
+    # ========================
+    # Private helper functions
+    # ========================
+    def _write(self, c_id, in_place, by_slab, versions, expected_versions=None):
+        """
+        Updates elements of a cube: in its own document if it isn't migrated yet (like MongoBackend does), or in its
+        slabs otherwise. Its version is increased and its stored index (if any) removed as well: before the slabs are
+        written if the write is conditional, and after otherwise.
+        :param c_id: Identifier of the cube to be updated.
+        :param in_place: Function that returns the update of the 'cube' field of the document of a cube not migrated
+        yet. Only called for those.
+        :param by_slab: dict whose keys are X coordinates and its values the update of the 'elements' of that slab.
+        :param versions: Amount the version of the cube is increased by.
+        :param expected_versions: Collection of versions the cube must be at to be updated. None means any version.
+        :return: True if the cube exists and was updated; False otherwise.
+        :raise VersionMismatch: If the cube isn't at any of the expected versions.
+        """
+        cube_id = _object_id(c_id)
+        query = dict(_version_query(expected_versions), _id=cube_id)
+
+        # Cubes not migrated yet are updated in place, like MongoBackend does.
+        if self.collection.count_documents(dict(query, cube={'$exists': True}), limit=1):
+            updates = in_place()
+            updates['$unset'] = {'index': True}
+            updates.setdefault('$inc', {})['version'] = versions
+            result = self.collection.update_one(dict(query, cube={'$exists': True}), updates)
+
+            if result.matched_count == 1:
+                return True
+
+        # A persisted index is no longer valid.
+        updates = {'$unset': {'index': True}, '$inc': {'version': versions}}
+
+        # Conditional writes claim the version they expect before writing the slabs, atomically with checking it, so
+        # only one of the writes that expect the same version goes ahead.
+        if expected_versions is not None:
+            if self.collection.find_one_and_update(query, updates, {'_id': True}) is None:
+                return self._mismatch(c_id)
+
+            self._write_slabs(cube_id, by_slab)
+            return True
+
+        if self.collection.count_documents(query, limit=1) != 1:
+            return False
+
+        self._write_slabs(cube_id, by_slab)
+
+        # Otherwise, the version is increased after the slabs are written, so readers that see the new version (e.g. as
+        # an ETag) never see the old elements.
+        result = self.collection.update_one({'_id': cube_id}, updates)
+        return result.matched_count == 1
+
+    def _write_slabs(self, cube_id, by_slab):
+        """
+        Applies updates to the slabs of a cube, creating the slabs that don't exist yet.
+        :param cube_id: ObjectId of the cube.
+        :param by_slab: dict whose keys are X coordinates and its values the update of the 'elements' of that slab.
+        """
+        from pymongo import UpdateOne
+
+        self.slabs.bulk_write([UpdateOne({'cube_id': cube_id, 'x': x}, update, upsert=True)
+                               for x, update in by_slab.items()], ordered=False)
+
+    def _migrate_cube(self, cube_id):
+        """
+        Moves a cube stored by MongoBackend to the slab layout, if it's still there.
+        :param cube_id: ObjectId of the cube.
+        :return: True if the cube was moved; False if it wasn't found in the old layout.
+        """
+        projection = {'cube': True, 'version': True}
+        cube = self.collection.find_one({'_id': cube_id, 'cube': {'$exists': True}}, projection)
+
+        while cube is not None:
+            if self._move_to_slabs(cube):
+                return True
+
+            # The cube was updated while being moved, so it's read and moved again.
+            cube = self.collection.find_one({'_id': cube_id, 'cube': {'$exists': True}}, projection)
+
+        return False
+
+    def _insert_slabs(self, cube_id, cube):
+        """
+        Inserts a document per non-empty slab of a cube.
+        """
+        slabs = [{'cube_id': cube_id, 'x': int(x), 'elements': matrix} for x, matrix in cube.items() if matrix]
+
+        if slabs:
+            self.slabs.insert_many(slabs, ordered=False)
+
+    def _move_to_slabs(self, cube):
+        """
+        Writes the slabs of a cube stored by MongoBackend, and then removes the elements from its document, unless the
+        cube was updated since it was read (i.e. its version changed).
+        :param cube: Document of the cube, with its '_id', 'cube' and (if stored after cubes had versions) 'version'.
+        :return: True if the cube was moved; False if it has to be read again.
+        """
+        # Slabs left by an interrupted migration of this cube are written again.
+        self.slabs.delete_many({'cube_id': cube['_id']})
+        self._insert_slabs(cube['_id'], cube['cube'])
+
+        query = {'_id': cube['_id'], 'cube': {'$exists': True},
+                 'version': cube['version'] if 'version' in cube else {'$exists': False}}
+        result = self.collection.update_one(query, {'$unset': {'cube': True}})
+        return result.modified_count == 1
+
+    def _read_slabs(self, query):
+        """
+        :return: Nested dict with the elements of the slabs that match the query.
+        """
+        return {str(slab['x']): slab['elements'] for slab in self.slabs.find(query, {'x': True, 'elements': True})}
+
+    def _with_elements(self, cubes):
+        """
+        Fills in the elements of the cubes, fetching the slabs of a page of cubes at a time.
+        """
+        pages = iter(lambda: list(islice(cubes, _PAGE_SIZE)), [])
+
+        for page in pages:
+            ids = [cube['_id'] for cube in page if 'cube' not in cube]
+            elements = {cube_id: {} for cube_id in ids}
+
+            for slab in self.slabs.find({'cube_id': {'$in': ids}}):
+                elements[slab['cube_id']][str(slab['x'])] = slab['elements']
+
+            for cube in page:
+                cube.setdefault('cube', elements.get(cube['_id']))
+                yield cube
+
+
+class MemoryBackend(StorageBackend):
+    """
+    Keeps cube documents in a dict of the running process. Nothing survives the process, so it's meant for tests and
+    single-node deployments that don't need durability.
+    """
+
+    name = 'memory'
+
+    def __init__(self, conf):
+        self._documents = {}
+        self._lock = Lock()
+
+    def store(self, document):
+        c_id = str(ObjectId())
+
+        with self._lock:
+            self._documents[c_id] = _copy_document(document, _id=c_id, version=1)
+
+        return c_id
+
+    def get(self, c_id):
+        with self._lock:
+            document = self._documents.get(_valid_id(c_id))
+            return _copy_document(document) if document else None
+
+    def get_all(self, limit=None, after=None, ids_only=False):
+        with self._lock:
+            ids = sorted(c_id for c_id in self._documents if not after or c_id > _valid_id(after))
+
+        for c_id in ids[:limit] if limit else ids:
+            with self._lock:
+                document = self._documents.get(c_id)
+
+                if document is None:
+                    continue  # Deleted in the meantime.
+
+                if ids_only:
+                    yield {'_id': c_id, 'dimension': document['dimension'], 'version': document['version']}
+                else:
+                    yield _copy_document(document, index=None)
+
+    def get_metadata(self, c_id):
+        with self._lock:
+            document = self._documents.get(_valid_id(c_id))
+
+            if not document:
+                return None
+
+            return {'_id': c_id, 'dimension': document['dimension'], 'version': document['version']}
+
+    def get_slabs(self, c_id, x_init, x_end):
+        with self._lock:
+            document = self._documents.get(_valid_id(c_id))
+
+            if not document:
+                return None
+
+            slabs = {x: matrix for x, matrix in document['cube'].items() if x_init <= int(x) <= x_end}
+            return _copy_document(document, cube=slabs, index=None)
+
+    def update(self, c_id, document, versions=1):
+        with self._lock:
+            current = self._documents.get(_valid_id(c_id))
+
+            if not current:
+                return False
+
+            self._documents[c_id] = _copy_document(document, _id=c_id, version=current['version'] + versions)
+            return True
+
+    def update_elements(self, c_id, values, versions=1, expected_versions=None):
+        with self._lock:
+            document = self._documents.get(_valid_id(c_id))
+
+            if not document:
+                return False
+
+            if expected_versions is not None and document['version'] not in expected_versions:
+                raise VersionMismatch(c_id, document['version'])
+
+            for (x, y, z), value in values.items():
+                document['cube'].setdefault(str(x), {}).setdefault(str(y), {})[str(z)] = value
+            document.pop('index', None)
+            document['version'] += versions
+
+            return True
+
+    def add_range(self, c_id, x_init, x_end, y_init, y_end, z_init, z_end, delta):
+        with self._lock:
+            document = self._documents.get(_valid_id(c_id))
+
+            if not document:
+                return False
+
+            _add_to_box(document['cube'], x_init, x_end, y_init, y_end, z_init, z_end, delta)
+            document.pop('index', None)
+            document['version'] += 1
+
+            return True
+
+    def store_index(self, c_id, index, version):
+        with self._lock:
+            document = self._documents.get(_valid_id(c_id))
+
+            if not document or document['version'] != version:
+                return False
+
+            document['index'] = bytes(index)
+            return True
+
+    def delete(self, c_id):
+        with self._lock:
+            return self._documents.pop(_valid_id(c_id), None) is not None
+
+    def delete_all(self):
+        with self._lock:
+            deleted = len(self._documents)
+            self._documents.clear()
+            return deleted
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Stores cubes in a local SQLite database file, with one row per element. Element updates and slab reads only touch
+    the rows involved. Elements must fit in a signed 64 bits integer.
+    """
+
+    name = 'sqlite'
+
+    _SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS cubes (
+            id TEXT PRIMARY KEY,
+            dimension INTEGER NOT NULL,
+            idx BLOB,
+            version INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS elements (
+            cube_id TEXT NOT NULL,
+            x INTEGER NOT NULL,
+            y INTEGER NOT NULL,
+            z INTEGER NOT NULL,
+            value INTEGER NOT NULL,
+            PRIMARY KEY (cube_id, x, y, z)
+        ) WITHOUT ROWID;
+    '''
+
+    # Adds a value to every element of a box of a cube, inserting the elements not set yet. Needs SQLite 3.24 or later.
+    _ADD_RANGE = '''
+        WITH RECURSIVE xs(x) AS (SELECT ? UNION ALL SELECT x + 1 FROM xs WHERE x < ?),
+                       ys(y) AS (SELECT ? UNION ALL SELECT y + 1 FROM ys WHERE y < ?),
+                       zs(z) AS (SELECT ? UNION ALL SELECT z + 1 FROM zs WHERE z < ?)
+        INSERT INTO elements SELECT ?, x, y, z, ? FROM xs, ys, zs WHERE true
+        ON CONFLICT (cube_id, x, y, z) DO UPDATE SET value = value + excluded.value
+    '''
+
+    def __init__(self, conf):
+        path = conf.get('sqlite', {}).get('path', 'cubes.sqlite3')
+
+        # A single connection shared by every thread, serialized by a lock.
+        self._connection = sqlite3.connect(os.path.expanduser(path), check_same_thread=False)
+        self._connection.executescript(self._SCHEMA)
+        self._lock = Lock()
+
+        # Databases created before cubes had versions lack the column.
+        columns = [row[1] for row in self._connection.execute('PRAGMA table_info(cubes)')]
+        if 'version' not in columns:
+            with self._connection as connection:
+                connection.execute('ALTER TABLE cubes ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+
+    def store(self, document):
+        c_id = str(ObjectId())
+
+        with self._lock, self._connection as connection:
+            connection.execute('INSERT INTO cubes (id, dimension, idx, version) VALUES (?, ?, ?, 1)',
+                               (c_id, document['dimension'], document.get('index')))
+            connection.executemany('INSERT INTO elements VALUES (?, ?, ?, ?, ?)',
+                                   _rows(c_id, document['cube']))
+        return c_id
+
+    def get(self, c_id):
+        return self._read(c_id, 'SELECT x, y, z, value FROM elements WHERE cube_id = ?', (c_id,), with_index=True)
+
+    def get_all(self, limit=None, after=None, ids_only=False):
+        query, parameters = 'SELECT id FROM cubes', []
+
+        if after:
+            query += ' WHERE id > ?'
+            parameters.append(_valid_id(after))
+
+        query += ' ORDER BY id'
+
+        if limit:
+            query += ' LIMIT ?'
+            parameters.append(limit)
+
+        with self._lock:
+            ids = [row[0] for row in self._connection.execute(query, parameters)]
+
+        for c_id in ids:
+            document = self.get_metadata(c_id) if ids_only else self._read(
+                c_id, 'SELECT x, y, z, value FROM elements WHERE cube_id = ?', (c_id,))
+
+            if document:  # Unless deleted in the meantime.
+                yield document
+
+    def get_metadata(self, c_id):
+        with self._lock:
+            row = self._connection.execute('SELECT dimension, version FROM cubes WHERE id = ?',
+                                           (_valid_id(c_id),)).fetchone()
+        return {'_id': c_id, 'dimension': row[0], 'version': row[1]} if row else None
+
+    def get_slabs(self, c_id, x_init, x_end):
+        return self._read(c_id, 'SELECT x, y, z, value FROM elements WHERE cube_id = ? AND x BETWEEN ? AND ?',
+                          (c_id, x_init, x_end))
+
+    def update(self, c_id, document, versions=1):
+        with self._lock, self._connection as connection:
+            cursor = connection.execute('UPDATE cubes SET dimension = ?, idx = ?, version = version + ? WHERE id = ?',
+                                        (document['dimension'], document.get('index'), versions, _valid_id(c_id)))
+
+            if cursor.rowcount != 1:
+                return False
+
+            connection.execute('DELETE FROM elements WHERE cube_id = ?', (c_id,))
+            connection.executemany('INSERT INTO elements VALUES (?, ?, ?, ?, ?)', _rows(c_id, document['cube']))
+            return True
+
+    def update_elements(self, c_id, values, versions=1, expected_versions=None):
+        query = 'UPDATE cubes SET idx = NULL, version = version + ? WHERE id = ?'
+        parameters = [versions, _valid_id(c_id)]
+
+        if expected_versions is not None:
+            query += ' AND version IN (%s)' % ', '.join('?' * len(expected_versions))
+            parameters.extend(expected_versions)
+
+        with self._lock, self._connection as connection:
+            cursor = connection.execute(query, parameters)
+
+            if cursor.rowcount != 1:
+                version = connection.execute('SELECT version FROM cubes WHERE id = ?', (c_id,)).fetchone()
+
+                if version is None:
+                    return False
+
+                raise VersionMismatch(c_id, version[0])
+
+            connection.executemany('INSERT OR REPLACE INTO elements VALUES (?, ?, ?, ?, ?)',
+                                   [(c_id, x, y, z, value) for (x, y, z), value in values.items()])
+            return True
+
+    def add_range(self, c_id, x_init, x_end, y_init, y_end, z_init, z_end, delta):
+        with self._lock, self._connection as connection:
+            cursor = connection.execute('UPDATE cubes SET idx = NULL, version = version + 1 WHERE id = ?',
+                                        (_valid_id(c_id),))
+
+            if cursor.rowcount != 1:
+                return False
+
+            connection.execute(self._ADD_RANGE, (x_init, x_end, y_init, y_end, z_init, z_end, c_id, delta))
+            return True
+
+    def store_index(self, c_id, index, version):
+        with self._lock, self._connection as connection:
+            cursor = connection.execute('UPDATE cubes SET idx = ? WHERE id = ? AND version = ?',
+                                        (index, _valid_id(c_id), version))
+            return cursor.rowcount == 1
+
+    def delete(self, c_id):
+        with self._lock, self._connection as connection:
+            connection.execute('DELETE FROM elements WHERE cube_id = ?', (_valid_id(c_id),))
+            return connection.execute('DELETE FROM cubes WHERE id = ?', (c_id,)).rowcount == 1
+
+    def delete_all(self):
+        with self._lock, self._connection as connection:
+            connection.execute('DELETE FROM elements')
+            return connection.execute('DELETE FROM cubes').rowcount
+
+    # ========================
+    # Private helper functions
+    # ========================
+    def _read(self, c_id, elements_query, parameters, with_index=False):
+        """
+        Builds a cube document out of its row in the cubes table and the rows of the elements query.
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT dimension, idx, version FROM cubes WHERE id = ?',
+                                           (_valid_id(c_id),)).fetchone()
+
+            if not row:
+                return None
+
+            cube = {}
+            for x, y, z, value in self._connection.execute(elements_query, parameters):
+                cube.setdefault(str(x), {}).setdefault(str(y), {})[str(z)] = value
+
+        document = {'_id': c_id, 'dimension': row[0], 'version': row[2], 'cube': cube}
+
+        if with_index and row[1] is not None:
+            document['index'] = bytes(row[1])
+
+        return document
+
+
+class LogBackend(StorageBackend):
+    """
+    Stores cubes in local files, event-sourced: every cube has a snapshot of its elements (see data.snapshot) plus an
+    append-only log of the element updates made since, so updating elements is a small sequential append whatever the
+    size of the cube. Reads load the latest snapshot and replay the log on top of it.
+
+    A background thread compacts the logs of the cubes updated by the process: once a log has compact_min_records
+    records, it's folded into a new snapshot every compact_interval_ms. That bounds the size of the logs, and hence
+    the time it takes to read a cube (e.g. to recover it after a crash). Elements must fit in an int64.
+    """
+
+    # NOTE ABOUT INNER REPRESENTATION:
+    # ------------------------------------
+    # Every cube has its own directory, named after its id, with files numbered by generation:
+    #   <generation>.snapshot   Elements of the cube before the updates of the logs of the same or later generations.
+    #   <generation>.version    Version of the cube at the snapshot, in ASCII. Written before the snapshot.
+    #   <generation>.log        Records of the updates of elements and of the box adds (see _LOG_RECORD), in order,
+    #                           each batch or box followed by a record with the increase of the version.
+    #   index                   Index of the cube, if persisted (see persistence.cube). Removed by any update.
+    # The state of a cube is the latest snapshot plus the logs of its generation and later ones, so files are never
+    # modified but appended to or replaced by a rename, and a crash at any point leaves a readable cube. A torn record
+    # at the end of a log (the process died while appending it) is ignored.
+    # Compacting generation g starts generation g + 1 by creating its (empty) log, where updates are appended from
+    # then on, folds snapshot and logs up to g into snapshot g + 1 without holding the lock of the cube, and removes
+    # generation g. Only one process may write a cube at a time, which is the case in cluster mode.
+
+    name = 'log'
+
+    def __init__(self, conf):
+        log_conf = conf.get('log', {})
+
+        self._path = os.path.expanduser(log_conf.get('path', 'cubes-log'))
+        self._fsync = log_conf.get('fsync', False)
+        self._compact_interval = log_conf.get('compact_interval_ms', 60000) / 1000
+        self._compact_min_records = log_conf.get('compact_min_records', 10000)
+
+        os.makedirs(self._path, exist_ok=True)
+
+        # Appends to a cube, and the start of a new generation, are serialized by one of these locks.
+        self._locks = [Lock() for _ in range(64)]
+
+        # Cubes updated by this process whose logs may need compacting, and the thread that compacts them.
+        self._updated = set()
+        self._compactor_pid = None
+        self._compactor_lock = Lock()
+
+    def store(self, document):
+        c_id = str(ObjectId())
+        os.makedirs(os.path.join(self._path, c_id))
+        self._write_generation(c_id, 1, dict(document, version=1))
+
+        return c_id
+
+    def get(self, c_id):
+        return self._read(c_id, with_index=True)
+
+    def get_all(self, limit=None, after=None, ids_only=False):
+        ids = sorted(c_id for c_id in os.listdir(self._path) if ObjectId.is_valid(c_id) and
+                     (not after or c_id > _valid_id(after)))
+
+        for c_id in ids[:limit] if limit else ids:
+            document = self.get_metadata(c_id) if ids_only else self._read(c_id)
+
+            if document:  # Unless deleted in the meantime.
+                yield document
+
+    def get_metadata(self, c_id):
+        for _ in range(3):
+            generations = self._generations(c_id)
+
+            if not generations['snapshot']:
+                return None
+
+            latest = max(generations['snapshot'])
+
+            try:
+                with open(self._file(c_id, latest, 'snapshot'), 'rb') as f:
+                    dimension = snapshot.dimension(f.read(snapshot.HEADER_SIZE))
+
+                version = self._read_version(c_id, latest)
+                for generation in self._logs_since(generations, latest):
+                    version += self._replay(self._read_log(c_id, generation))
+
+                return {'_id': c_id, 'dimension': dimension, 'version': version}
+            except FileNotFoundError:
+                continue  # Compacted in the meantime.
+
+        return None
+
+    def get_slabs(self, c_id, x_init, x_end):
+        document = self._read(c_id)
+
+        if document:
+            document['cube'] = {x: matrix for x, matrix in document['cube'].items() if x_init <= int(x) <= x_end}
+
+        return document
+
+    def update(self, c_id, document, versions=1):
+        with self._lock_for(c_id):
+            metadata = self.get_metadata(c_id)
+
+            if not metadata:
+                return False
+
+            generation = self._current_generation(self._generations(c_id)) + 1
+            self._write_generation(c_id, generation, dict(document, version=metadata['version'] + versions))
+            return True
+
+    def update_elements(self, c_id, values, versions=1, expected_versions=None):
+        records = b''.join(_LOG_RECORD.pack(x, y, z, value) for (x, y, z), value in values.items())
+        records += _LOG_RECORD.pack(0, _VERSION_RECORD, 0, versions)
+
+        return self._append(c_id, records, expected_versions)
+
+    def add_range(self, c_id, x_init, x_end, y_init, y_end, z_init, z_end, delta):
+        # The box is logged as is, whatever its size, and only applied to the elements when the cube is read.
+        records = b''.join([_LOG_RECORD.pack(0, _RANGE_RECORD, 0, delta), _LOG_RECORD.pack(x_init, y_init, z_init, 0),
+                            _LOG_RECORD.pack(x_end, y_end, z_end, 0), _LOG_RECORD.pack(0, _VERSION_RECORD, 0, 1)])
+
+        return self._append(c_id, records)
+
+    def store_index(self, c_id, index, version):
+        # Appends remove the index while holding the lock, so the version can't change until the index is written.
+        with self._lock_for(c_id):
+            metadata = self.get_metadata(c_id)
+
+            if not metadata or metadata['version'] != version:
+                return False
+
+            self._write_file(os.path.join(self._path, c_id, 'index'), bytes(index))
+            return True
+
+    def delete(self, c_id):
+        with self._lock_for(c_id):
+            self._updated.discard(c_id)
+
+            try:
+                shutil.rmtree(os.path.join(self._path, _valid_id(c_id)))
+                return True
+            except FileNotFoundError:
+                return False
+
+    def delete_all(self):
+        deleted = 0
+
+        for c_id in os.listdir(self._path):
+            if ObjectId.is_valid(c_id):
+                deleted += self.delete(c_id)
+
+        return deleted
+
+    def compact(self, c_id, min_records=0):
+        """
+        Folds the logs of a cube into a new snapshot, if they have enough records.
+        :param c_id: Identifier of the cube.
+        :param min_records: Minimum number of records in the logs for the cube to be compacted.
+        :return: True if the cube was compacted; False otherwise.
+        """
+        with self._lock_for(c_id):
+            generations = self._generations(c_id)
+            current = self._current_generation(generations)
+            records = sum(self._log_size(c_id, g) for g in generations['log']) // _LOG_RECORD.size
+
+            if not generations['snapshot'] or not records or records < min_records:
+                return False
+
+            # Updates go to the log of the new generation from now on.
+            open(self._file(c_id, current + 1, 'log'), 'ab').close()
+
+        try:
+            document = self._read(c_id, up_to=current)
+
+            if document is None:
+                return False  # Deleted in the meantime.
+
+            self._write_snapshot(c_id, current + 1, document)
+        except FileNotFoundError:
+            return False  # Deleted or replaced by update in the meantime, which leaves nothing to compact.
+
+        self._remove_generations(c_id, current + 1)
+        return True
+
+    # ========================
+    # Private helper functions
+    # ========================
+    def _lock_for(self, c_id):
+        """
+        :return: Lock that serializes appends to the given cube.
+        """
+        return self._locks[hash(c_id) % len(self._locks)]
+
+    def _append(self, c_id, records, expected_versions=None):
+        """
+        Appends records to the log of the current generation of a cube, and removes its stored index (if any).
+        :param records: bytes with the records, ending with the increase of the version.
+        :param expected_versions: Collection of versions the cube must be at to be updated. None means any version.
+        :return: True if the cube exists and was updated; False otherwise.
+        :raise VersionMismatch: If the cube isn't at any of the expected versions.
+        """
+        with self._lock_for(c_id):
+            generations = self._generations(c_id)
+
+            if not generations['snapshot']:
+                return False
+
+            # Appends are serialized by the lock, so the version can't change until this one is written.
+            if expected_versions is not None:
+                metadata = self.get_metadata(c_id)
+
+                if metadata is None:
+                    return False
+
+                if metadata['version'] not in expected_versions:
+                    raise VersionMismatch(c_id, metadata['version'])
+
+            with open(self._file(c_id, self._current_generation(generations), 'log'), 'ab') as f:
+                f.write(records)
+
+                if self._fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            self._remove(os.path.join(self._path, c_id, 'index'))
+
+        self._updated.add(c_id)
+        self._start_compactor()
+
+        return True
+
+    def _file(self, c_id, generation, kind):
+        """
+        :return: Path of the snapshot, version or log file of a generation of a cube.
+        """
+        return os.path.join(self._path, c_id, '%d.%s' % (generation, kind))
+
+    def _generations(self, c_id):
+        """
+        :return: dict with the generations of the 'snapshot', 'version' and 'log' files of a cube. All of them are
+        empty if the cube doesn't exist.
+        """
+        generations = {'snapshot': [], 'version': [], 'log': []}
+
+        try:
+            names = os.listdir(os.path.join(self._path, _valid_id(c_id)))
+        except FileNotFoundError:
+            return generations
+
+        for name in names:
+            generation, _, kind = name.partition('.')
+            if kind in generations and generation.isdigit():
+                generations[kind].append(int(generation))
+
+        return generations
+
+    def _current_generation(self, generations):
+        """
+        :return: Generation updates are appended to.
+        """
+        return max(generations['snapshot'] + generations['log'])
+
+    def _log_size(self, c_id, generation):
+        """
+        :return: Size of the log of a generation, in bytes.
+        """
+        try:
+            return os.path.getsize(self._file(c_id, generation, 'log'))
+        except FileNotFoundError:
+            return 0
+
+    def _read(self, c_id, up_to=None, with_index=False):
+        """
+        Builds a cube document out of the latest snapshot of a cube and the logs written since.
+        :param up_to: Latest generation to be read. None means every generation.
+        :return: Cube document if found or None otherwise.
+        """
+        for _ in range(3):
+            generations = self._generations(c_id)
+            snapshots = [g for g in generations['snapshot'] if up_to is None or g <= up_to]
+
+            if not snapshots:
+                return None
+
+            latest = max(snapshots)
+            logs = [g for g in self._logs_since(generations, latest) if up_to is None or g <= up_to]
+
+            try:
+                cube = snapshot.load(self._file(c_id, latest, 'snapshot'))
+                elements = cube.cube
+                version = self._read_version(c_id, latest)
+
+                for generation in logs:
+                    version += self._replay(self._read_log(c_id, generation), elements)
+
+                document = {'_id': c_id, 'dimension': cube.dimension, 'version': version, 'cube': elements}
+
+                if with_index:
+                    document.update(self._read_index(c_id))
+
+                return document
+            except FileNotFoundError:
+                continue  # Compacted or deleted in the meantime.
+
+        return None
+
+    def _logs_since(self, generations, generation):
+        """
+        :return: Generations of the logs of a cube from the given one on, in order.
+        """
+        return sorted(g for g in generations['log'] if g >= generation)
+
+    def _read_log(self, c_id, generation):
+        """
+        :return: Records of the log of a generation of a cube, as (x, y, z, value) tuples. A torn record at the end, if
+        any, is skipped.
+        """
+        with open(self._file(c_id, generation, 'log'), 'rb') as f:
+            data = f.read()
+
+        return _LOG_RECORD.iter_unpack(data[:len(data) - len(data) % _LOG_RECORD.size])
+
+    def _replay(self, records, elements=None):
+        """
+        Applies the records of a log to the elements of a cube.
+        :param records: Iterable of records (see _read_log).
+        :param elements: Nested dict with the elements of the cube, updated in place. None to only add up versions.
+        :return: Amount the version of the cube is increased by.
+        """
+        versions = 0
+        records = iter(records)
+
+        for x, y, z, value in records:
+            if x:
+                if elements is not None:
+                    elements.setdefault(str(x), {}).setdefault(str(y), {})[str(z)] = value
+            elif y == _RANGE_RECORD:
+                corners = list(islice(records, 2))  # Missing if torn.
+
+                if len(corners) == 2 and elements is not None:
+                    (x_init, y_init, z_init, _), (x_end, y_end, z_end, _) = corners
+                    _add_to_box(elements, x_init, x_end, y_init, y_end, z_init, z_end, value)
+            else:
+                versions += value
+
+        return versions
+
+    def _read_version(self, c_id, generation):
+        """
+        :return: Version of a cube at the snapshot of a generation. Snapshots written before cubes had versions are
+        version 0.
+        """
+        try:
+            with open(self._file(c_id, generation, 'version'), 'rb') as f:
+                return int(f.read())
+        except FileNotFoundError:
+            if os.path.exists(self._file(c_id, generation, 'snapshot')):
+                return 0
+            raise
+
+    def _read_index(self, c_id):
+        """
+        :return: dict with the 'index' field of a cube, if it has one. Empty otherwise.
+        """
+        try:
+            with open(os.path.join(self._path, c_id, 'index'), 'rb') as f:
+                return {'index': f.read()}
+        except FileNotFoundError:
+            return {}
+
+    def _write_generation(self, c_id, generation, document):
+        """
+        Writes the whole content of a cube as a new generation, and removes the older ones.
+        """
+        index_path = os.path.join(self._path, c_id, 'index')
+
+        if document.get('index') is not None:
+            self._write_file(index_path, bytes(document['index']))
+        else:
+            self._remove(index_path)
+
+        self._write_snapshot(c_id, generation, document)
+        self._remove_generations(c_id, generation)
+
+    def _write_snapshot(self, c_id, generation, document):
+        """
+        Writes the snapshot of a generation of a cube, after its version.
+        """
+        self._write_file(self._file(c_id, generation, 'version'), b'%d' % document['version'])
+
+        cube = Cube(document['dimension'], document['cube'])
+        self._write_file(self._file(c_id, generation, 'snapshot'), snapshot.dumps(cube))
+
+    def _write_file(self, path, data):
+        """
+        Writes a file atomically: readers see either the previous file or the new one, whole.
+        """
+        temporary_path = '%s.tmp' % path
+
+        with open(temporary_path, 'wb') as f:
+            f.write(data)
+
+            if self._fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+        os.replace(temporary_path, path)
+
+    def _remove_generations(self, c_id, generation):
+        """
+        Removes the files of the generations of a cube older than the given one.
+        """
+        generations = self._generations(c_id)
+
+        for kind, older in generations.items():
+            for g in older:
+                if g < generation:
+                    self._remove(self._file(c_id, g, kind))
+
+    def _remove(self, path):
+        """
+        Removes a file, unless it doesn't exist.
+        """
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _start_compactor(self):
+        """
+        Starts the thread that compacts the logs every compact interval, unless it's running in this process.
+        """
+        with self._compactor_lock:
+            if self._compactor_pid == os.getpid():
+                return
+
+            self._compactor_pid = os.getpid()
+            Thread(target=self._compact_periodically, name='log-compactor', daemon=True).start()
+
+    def _compact_periodically(self):
+        """
+        Body of the compaction thread. Failed compactions are logged and retried on the next interval.
+        """
+        while True:
+            time.sleep(self._compact_interval)
+
+            for c_id in list(self._updated):
+                try:
+                    self.compact(c_id, min_records=self._compact_min_records)
+                except Exception:
+                    logging.getLogger(__name__).exception('Compacting the log of cube %s failed', c_id)
+
+
+# Backends available, by name.
+BACKENDS = {backend.name: backend for backend in (MongoBackend, MongoSlabBackend, MemoryBackend, SQLiteBackend,
+                                                  LogBackend)}
+DEFAULT_BACKEND = MongoBackend.name
+
+
+def create_backend(conf):
+    """
+    Creates the storage backend named in the persistence configuration.
+    :param conf: Persistence configuration (see config/persistence.json).
+    :return: StorageBackend instance.
+    """
+    name = conf.get('backend', DEFAULT_BACKEND)
+    assert name in BACKENDS, 'Unknown backend %s. Must be one of: %s' % (name, ', '.join(sorted(BACKENDS)))
+
+    return BACKENDS[name](conf)
+
+
+# ===============================
+# Private helper functions.
+# ===============================
+def _object_id(c_id):
+    """
+    Converts a cube id into an ObjectId.
+    """
+    try:
+        return ObjectId(c_id)
+    except (TypeError, InvalidId):
+        raise TypeError('Invalid cube id.')
+
+
+def _valid_id(c_id):
+    """
+    Checks that a cube id is valid (i.e. it's a string representation of an ObjectId) and returns it.
+    """
+    _object_id(c_id)
+    return c_id
+
+
+def _copy_document(document, **overrides):
+    """
+    Copies a cube document deep enough for the copy not to share any mutable object with the original. Fields given
+    as keyword arguments replace the ones of the document, and a None value removes the field.
+    """
+    copy = dict(document)
+    copy.update(overrides)
+    copy['cube'] = {x: {y: dict(row) for y, row in matrix.items()} for x, matrix in copy['cube'].items()}
+
+    return {field: value for field, value in copy.items() if value is not None}
+
+
+def _version_query(expected_versions):
+    """
+    Builds the MongoDB query that matches cube documents at any of the expected versions. Documents stored before cubes
+    had versions lack the field, and match version 0.
+    :param expected_versions: Collection of versions, or None for any version.
+    :return: dict with the query on the 'version' field. Empty if any version is expected.
+    """
+    if expected_versions is None:
+        return {}
+
+    versions = list(expected_versions)
+
+    if 0 in versions:
+        versions.append(None)  # Matches missing fields too.
+
+    return {'version': {'$in': versions}}
+
+
+def _box(x_init, x_end, y_init, y_end, z_init, z_end):
+    """
+    :return: Iterator of the (x, y, z) tuples of every point of a box.
+    """
+    return product(range(x_init, x_end + 1), range(y_init, y_end + 1), range(z_init, z_end + 1))
+
+
+def _volume(x_init, x_end, y_init, y_end, z_init, z_end):
+    """
+    :return: Number of points of a box.
+    """
+    return (x_end - x_init + 1) * (y_end - y_init + 1) * (z_end - z_init + 1)
+
+
+def _add_to_box(cube, x_init, x_end, y_init, y_end, z_init, z_end, delta):
+    """
+    Adds delta to every element of a box of a nested dict of elements, elements not set included.
+    """
+    for x in range(x_init, x_end + 1):
+        matrix = cube.setdefault(str(x), {})
+
+        for y in range(y_init, y_end + 1):
+            row = matrix.setdefault(str(y), {})
+
+            for z in range(z_init, z_end + 1):
+                row[str(z)] = row.get(str(z), 0) + delta
+
+
+def _rows(c_id, cube):
+    """
+    Flattens a nested dict of elements into rows of the elements table.
+    """
+    return [(c_id, int(x), int(y), int(z), value)
+            for x, matrix in cube.items() for y, row in matrix.items() for z, value in row.items()]
+
+
+def _stringify_id(cube_document):
+    """
+    Converts a cube id into a string and returns the same cube.
+    :param cube_document: Cube document to be processed.
+    :return: Cube document with its '_id' field converted into string, and its version (0 if it was stored before
+    versions existed).
+    """
+    cube_document['_id'] = str(cube_document['_id'])
+    cube_document.setdefault('version', 0)
+    return cube_document
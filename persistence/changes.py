@@ -0,0 +1,93 @@
+"""
+Log of the latest element updates of the cubes, used by persistence.cube to serve the changes of a cube since a given
+version (its change feed).
+"""
+
+from collections import deque
+from threading import Lock
+from data.lru import LRUCache
+
+
+class ChangeLog:
+    """
+    Latest element updates, by cube and version. Only the last max_versions versions of a cube are kept, and only for
+    the max_cubes cubes updated most recently, so memory is bounded whatever the write rate. Changes since a version
+    older than that are unknown, and the whole cube must be read instead.
+    """
+
+    # NOTE ABOUT INNER REPRESENTATION:
+    # ------------------------------------
+    # The history of a cube is a list [floor, versions], where versions is a deque of (version, values) tuples in
+    # version order, without gaps, and floor the version right before the first of them: changes are known from floor
+    # on. Dropping the oldest version moves the floor forward.
+
+    def __init__(self, max_versions=1000, max_cubes=1024):
+        """
+        Creates a new, empty, log.
+        :param max_versions: Number of versions kept per cube.
+        :param max_cubes: Number of cubes whose versions are kept.
+        :return: New ChangeLog instance.
+        """
+        assert max_versions > 0, 'max_versions must be positive'
+
+        self.max_versions = max_versions
+        self._histories = LRUCache(max_entries=max_cubes)
+        self._lock = Lock()
+
+    def add(self, c_id, version, values):
+        """
+        Records updates of a cube.
+        :param c_id: Identifier of the cube.
+        :param version: Version of the cube after the updates. If it doesn't follow the latest version recorded, the
+        history of the cube starts over from it.
+        :param values: dict whose keys are (x, y, z) tuples and its values the elements set.
+        """
+        with self._lock:
+            history = self._histories.peek(c_id)
+
+            if history is None or history[0] + len(history[1]) != version - 1:
+                history = [version - 1, deque()]
+
+            history[1].append((version, dict(values)))
+
+            if len(history[1]) > self.max_versions:
+                history[0] = history[1].popleft()[0]
+
+            self._histories.put(c_id, history)
+
+    def since(self, c_id, version):
+        """
+        Merges the updates of a cube made after a version. Updates of the same element are coalesced: the last value
+        wins.
+        :param c_id: Identifier of the cube.
+        :param version: Version of the cube the changes are relative to.
+        :return: dict whose keys are (x, y, z) tuples and its values the elements set, or None if the updates since
+        that version are unknown.
+        """
+        with self._lock:
+            history = self._histories.get(c_id)
+
+            if history is None or version < history[0]:
+                return None
+
+            changes = {}
+
+            for updated, values in history[1]:
+                if updated > version:
+                    changes.update(values)
+
+            return changes
+
+    def discard(self, c_id):
+        """
+        Forgets the history of a cube (e.g. because it was replaced as a whole).
+        """
+        with self._lock:
+            self._histories.pop(c_id)
+
+    def clear(self):
+        """
+        Forgets every history.
+        """
+        with self._lock:
+            self._histories.clear()
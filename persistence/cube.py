@@ -1,11 +1,69 @@
 """
-This module provides a series of functions to access and manipulate the cube data persisted.
+This module provides a series of functions to access and manipulate the cube data persisted. Cubes are stored in the
+backend picked in config/persistence.json (see persistence.backends).
+
+In write-behind mode, element updates are applied to the cached cube right away but only buffered for the backend, and
+written in bulk once enough of them pile up, every flush interval and on shutdown. Reads that go to the backend flush
+the pending updates of the cube read first, so they never see it older than what was already acknowledged.
+
+Every write to a cube increases its version by one (see get_version), buffered writes included, so clients can tell
+whether a cube changed without reading it, and the latest element updates are kept by version, so they can fetch only
+what changed since the version they have (see get_changes).
 """
 
-from bson import ObjectId
-from bson.errors import InvalidId
-from config.config import collection
-from data.cube import Cube
+import atexit
+import logging
+import os
+import time
+from threading import Lock, Thread
+from config.config import persistence_conf
+from metrics import timer
+from data.cube import Cube, instantiate_from_raw_data, query_cache
+from data.lru import LRUCache
+from persistence.backends import VersionMismatch, create_backend
+from persistence.changes import ChangeLog
+from persistence.write_behind import WriteBuffer
+
+_backend = create_backend(persistence_conf)
+
+# Dimension of the cubes seen so far, by id. A cube's dimension never changes, so this cache never goes stale; entries
+# are only dropped when cubes are deleted.
+_dimensions = {}
+
+# Version of the cubes seen so far, by id, counting the buffered updates. Kept coherent by every function of this module
+# that writes to database, like the cache of cubes below.
+_versions = {}
+
+# Hydrated cubes, by id. Kept coherent by every function of this module that writes to database.
+_cache_conf = persistence_conf.get('cache', {})
+_cubes = LRUCache(max_entries=_cache_conf.get('max_entries', 128), max_bytes=_cache_conf.get('max_bytes'),
+                  sizeof=lambda c: c.memory_size)
+
+query_cache.max_entries = persistence_conf.get('query_cache', {}).get('max_entries', query_cache.max_entries)
+
+# Writes to a cube and loads of that cube into the cache are serialized by one of these locks, so a load never puts
+# in the cache a cube older than the one in database.
+_locks = [Lock() for _ in range(64)]
+
+# Element updates not written to the backend yet, when in write-behind mode. At most flush_interval_ms worth of
+# acknowledged updates are lost if the process dies.
+_write_behind_conf = persistence_conf.get('write_behind', {})
+_write_behind = _write_behind_conf.get('enabled', False)
+_buffer = WriteBuffer(max_elements=_write_behind_conf.get('max_pending', 10000))
+_flush_interval = _write_behind_conf.get('flush_interval_ms', 1000) / 1000
+
+# Latest element updates of the cubes written by this process, by version.
+_change_feed_conf = persistence_conf.get('change_feed', {})
+_changes = ChangeLog(max_versions=_change_feed_conf.get('max_versions', 1000),
+                     max_cubes=_change_feed_conf.get('max_cubes', 1024))
+
+# Box adds (see add_range) with more elements than this aren't kept in the change feed.
+MAX_RANGE_ELEMENTS = 10000
+
+# Thread that flushes the buffer every flush interval, and pid of the process that started it.
+_flusher = None
+_flusher_pid = None
+_flusher_lock = Lock()
 
 
 def store(c):
@@ -20,9 +78,14 @@ def store(c):
         'cube': c.cube,
         'dimension': c.dimension
     }
+    document.update(_index_fields(c))
+
+    with timer('write'):
+        c_id = _backend.store(document)
+    _dimensions[c_id] = c.dimension
+    _versions[c_id] = 1
 
-    result = collection.insert_one(document)
-    return str(result.inserted_id)
+    return c_id
 
 
 def get(c_id):
@@ -31,16 +94,80 @@ def get(c_id):
     :param c_id: Identifier of the cube to be retrieved.
     :return: Cube if found or None otherwise.
     """
-    try:
-        cube_object_id = ObjectId(c_id)
-        cube = collection.find_one({'_id': cube_object_id})
+    with _lock_for(c_id):
+        _flush_cube(c_id)
 
-        if cube:
-            return _stringify_id(cube)
+        with timer('fetch'):
+            return _backend.get(c_id)
 
-        return None
-    except (TypeError, InvalidId):
-        raise TypeError('Invalid cube id.')
+
+def get_cube(c_id):
+    """
+    Retrieve a particular cube as a Cube instance. Cubes are cached, so only the first retrieval of a cube (or the
+    first one after it's evicted) goes to database.
+    :param c_id: Identifier of the cube to be retrieved.
+    :return: Cube if found or None otherwise. Cubes are shared, so they must not be modified.
+    """
+    cube = _cubes.get(c_id)
+    if cube is not None:
+        return cube
+
+    with _lock_for(c_id):
+        return _load_cube(c_id)
+
+
+def get_version(c_id):
+    """
+    Retrieves the version of a cube, which starts at 1 and increases by one with every write to the cube. Versions are
+    cached, so only the first retrieval of the version of a cube goes to database.
+    :param c_id: Identifier of the cube.
+    :return: Version of the cube if found or None otherwise.
+    """
+    version = _versions.get(c_id)
+    if version is not None:
+        return version
+
+    with _lock_for(c_id):
+        return _load_version(c_id)
+
+
+def get_changes(c_id, since):
+    """
+    Retrieves the elements of a cube updated after a given version, so a copy of the cube at that version can be
+    brought up to date. If those updates aren't known anymore (see ChangeLog), every element of the cube is returned
+    instead, and the copy must be replaced rather than updated.
+    :param c_id: Identifier of the cube.
+    :param since: Version of the cube the changes are relative to.
+    :return: Tuple (version, changes, full), with the current version of the cube, a dict whose keys are (x, y, z)
+    tuples and its values the elements set, and whether the changes are the whole cube. None if the cube isn't found.
+    """
+    with _lock_for(c_id):
+        version = _load_version(c_id)
+
+        if version is None:
+            return None
+
+        if since >= version:
+            return version, {}, False
+
+        changes = _changes.since(c_id, since)
+
+        if changes is not None:
+            return version, changes, False
+
+        cube = _cubes.peek(c_id) or _load_cube(c_id)
+
+        if cube is None:
+            return None
+
+        return version, {(x, y, z): value for x, y, z, value in cube.points()}, True
+
+
+def cache_stats():
+    """
+    :return: dict with the hits, misses, evictions and size of the cache of cubes.
+    """
+    return _cubes.stats()
 
 
 def get_all():
@@ -48,8 +175,19 @@ def get_all():
     Gets all cubes in databae.
     :return: List of documents that represent cubes.
     """
-    cubes = collection.find({})
-    return [_stringify_id(cube) for cube in cubes]
+    return list(iter_all())
+
+
+def iter_all(limit=None, after=None, ids_only=False):
+    """
+    Iterates over the cubes in database in id order, fetching them lazily from the backend.
+    :param limit: Maximum number of cubes to retrieve. None means no limit.
+    :param after: Identifier of a cube. If given, only cubes after it are retrieved.
+    :param ids_only: If True, only the id and dimension of every cube are retrieved.
+    :return: Generator of documents that represent cubes.
+    """
+    flush()
+    return _backend.get_all(limit=limit, after=after, ids_only=ids_only)
 
 
 def delete(c_id):
@@ -58,13 +196,15 @@ def delete(c_id):
     :param c_id: Identifier of the cube to be deleted.
     :return: True if deleted. False otherwise.
     """
-    try:
-        cube_object_id = ObjectId(c_id)
-        result = collection.delete_one({'_id': cube_object_id})
+    with _lock_for(c_id):
+        _buffer.take(c_id)
+        deleted = _backend.delete(c_id)
+        _dimensions.pop(c_id, None)
+        _versions.pop(c_id, None)
+        _changes.discard(c_id)
+        _cubes.pop(c_id)
 
-        return result.deleted_count == 1
-    except (TypeError, InvalidId):
-        raise TypeError('Invalid cube id.')
+    return deleted
 
 
 def delete_all():
@@ -72,8 +212,14 @@ def delete_all():
     Removes all cubes in database.
     :return Number of elements deleted.
     """
-    result = collection.delete_many({})
-    return result.deleted_count
+    _buffer.clear()
+    deleted = _backend.delete_all()
+    _dimensions.clear()
+    _versions.clear()
+    _changes.clear()
+    _cubes.clear()
+
+    return deleted
 
 
 def update(c_id, c):
@@ -85,27 +231,438 @@ def update(c_id, c):
     """
     assert isinstance(c_id, str), 'Cube identifier must be string instance.'
     assert isinstance(c, Cube), 'cube parameter must be of type Cube.'
-    try:
-        cube_object_id = ObjectId(c_id)
+    document = {'dimension': c.dimension, 'cube': c.cube}
+    document.update(_index_fields(c))  # Without an index, the persisted one (if any) is removed.
+
+    with _lock_for(c_id):
+        _, versions = _buffer.take(c_id)  # Pending updates of single elements are overwritten anyway.
+        updated = _backend.update(c_id, document, versions=versions + 1)
+        _cubes.pop(c_id)  # The input cube may be modified later on by its owner, so it's not cached.
+
+        if updated:
+            _bump_version(c_id)
+            _changes.discard(c_id)  # Elements may have been removed, which isn't an element update.
+
+    return updated
+
+
+def update_element(c_id, x, y, z, value, expected_versions=None):
+    """
+    Replaces a single element of a cube in place, with one atomic write that only touches that element. Concurrent
+    updates of different elements of the same cube never overwrite each other.
+    :param c_id: Identifier of the cube to be updated.
+    :param x: X coordinate. Must be between 1 and N, where N is the dimension of the cube.
+    :param y: Y coordinate. Must be between 1 and N, where N is the dimension of the cube.
+    :param z: Z coordinate. Must be between 1 and N, where N is the dimension of the cube.
+    :param value: Value to be set at the (X,Y,Z) point.
+    :param expected_versions: Versions the cube must be at to be updated (see update_elements). None means any version.
+    :return: True if the cube exists and was updated; False otherwise.
+    """
+    return update_elements(c_id, [(x, y, z, value)], expected_versions=expected_versions)
+
+
+def update_elements(c_id, elements, expected_versions=None):
+    """
+    Replaces a batch of elements of a cube in place, with one atomic write that only touches those elements. Elements
+    are applied in order, so if a point appears more than once the last value wins, just like with Cube.update. In
+    write-behind mode, the write is buffered instead (see flush).
+    :param c_id: Identifier of the cube to be updated.
+    :param elements: Iterable of (x, y, z, value) tuples.
+    :param expected_versions: Collection of versions the cube must be at to be updated, checked by the backend along
+    with the write (e.g. for optimistic concurrency), so conditional updates are never buffered. None means any
+    version.
+    :return: True if the cube exists and was updated; False otherwise.
+    :raise VersionMismatch: If the cube isn't at any of the expected versions.
+    """
+    assert isinstance(c_id, str), 'Cube identifier must be string instance.'
+    dimension = get_dimension(c_id)
+
+    if dimension is None:
+        return False
+
+    validator = Cube(dimension)
+    values = {}
+
+    for x, y, z, value in elements:
+        validator.validate_update(x, y, z, value)  # Same validation Cube.update performs.
+        values[(x, y, z)] = int(value)
+
+    full = False
+
+    with _lock_for(c_id):
+        if expected_versions is not None:
+            _flush_cube(c_id)  # The backend must be at the version clients see before checking it.
+
+            if not values:
+                metadata = get_metadata(c_id)
+
+                if metadata and metadata['version'] not in expected_versions:
+                    raise VersionMismatch(c_id, metadata['version'])
+
+                return metadata is not None
+
+            updated = _update_if_version(c_id, values, expected_versions)
+        elif not values:
+            return True
+        elif _write_behind:
+            full = _buffer.add(c_id, values)
+            updated = True
+        else:
+            with timer('write'):
+                updated = _backend.update_elements(c_id, values)
+
+        if updated:
+            _record_changes(c_id, values)
+
+        # Write through to the cached cube, if any.
+        cube = _cubes.peek(c_id)
+        if updated and cube is not None:
+            xs, ys, zs = zip(*values.keys())
+            cube.update_many(xs, ys, zs, values.values())
+            _cubes.resize(c_id)
+
+    if _write_behind:
+        _start_flusher()
+
+    if full:
+        flush()
+
+    return updated
+
+
+def add_range(c_id, x_init, x_end, y_init, y_end, z_init, z_end, delta):
+    """
+    Adds delta to every element of a box of a cube (see Cube.add_range). The box add itself is written to the backend
+    (see StorageBackend.add_range), rather than the new value of every element, and applied to the cached cube, if any.
+    In write-behind mode, buffered updates of the cube are written first, and the box add isn't buffered. Box adds of
+    up to MAX_RANGE_ELEMENTS elements are kept in the change feed, which needs the new values of the elements, so the
+    cube is read first unless cached; bigger ones are not.
+    :param c_id: Identifier of the cube to be updated.
+    :param x_init: Initial X coordinate.
+    :param x_end: Final X coordinate.
+    :param y_init: Initial Y coordinate.
+    :param y_end: Final Y coordinate.
+    :param z_init: Initial Z coordinate.
+    :param z_end: Final Z coordinate.
+    :param delta: Value to be added to every element.
+    :return: True if the cube exists and was updated; False otherwise.
+    """
+    assert isinstance(c_id, str), 'Cube identifier must be string instance.'
+    dimension = get_dimension(c_id)
+
+    if dimension is None:
+        return False
+
+    box = (x_init, x_end, y_init, y_end, z_init, z_end)
+    Cube(dimension).validate_add_range(*box, delta)  # Same validation Cube.add_range performs.
+    box, delta = tuple(int(limit) for limit in box), int(delta)
+    small = (box[1] - box[0] + 1) * (box[3] - box[2] + 1) * (box[5] - box[4] + 1) <= MAX_RANGE_ELEMENTS
+
+    with _lock_for(c_id):
+        _flush_cube(c_id)
+        cube = _cubes.peek(c_id) or (_load_cube(c_id) if small else None)
+
+        try:
+            with timer('write'):
+                updated = _backend.add_range(c_id, *box, delta)
+        except Exception:
+            _cubes.pop(c_id)  # The box may have been written in part.
+            raise
+
+        if not updated:
+            _cubes.pop(c_id)  # Deleted meanwhile.
+            return False
+
+        if cube is not None:
+            cube.add_range(*box, delta)
+            _cubes.resize(c_id)
+
+        if cube is not None and small:
+            _record_changes(c_id, {(x, y, z): value for x, y, z, value in cube.box_points(*box)})
+        else:
+            _bump_version(c_id)
+            _changes.discard(c_id)  # Too many elements to be kept.
+
+    return True
+
+
+def flush():
+    """
+    Writes every buffered element update to the backend, one write per cube. Does nothing unless in write-behind mode.
+    :return: Number of elements written.
+    """
+    written = 0
+
+    for c_id in _buffer.ids():
+        with _lock_for(c_id):
+            written += _flush_cube(c_id)
+
+    return written
+
+
+def get_dimension(c_id):
+    """
+    Retrieves the dimension of a cube, going to database only the first time the cube is seen.
+    :param c_id: Identifier of the cube.
+    :return: Dimension of the cube if found or None otherwise.
+    """
+    if c_id in _dimensions:
+        return _dimensions[c_id]
+
+    metadata = get_metadata(c_id)
+
+    if metadata:
+        _dimensions[c_id] = metadata['dimension']
+        return metadata['dimension']
+
+    return None
 
-        query = {'_id': cube_object_id}
-        updates = {'$set': {'dimension': c.dimension, 'cube': c.cube}}
 
-        result = collection.update_one(query, updates)
+def get_metadata(c_id):
+    """
+    Retrieve a particular cube without its elements.
+    :param c_id: Identifier of the cube to be retrieved.
+    :return: Cube document without the "cube" field if found or None otherwise.
+    """
+    with timer('fetch'):
+        return _backend.get_metadata(c_id)
+
+
+def get_slabs(c_id, x_init, x_end):
+    """
+    Retrieve a particular cube, but only with its elements whose X coordinate falls between x_init and x_end.
+    :param c_id: Identifier of the cube to be retrieved.
+    :param x_init: Initial X coordinate.
+    :param x_end: Final X coordinate.
+    :return: Cube document if found or None otherwise.
+    """
+    with timer('fetch'):
+        return _backend.get_slabs(c_id, x_init, x_end)
+
+
+def get_cube_range(c_id, x_init, x_end):
+    """
+    Retrieve a particular cube as a Cube instance, or at least the part of it with its elements whose X coordinate falls
+    between x_init and x_end. If the cube is cached, that's the one returned; otherwise, only the elements in that range
+    are read from database and the partial cube returned is not cached.
+    :param c_id: Identifier of the cube to be retrieved.
+    :param x_init: Initial X coordinate.
+    :param x_end: Final X coordinate.
+    :return: Cube if found or None otherwise. Cubes may be shared, so they must not be modified.
+    """
+    cube = _cubes.get(c_id)
+    if cube is not None:
+        return cube
+
+    dimension = get_dimension(c_id)
+
+    if dimension is None:
+        return None
+
+    if x_init <= 1 and x_end >= dimension:
+        return get_cube(c_id)  # Every slab is needed anyway.
+
+    with _lock_for(c_id):
+        _flush_cube(c_id)
+
+    raw_cube = get_slabs(c_id, x_init, x_end)
+
+    if not raw_cube:
+        return None
 
-        return result.modified_count == 1
-    except (TypeError, InvalidId):
-        raise TypeError('Invalid cube id.')
+    with timer('hydrate'):
+        return instantiate_from_raw_data(raw_cube, engine=persistence_conf.get('engine'))
 
 
 # ===============================
 # Private helper functions.
 # ===============================
-def _stringify_id(cube_document):
+def _lock_for(c_id):
+    """
+    :return: Lock that serializes writes and cache loads of the given cube.
+    """
+    return _locks[hash(c_id) % len(_locks)]
+
+
+def _load_version(c_id):
+    """
+    Reads the version of a cube from the backend, adds its buffered updates and caches it. The lock of the cube must be
+    held.
+    :return: Version of the cube if found or None otherwise.
+    """
+    if c_id in _versions:
+        return _versions[c_id]
+
+    metadata = get_metadata(c_id)
+
+    if not metadata:
+        return None
+
+    _dimensions[c_id] = metadata['dimension']
+    _versions[c_id] = metadata['version'] + _buffer.versions(c_id)
+
+    return _versions[c_id]
+
+
+def _bump_version(c_id):
+    """
+    Increases the cached version of a cube, if any, after a write to it. The lock of the cube must be held.
+    :return: New version of the cube if cached or None otherwise.
+    """
+    if c_id in _versions:
+        _versions[c_id] += 1
+        return _versions[c_id]
+
+    return None
+
+
+def _update_if_version(c_id, values, expected_versions):
+    """
+    Writes element updates of a cube straight to the backend, only if the cube is at one of the expected versions
+    there. If the backend shows the cached version was stale (i.e. the cube was written by another process), what's
+    cached about the cube is dropped. The lock of the cube must be held, and its buffered updates flushed.
+    :return: True if the cube exists and was updated; False otherwise.
+    :raise VersionMismatch: If the cube isn't at any of the expected versions.
+    """
+    cached = _versions.get(c_id)
+
+    try:
+        with timer('write'):
+            updated = _backend.update_elements(c_id, values, expected_versions=expected_versions)
+    except VersionMismatch as e:
+        if cached is not None and cached != e.version:
+            _forget(c_id)
+        raise
+
+    if updated and cached is not None and cached not in expected_versions:
+        _forget(c_id)
+
+    return updated
+
+
+def _forget(c_id):
     """
-    Converts a cube id into a string and returns the same cube.
-    :param cube_document: Cube document to be processed.
-    :return: Cube document with its '_id' field converted into string.
+    Drops the cached version, change history and cube of a cube. The lock of the cube must be held.
     """
-    cube_document['_id'] = str(cube_document['_id'])
-    return cube_document
+    _versions.pop(c_id, None)
+    _changes.discard(c_id)
+    _cubes.pop(c_id)
+
+
+def _record_changes(c_id, values):
+    """
+    Increases the version of a cube after an update of some of its elements, and records them in the change log. The
+    lock of the cube must be held.
+    """
+    version = _bump_version(c_id)
+
+    if version is not None:
+        _changes.add(c_id, version, values)
+    else:
+        _changes.discard(c_id)  # Its history can't be told apart from the next one.
+
+
+def _load_cube(c_id):
+    """
+    Reads a cube from the backend, after flushing its buffered updates, and caches it. The lock of the cube must be
+    held.
+    :return: Cube if found or None otherwise.
+    """
+    _flush_cube(c_id)
+
+    with timer('fetch'):
+        raw_cube = _backend.get(c_id)
+
+    if not raw_cube:
+        return None
+
+    with timer('hydrate'):
+        cube = instantiate_from_raw_data(raw_cube, engine=persistence_conf.get('engine'))
+
+    # Element writes drop the persisted index, so it's built again here and persisted for the next process to load.
+    if persistence_conf.get('persist_index') and 'index' not in raw_cube:
+        _persist_index(c_id, cube, raw_cube.get('version', 0))
+
+    _cubes.put(c_id, cube)
+    _dimensions[c_id] = cube.dimension
+
+    return cube
+
+
+def _flush_cube(c_id):
+    """
+    Writes the buffered element updates of a cube to the backend. The lock of the cube must be held.
+    :return: Number of elements written.
+    """
+    values, versions = _buffer.take(c_id)
+
+    if not values:
+        return 0
+
+    try:
+        # If the cube was deleted meanwhile, its updates are dropped.
+        _backend.update_elements(c_id, values, versions=versions)
+    except Exception:
+        _buffer.restore(c_id, values, versions)
+        raise
+
+    return len(values)
+
+
+def _start_flusher():
+    """
+    Starts the thread that flushes the buffered updates every flush interval, unless it's running in this process.
+    Buffered updates are flushed on shutdown as well.
+    """
+    global _flusher, _flusher_pid
+
+    with _flusher_lock:
+        if _flusher is not None and _flusher_pid == os.getpid():
+            return
+
+        if _flusher is None:
+            atexit.register(flush)
+
+        _flusher = Thread(target=_flush_periodically, name='write-behind-flusher', daemon=True)
+        _flusher_pid = os.getpid()
+        _flusher.start()
+
+
+def _flush_periodically():
+    """
+    Body of the flusher thread. Failed flushes are logged and retried on the next interval.
+    """
+    while True:
+        time.sleep(_flush_interval)
+
+        try:
+            flush()
+        except Exception:
+            logging.getLogger(__name__).exception('Flushing buffered cube updates failed')
+
+
+def _index_fields(c):
+    """
+    Builds the fields to persist the index of a cube, if it has one and indexes must be persisted.
+    :param c: Cube to be persisted.
+    :return: dict with the fields to be set in the cube document. Empty if there's no index to persist.
+    """
+    if not persistence_conf.get('persist_index'):
+        return {}
+
+    index = c.export_index()
+    return {'index': index} if index is not None else {}
+
+
+def _persist_index(c_id, c, version):
+    """
+    Builds the index of a cube and persists it, unless the cube changed since it was read or its engine keeps no index.
+    :param c: Cube read from the backend.
+    :param version: Version of the cube read.
+    """
+    with timer('hydrate'):
+        index = c.export_index(build=True)
+
+    if index is not None:
+        with timer('write'):
+            _backend.store_index(c_id, index, version)
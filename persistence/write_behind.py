@@ -0,0 +1,97 @@
+"""
+Buffer of element updates not yet written to the storage backend, used by the write-behind mode of persistence.cube.
+"""
+
+from threading import Lock
+
+
+class WriteBuffer:
+    """
+    Pending element updates, by cube. Updates of the same element are coalesced: the last value wins, just like with
+    Cube.update, so each element is written once per flush no matter how many times it was updated. The number of
+    updates (i.e. calls to add) is kept as well, since every one of them is a new version of the cube.
+    """
+
+    def __init__(self, max_elements=10000):
+        """
+        Creates a new buffer.
+        :param max_elements: Number of pending elements (counting every cube) from which the buffer is full.
+        :return: New WriteBuffer instance.
+        """
+        self.max_elements = max_elements
+        self._pending = {}
+        self._versions = {}
+        self._size = 0
+        self._lock = Lock()
+
+    def add(self, c_id, values):
+        """
+        Adds updates of a cube.
+        :param c_id: Identifier of the cube.
+        :param values: dict whose keys are (x, y, z) tuples and its values the elements to be set.
+        :return: True if the buffer is full after adding them, i.e. it must be flushed; False otherwise.
+        """
+        with self._lock:
+            pending = self._pending.setdefault(c_id, {})
+            before = len(pending)
+            pending.update(values)
+            self._size += len(pending) - before
+            self._versions[c_id] = self._versions.get(c_id, 0) + 1
+
+            return self._size >= self.max_elements
+
+    def take(self, c_id):
+        """
+        Removes the pending updates of a cube from the buffer.
+        :return: Tuple (values, versions), with a dict with the pending updates, as given to add, and the number of
+        updates. Empty and 0 if there are none.
+        """
+        with self._lock:
+            pending = self._pending.pop(c_id, {})
+            self._size -= len(pending)
+
+            return pending, self._versions.pop(c_id, 0)
+
+    def versions(self, c_id):
+        """
+        :return: Number of pending updates of a cube.
+        """
+        with self._lock:
+            return self._versions.get(c_id, 0)
+
+    def restore(self, c_id, values, versions):
+        """
+        Puts back updates taken from the buffer (e.g. because writing them failed). Updates added in the meantime win.
+        """
+        with self._lock:
+            self._versions[c_id] = self._versions.get(c_id, 0) + versions
+
+            pending = self._pending.setdefault(c_id, {})
+            before = len(pending)
+
+            for point, value in values.items():
+                pending.setdefault(point, value)
+
+            self._size += len(pending) - before
+
+    def clear(self):
+        """
+        Drops every pending update.
+        """
+        with self._lock:
+            self._pending.clear()
+            self._versions.clear()
+            self._size = 0
+
+    def ids(self):
+        """
+        :return: List with the identifiers of the cubes with pending updates.
+        """
+        with self._lock:
+            return list(self._pending)
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, c_id):
+        return c_id in self._pending
@@ -1,6 +1,7 @@
 from nose.tools import *
 import json
 from tests import test_app
+import persistence.cube as cube_persistence
 from persistence.cube import *
 
 
@@ -83,6 +84,80 @@ def test_update_cube():
     eq_(cube['cube']['1']['2']['3'], 42)
 
 
+@with_setup(teardown=teardown_func)
+def test_update_cube_elements():
+    """
+    Tests batch cube updates through API, both with JSON and NDJSON bodies
+    """
+    cube_id = store(Cube(dimension=4))
+
+    # Same point twice: last value wins.
+    request_body = [{'x': 1, 'y': 2, 'z': 3, 'value': 42},
+                    {'x': 4, 'y': 4, 'z': 4, 'value': 7},
+                    {'x': 1, 'y': 2, 'z': 3, 'value': 43}]
+    response = test_app.post('/cubes/%s/updates' % cube_id, data=json.dumps(request_body),
+                             content_type='application/json')
+
+    _check_content_type(response)
+    _check_status_code(response)
+    eq_(_decode_response(response)['data'], 3)
+
+    cube = get(cube_id)
+    eq_(cube['cube'], {'1': {'2': {'3': 43}}, '4': {'4': {'4': 7}}})
+
+    # Now as NDJSON
+    request_body = '\n'.join(json.dumps({'x': 2, 'y': 2, 'z': i, 'value': i}) for i in range(1, 5))
+    response = test_app.post('/cubes/%s/updates' % cube_id, data=request_body, content_type='application/x-ndjson')
+
+    _check_status_code(response)
+    cube = get(cube_id)
+    eq_(cube['cube']['2']['2'], {'1': 1, '2': 2, '3': 3, '4': 4})
+
+    # Malformed elements are rejected.
+    response = test_app.post('/cubes/%s/updates' % cube_id, data=json.dumps([{'x': 1}]),
+                             content_type='application/json')
+    _check_status_code(response, 400)
+
+
+@with_setup(teardown=teardown_func)
+def test_add_to_cube_range():
+    """
+    Tests box adds through API
+    """
+    cube_id = store(Cube(dimension=4))
+
+    # Missing limits default to the whole axis.
+    request_body = {'x1': 2, 'x2': 3, 'y2': 1, 'z1': 4, 'delta': 5}
+    response = test_app.patch('/cubes/%s' % cube_id, data=json.dumps(request_body), content_type='application/json')
+
+    _check_content_type(response)
+    _check_status_code(response)
+    eq_(_decode_response(response)['data'], 2)
+
+    cube = get(cube_id)
+    eq_(cube['cube'], {'2': {'1': {'4': 5}}, '3': {'1': {'4': 5}}})
+
+    # Bodies without a delta or with unknown fields are rejected.
+    response = test_app.patch('/cubes/%s' % cube_id, data=json.dumps({'x1': 1}), content_type='application/json')
+    _check_status_code(response, 400)
+    response = test_app.patch('/cubes/%s' % cube_id, data=json.dumps({'x': 1, 'delta': 1}),
+                              content_type='application/json')
+    _check_status_code(response, 400)
+
+    # A limit of 0 is out of range rather than missing, and inverted boxes or non-integer deltas are invalid too.
+    for request_body in [{'x1': 0, 'x2': 0, 'delta': 5}, {'x1': 3, 'x2': 2, 'delta': 5}, {'delta': 1.5},
+                         {'y1': '1', 'delta': 5}]:
+        response = test_app.patch('/cubes/%s' % cube_id, data=json.dumps(request_body),
+                                  content_type='application/json')
+        _check_status_code(response, 400)
+
+    eq_(get(cube_id)['cube'], {'2': {'1': {'4': 5}}, '3': {'1': {'4': 5}}})
+
+    response = test_app.patch('/cubes/575cf0a57d09db2bf185dea9', data=json.dumps({'delta': 1}),
+                              content_type='application/json')
+    _check_status_code(response, 404)
+
+
 @with_setup(teardown=teardown_func)
 def test_list_all_cubes():
     """
@@ -107,6 +182,39 @@ def test_list_all_cubes():
     eq_(cubes_ids, set([c['_id'] for c in data]))  # Ids must match.
 
 
+@with_setup(teardown=teardown_func)
+def test_list_cubes_paginated():
+    """
+    Tests cube pagination and streaming through API
+    """
+    delete_all()
+    cubes_ids = [store(Cube(dimension=i + 1)) for i in range(5)]
+
+    # First page
+    response = test_app.get('/cubes?limit=3&fields=ids')
+    _check_status_code(response)
+    payload = _decode_response(response)
+    eq_([c['_id'] for c in payload['data']], cubes_ids[:3])
+    assert all('cube' not in c for c in payload['data'])
+
+    # Second (and last) page
+    response = test_app.get('/cubes?limit=3&after=%s' % payload['next'])
+    payload = _decode_response(response)
+    eq_([c['_id'] for c in payload['data']], cubes_ids[3:])
+    assert 'next' not in payload
+
+    # Whole collection, streamed.
+    response = test_app.get('/cubes', headers={'Accept': 'application/x-ndjson'})
+    _check_status_code(response)
+    _check_content_type(response, 'application/x-ndjson')
+    lines = response.data.decode('utf8').splitlines()
+    eq_([json.loads(line)['_id'] for line in lines], cubes_ids)
+
+    # Invalid ids to start after are rejected, streamed or not.
+    _check_status_code(test_app.get('/cubes?after=zzz'), 400)
+    _check_status_code(test_app.get('/cubes?after=zzz&format=ndjson'), 400)
+
+
 @with_setup(teardown=teardown_func)
 def test_get_cube():
     """
@@ -127,6 +235,64 @@ def test_get_cube():
     assert 'params' not in data and 'result' not in data
 
 
+@with_setup(teardown=teardown_func)
+def test_conditional_get_cube():
+    """
+    Tests cube retrieval and update through API conditional on the version of the cube
+    """
+    cube_id = store(Cube(4))
+
+    response = test_app.get('/cubes/%s' % cube_id)
+    _check_status_code(response)
+    eq_(response.headers['ETag'], '"1"')
+
+    # Not modified, be it the whole cube or a summation over it.
+    for url in ['/cubes/%s', '/cubes/%s?x1=2']:
+        response = test_app.get(url % cube_id, headers={'If-None-Match': '"1"'})
+        _check_status_code(response, 304)
+        eq_(response.headers['ETag'], '"1"')
+        eq_(response.data, b'')
+
+    # Updates only go ahead if the cube is still at the version given.
+    body = json.dumps({'x': 1, 'y': 1, 'z': 1, 'value': 3})
+    response = test_app.put('/cubes/%s' % cube_id, data=body, content_type='application/json',
+                            headers={'If-Match': '"1"'})
+    _check_status_code(response)
+
+    response = test_app.put('/cubes/%s' % cube_id, data=body, content_type='application/json',
+                            headers={'If-Match': '"1"'})
+    _check_status_code(response, 412)
+    eq_(response.headers['ETag'], '"2"')
+
+    response = test_app.get('/cubes/%s?x1=1&x2=1' % cube_id, headers={'If-None-Match': '"1"'})
+    _check_status_code(response)
+    eq_(response.headers['ETag'], '"2"')
+    eq_(_decode_response(response)['data']['result'], 3)
+
+    response = test_app.get('/cubes/575cf0a57d09db2bf185dea9', headers={'If-None-Match': '*'})
+    _check_status_code(response, 404)
+
+
+@with_setup(teardown=teardown_func)
+def test_cube_changes():
+    """
+    Tests retrieval of the elements of a cube updated since a version through API
+    """
+    cube_id = store(Cube(4))
+    update_element(cube_id, 2, 2, 2, 4)
+    update_elements(cube_id, [(1, 1, 1, 1), (2, 2, 2, 0)])
+
+    response = test_app.get('/cubes/%s/changes?since=2' % cube_id)
+    _check_status_code(response)
+    _check_content_type(response)
+    eq_(response.headers['ETag'], '"3"')
+    eq_(_decode_response(response)['data'], {'_id': cube_id, 'since': 2, 'version': 3, 'full': False,
+                                             'changes': [[1, 1, 1, 1], [2, 2, 2, 0]]})
+
+    _check_status_code(test_app.get('/cubes/%s/changes' % cube_id), 400)
+    _check_status_code(test_app.get('/cubes/575cf0a57d09db2bf185dea9/changes?since=1'), 404)
+
+
 @with_setup(teardown=teardown_func)
 def test_query_cube():
     """
@@ -157,6 +323,116 @@ def test_query_cube():
     eq_(parameters['z2'], 4)
     eq_(data['result'], 4)
 
+    # The raw cube only has the slabs within [x1, x2].
+    eq_(data['cube'], {'2': {'2': {'2': 4}}})
+    response = test_app.get('/cubes/%s?x1=3' % cube_id)
+    eq_(_decode_response(response)['data']['cube'], {})
+
+
+@with_setup(teardown=teardown_func)
+def test_query_cube_many():
+    """
+    Tests batch cube querying through API
+    """
+    # Create cube
+    cube = Cube(4)
+    cube.update(2, 2, 2, 4)
+    cube.update(4, 4, 4, 1)
+    cube_id = store(cube)
+
+    request_body = [[1, 4, 1, 4, 1, 4], [1, 3, 1, 3, 1, 3], {'x1': 3}, {}]
+    response = test_app.post('/cubes/%s/queries' % cube_id, data=json.dumps(request_body),
+                             content_type='application/json')
+
+    _check_status_code(response)
+    _check_content_type(response)
+
+    data = _decode_response(response)['data']
+
+    # One result per box, in input order.
+    eq_([d['result'] for d in data], [5, 4, 1, 5])
+    eq_(data[2]['params'], {'x1': 3, 'x2': 4, 'y1': 1, 'y2': 4, 'z1': 1, 'z2': 4})
+
+    # A limit of 0 is out of range rather than missing, and inverted boxes are invalid too.
+    for box in [{'x1': 0, 'x2': 0}, {'x1': 3, 'x2': 2}, [1, 4, 3, 2, 1, 4], {'x1': 1.5}]:
+        response = test_app.post('/cubes/%s/queries' % cube_id, data=json.dumps([{}, box]),
+                                 content_type='application/json')
+        _check_status_code(response, 400)
+        assert _decode_response(response)['message'].startswith('Bad Request. Box 1')
+
+
+@with_setup(teardown=teardown_func)
+def test_export_import_cube():
+    """
+    Tests moving a cube through its binary snapshot
+    """
+    # Create cube
+    cube = Cube(4)
+    cube.update(2, 2, 2, 4)
+    cube.update(4, 4, 4, 1)
+    cube_id = store(cube)
+
+    response = test_app.get('/cubes/%s/snapshot' % cube_id)
+    _check_status_code(response)
+    _check_content_type(response, 'application/vnd.cube-snapshot')
+
+    # Import it back as a new cube.
+    response = test_app.post('/cubes/import', data=response.data, content_type='application/octet-stream')
+    _check_status_code(response)
+
+    imported_id = _decode_response(response)['data']
+    assert imported_id != cube_id
+    eq_(get_cube(imported_id).cube, cube.cube)
+
+    # Garbage is rejected.
+    response = test_app.post('/cubes/import', data=b'not a cube', content_type='application/octet-stream')
+    _check_status_code(response, 400)
+
+
+@with_setup(teardown=teardown_func)
+def test_metrics():
+    """
+    Tests the metrics exposed through API
+    """
+    cube = Cube(4)
+    cube.update(2, 2, 2, 4)
+    cube_id = store(cube)
+
+    test_app.get('/cubes/%s?x1=2' % cube_id)
+
+    response = test_app.get('/metrics')
+    _check_status_code(response)
+    _check_content_type(response, 'text/plain; version=0.0.4; charset=utf-8')
+
+    text = response.data.decode('utf8')
+    assert 'cubes_request_seconds_count{route="/cubes/<cube_id>",method="GET",status="200"}' in text
+    assert 'cubes_phase_seconds_count{route="/cubes/<cube_id>",phase="compute"}' in text
+    assert 'cubes_query_cells_scanned_count{engine="sparse"}' in text
+    assert 'cubes_cache{cache="cubes",stat="hits"}' in text
+
+
+@with_setup(teardown=teardown_func)
+def test_flush():
+    """
+    Tests writing buffered updates through API
+    """
+    cube_persistence._write_behind = True
+    try:
+        cube_id = store(Cube(dimension=4))
+        update_element(cube_id, 1, 2, 3, 7)
+        update_element(cube_id, 1, 2, 3, 8)
+
+        response = test_app.post('/cubes/flush')
+        _check_status_code(response)
+        _check_content_type(response)
+        eq_(_decode_response(response)['data'], 1)
+
+        # Nothing left to write.
+        eq_(_decode_response(test_app.post('/cubes/flush'))['data'], 0)
+        eq_(cube_persistence._backend.get(cube_id)['cube'], {'1': {'2': {'3': 8}}})
+    finally:
+        cube_persistence._write_behind = False
+
 
 def test_delete_one():
     """
@@ -0,0 +1,184 @@
+import asyncio
+import json
+from unittest import SkipTest
+from nose.tools import *
+import metrics
+from data.cube import Cube
+from persistence.cube import delete_all, store
+
+try:
+    from aiohttp.test_utils import TestClient, TestServer
+    from async_application import create_app
+except ImportError:
+    create_app = None
+
+
+def teardown_func():
+    """
+    Flushes database
+    """
+    delete_all()
+
+
+def _run(test):
+    """
+    Runs a coroutine function that takes an aiohttp test client against the asynchronous API.
+    """
+    if create_app is None:
+        raise SkipTest('aiohttp is not installed')
+
+    async def run():
+        async with TestClient(TestServer(create_app())) as client:
+            await test(client)
+
+    asyncio.run(run())
+
+
+@with_setup(teardown=teardown_func)
+def test_create_update_and_query_cube():
+    """
+    Tests cube creation, updates, queries, versions and box adds through the asynchronous API.
+    """
+    async def test(client):
+        response = await client.post('/cubes', json={'dimension': 4})
+        eq_(response.status, 200)
+        cube_id = (await response.json())['data']
+
+        response = await client.put('/cubes/%s' % cube_id, json={'x': 2, 'y': 2, 'z': 2, 'value': 4})
+        eq_(response.status, 200)
+
+        response = await client.post('/cubes/%s/updates' % cube_id, data='{"x": 4, "y": 4, "z": 4, "value": 1}\n',
+                                     headers={'Content-Type': 'application/x-ndjson'})
+        eq_((await response.json())['data'], 1)
+
+        response = await client.get('/cubes/%s?x1=2' % cube_id)
+        data = (await response.json())['data']
+        eq_(data['result'], 5)
+        eq_(data['params'], {'x1': 2, 'x2': 4, 'y1': 1, 'y2': 4, 'z1': 1, 'z2': 4})
+
+        response = await client.post('/cubes/%s/queries' % cube_id, json=[[1, 2, 1, 2, 1, 2], {'x1': 3}])
+        eq_([d['result'] for d in (await response.json())['data']], [4, 1])
+
+        response = await client.post('/cubes/%s/queries' % cube_id, json=[{'x1': 0, 'x2': 0}])
+        eq_(response.status, 400)
+
+        response = await client.get('/cubes/%s' % cube_id)
+        eq_((await response.json())['data']['cube'], {'2': {'2': {'2': 4}}, '4': {'4': {'4': 1}}})
+        eq_(response.headers['ETag'], '"3"')
+
+        response = await client.get('/cubes/%s?x1=2' % cube_id, headers={'If-None-Match': '"3"'})
+        eq_(response.status, 304)
+
+        response = await client.put('/cubes/%s' % cube_id, json={'x': 1, 'y': 1, 'z': 1, 'value': 1},
+                                    headers={'If-Match': '"2"'})
+        eq_(response.status, 412)
+
+        response = await client.get('/cubes/%s/changes?since=2' % cube_id)
+        eq_((await response.json())['data']['changes'], [[4, 4, 4, 1]])
+
+        response = await client.patch('/cubes/%s' % cube_id, json={'x1': 4, 'y1': 4, 'z1': 3, 'delta': 2})
+        eq_((await response.json())['data'], 2)
+
+        response = await client.get('/cubes/%s?x1=4' % cube_id)
+        eq_((await response.json())['data']['result'], 5)
+
+        response = await client.patch('/cubes/%s' % cube_id, json={'x1': 4})
+        eq_(response.status, 400)
+
+        response = await client.patch('/cubes/%s' % cube_id, json={'x1': 0, 'x2': 0, 'delta': 5})
+        eq_(response.status, 400)
+
+    _run(test)
+
+
+@with_setup(teardown=teardown_func)
+def test_list_and_delete_cubes():
+    """
+    Tests cube listing, flushing and removal through the asynchronous API.
+    """
+    for i in range(3):
+        store(Cube(i + 1))
+
+    async def test(client):
+        response = await client.get('/cubes?limit=2&fields=ids')
+        body = await response.json()
+        eq_(len(body['data']), 2)
+        eq_(body['next'], body['data'][-1]['_id'])
+
+        response = await client.get('/cubes?after=zzz')
+        eq_(response.status, 400)
+
+        response = await client.get('/cubes?format=ndjson')
+        eq_(response.headers['Content-Type'], 'application/x-ndjson')
+        eq_(len([json.loads(line) for line in (await response.text()).splitlines()]), 3)
+
+        response = await client.get('/cubes/575cf0a57d09db2bf185dea9')
+        eq_(response.status, 404)
+
+        response = await client.get('/cubes/not-an-id')
+        eq_(response.status, 500)
+
+        response = await client.post('/cubes/flush')
+        eq_((await response.json())['data'], 0)
+
+        response = await client.delete('/cubes')
+        eq_((await response.json())['message'], '3 cubes were removed.')
+
+    _run(test)
+
+
+@with_setup(teardown=teardown_func)
+def test_export_import_cube():
+    """
+    Tests that a snapshot exported through the asynchronous API is imported back as a new cube.
+    """
+    cube = Cube(3)
+    cube.update(1, 2, 3, 7)
+    cube_id = store(cube)
+
+    async def test(client):
+        response = await client.get('/cubes/%s/snapshot' % cube_id)
+        eq_(response.status, 200)
+
+        response = await client.post('/cubes/import', data=await response.read())
+        imported_id = (await response.json())['data']
+
+        response = await client.get('/cubes/%s?z1=3' % imported_id)
+        eq_((await response.json())['data']['result'], 7)
+
+    _run(test)
+
+
+@with_setup(teardown=teardown_func)
+def test_metrics():
+    """
+    Tests that requests to the asynchronous API are counted in the metrics, phase by phase.
+    """
+    cube_id = store(Cube(3))
+    requests = metrics.requests.count(('/cubes/{cube_id}', 'GET', '200'))
+    computations = metrics.phases.count(('/cubes/{cube_id}', 'compute'))
+
+    async def test(client):
+        await client.get('/cubes/%s?x1=2' % cube_id)
+
+        response = await client.get('/metrics')
+        eq_(response.status, 200)
+        text = await response.text()
+
+        assert 'cubes_request_seconds_count{route="/cubes/{cube_id}",method="GET",status="200"} %d' % (requests + 1) \
+            in text
+        assert 'cubes_phase_seconds_count{route="/cubes/{cube_id}",phase="compute"} %d' % (computations + 1) in text
+
+    _run(test)
+
+
+def test_profile_disabled():
+    """
+    Tests that the profiler endpoint is not found unless enabled.
+    """
+    async def test(client):
+        # The profiler is disabled in config/server.json.
+        response = await client.get('/debug/profile')
+        eq_(response.status, 404)
+
+    _run(test)
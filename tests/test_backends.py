@@ -0,0 +1,307 @@
+import os
+import sqlite3
+import tempfile
+from nose.tools import *
+import persistence.backends as backends
+from config.config import persistence_conf
+from persistence.backends import LogBackend, MemoryBackend, MongoBackend, MongoSlabBackend, SQLiteBackend, \
+    VersionMismatch
+
+
+def _check_backend(backend):
+    """
+    Runs the behaviors every backend shares against the given one.
+    """
+    document = {'dimension': 4, 'cube': {'1': {'1': {'1': 5}}, '3': {'2': {'4': -2}}}, 'index': b'\x01\x02'}
+    c_id = backend.store(document)
+
+    # Stored documents don't share anything with the input one.
+    document['cube']['1']['1']['1'] = 100
+
+    cube = backend.get(c_id)
+    eq_(cube['_id'], c_id)
+    eq_(cube['dimension'], 4)
+    eq_(cube['cube'], {'1': {'1': {'1': 5}}, '3': {'2': {'4': -2}}})
+    eq_(cube['index'], b'\x01\x02')
+    eq_(cube['version'], 1)
+
+    eq_(backend.get_metadata(c_id), {'_id': c_id, 'dimension': 4, 'version': 1})
+    eq_(backend.get_slabs(c_id, 2, 4)['cube'], {'3': {'2': {'4': -2}}})
+    eq_(backend.get_slabs(c_id, 2, 2)['cube'], {})
+
+    # Updating elements drops the index.
+    ok_(backend.update_elements(c_id, {(1, 1, 1): 7, (2, 2, 2): 1}))
+    cube = backend.get(c_id)
+    eq_(cube['cube'], {'1': {'1': {'1': 7}}, '2': {'2': {'2': 1}}, '3': {'2': {'4': -2}}})
+    ok_('index' not in cube)
+    eq_(cube['version'], 2)
+
+    # Writes increase the version by the amount given.
+    ok_(backend.update(c_id, {'dimension': 4, 'cube': {'4': {'4': {'4': 9}}}}, versions=3))
+    eq_(backend.get(c_id)['cube'], {'4': {'4': {'4': 9}}})
+    eq_(backend.get_metadata(c_id)['version'], 5)
+    ok_(backend.update_elements(c_id, {(1, 1, 1): 1}, versions=2))
+    eq_(backend.get_slabs(c_id, 1, 1)['version'], 7)
+
+    # Conditional updates only write if the cube is at one of the expected versions.
+    with assert_raises(VersionMismatch) as context:
+        backend.update_elements(c_id, {(1, 1, 1): 3}, expected_versions={1, 6})
+    eq_(context.exception.version, 7)
+    ok_(backend.update_elements(c_id, {(1, 1, 1): 3}, expected_versions={6, 7}))
+    eq_(backend.get_slabs(c_id, 1, 1), {'_id': c_id, 'dimension': 4, 'version': 8, 'cube': {'1': {'1': {'1': 3}}}})
+
+    # Box adds increase every element of the box, set or not, as a single new version.
+    ok_(backend.add_range(c_id, 1, 2, 1, 1, 1, 1, 2))
+    eq_(backend.get_slabs(c_id, 1, 3), {'_id': c_id, 'dimension': 4, 'version': 9,
+                                        'cube': {'1': {'1': {'1': 5}}, '2': {'1': {'1': 2}}}})
+
+    # Indexes are stored without a new version, unless the cube changed since the version they were built from.
+    ok_(not backend.store_index(c_id, b'\x03', 8))
+    ok_(backend.store_index(c_id, b'\x03', 9))
+    cube = backend.get(c_id)
+    eq_((bytes(cube['index']), cube['version']), (b'\x03', 9))
+
+    # Listing, in id order.
+    other_id = backend.store({'dimension': 2, 'cube': {}})
+    eq_([c['_id'] for c in backend.get_all()], sorted([c_id, other_id]))
+    eq_(len(list(backend.get_all(limit=1))), 1)
+    eq_([c['_id'] for c in backend.get_all(after=min(c_id, other_id))], [max(c_id, other_id)])
+    eq_(list(backend.get_all(ids_only=True))[0].keys(), {'_id', 'dimension', 'version'})
+
+    # Missing and invalid cubes.
+    ok_(backend.delete(c_id))
+    ok_(not backend.delete(c_id))
+    eq_(backend.get(c_id), None)
+    ok_(not backend.update_elements(c_id, {(1, 1, 1): 1}))
+    ok_(not backend.update_elements(c_id, {(1, 1, 1): 1}, expected_versions={8}))
+    ok_(not backend.add_range(c_id, 1, 1, 1, 1, 1, 1, 1))
+    ok_(not backend.store_index(c_id, b'\x03', 9))
+    assert_raises(TypeError, backend.get, 'not-an-id')
+
+    eq_(backend.delete_all(), 1)
+    eq_(list(backend.get_all()), [])
+
+
+def test_memory_backend():
+    """
+    Tests the behaviors every backend shares with the memory backend.
+    """
+    _check_backend(MemoryBackend({}))
+
+
+def test_sqlite_backend():
+    """
+    Tests the SQLite backend, databases created before cubes had versions included.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'cubes.sqlite3')
+        _check_backend(SQLiteBackend({'sqlite': {'path': path}}))
+
+        # Cubes survive the backend.
+        backend = SQLiteBackend({'sqlite': {'path': path}})
+        c_id = backend.store({'dimension': 3, 'cube': {'1': {'2': {'3': 4}}}})
+        eq_(SQLiteBackend({'sqlite': {'path': path}}).get(c_id)['cube'], {'1': {'2': {'3': 4}}})
+
+    # Databases created before cubes had versions get the column, and their cubes are version 0.
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'cubes.sqlite3')
+        connection = sqlite3.connect(path)
+        connection.executescript('''
+            CREATE TABLE cubes (id TEXT PRIMARY KEY, dimension INTEGER NOT NULL, idx BLOB);
+            INSERT INTO cubes VALUES ('5f0c6a3e9d1b2c3d4e5f6a7b', 2, NULL);
+        ''')
+        connection.close()
+
+        backend = SQLiteBackend({'sqlite': {'path': path}})
+        eq_(backend.get_metadata('5f0c6a3e9d1b2c3d4e5f6a7b')['version'], 0)
+        ok_(backend.update_elements('5f0c6a3e9d1b2c3d4e5f6a7b', {(1, 1, 1): 1}))
+        eq_(backend.get('5f0c6a3e9d1b2c3d4e5f6a7b')['version'], 1)
+
+
+def test_log_backend():
+    """
+    Tests the log backend: appends, replays, torn records, compaction and versions of old snapshots.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        _check_backend(LogBackend({'log': {'path': directory}}))
+
+        backend = LogBackend({'log': {'path': directory}})
+        c_id = backend.store({'dimension': 3, 'cube': {'1': {'1': {'1': 1}}}})
+        cube_path = os.path.join(directory, c_id)
+
+        # Updates are appended to the log, each followed by the increase of the version, and replayed on top of the
+        # snapshot.
+        backend.update_elements(c_id, {(1, 1, 1): 2, (3, 3, 3): -1})
+        backend.update_elements(c_id, {(1, 1, 1): 0})
+        eq_(sorted(os.listdir(cube_path)), ['1.log', '1.snapshot', '1.version'])
+        eq_(os.path.getsize(os.path.join(cube_path, '1.log')), 5 * 14)
+        eq_(backend.get(c_id)['cube'], {'1': {'1': {'1': 0}}, '3': {'3': {'3': -1}}})
+        eq_(backend.get_metadata(c_id)['version'], 3)
+
+        # A torn record at the end of the log is ignored.
+        with open(os.path.join(cube_path, '1.log'), 'ab') as f:
+            f.write(b'\x02\x00\x02')
+        eq_(backend.get(c_id)['cube'], {'1': {'1': {'1': 0}}, '3': {'3': {'3': -1}}})
+
+        # Compaction folds the log into a new snapshot, unless it's too short.
+        ok_(not backend.compact(c_id, min_records=6))
+        ok_(backend.compact(c_id))
+        eq_(sorted(os.listdir(cube_path)), ['2.log', '2.snapshot', '2.version'])
+        eq_(backend.get(c_id)['cube'], {'3': {'3': {'3': -1}}})
+        eq_(backend.get(c_id)['version'], 3)
+        ok_(not backend.compact(c_id))
+
+        # Generations left by a compaction that didn't finish are read as well.
+        open(os.path.join(cube_path, '3.log'), 'ab').close()
+        backend.update_elements(c_id, {(2, 2, 2): 5})
+        eq_(sorted(os.listdir(cube_path)), ['2.log', '2.snapshot', '2.version', '3.log'])
+        eq_(LogBackend({'log': {'path': directory}}).get(c_id)['cube'], {'2': {'2': {'2': 5}}, '3': {'3': {'3': -1}}})
+        eq_(backend.get_metadata(c_id)['version'], 4)
+
+        # Box adds are four records, whatever the size of the box, applied when the cube is read.
+        ok_(backend.add_range(c_id, 1, 3, 1, 3, 2, 3, 1))
+        eq_(os.path.getsize(os.path.join(cube_path, '3.log')), 6 * 14)
+        cube = backend.get(c_id)['cube']
+        eq_(cube['1']['1'], {'2': 1, '3': 1})
+        eq_(cube['2']['2'], {'2': 6, '3': 1})
+        eq_(cube['3']['3'], {'2': 1, '3': 0})
+        eq_(backend.get_metadata(c_id)['version'], 5)
+
+        # Full updates start a new generation on their own.
+        ok_(backend.update(c_id, {'dimension': 3, 'cube': {'1': {'2': {'3': 4}}}}))
+        eq_(sorted(os.listdir(cube_path)), ['4.snapshot', '4.version'])
+        eq_(backend.get(c_id)['cube'], {'1': {'2': {'3': 4}}})
+        eq_(backend.get(c_id)['version'], 6)
+
+        # Snapshots written before cubes had versions are version 0.
+        os.remove(os.path.join(cube_path, '4.version'))
+        eq_(backend.get_metadata(c_id)['version'], 0)
+
+
+def test_mongo_backend():
+    """
+    Tests the MongoDB backend, boxes too large for a single increase included.
+    """
+    backend = MongoBackend(persistence_conf)
+    backend.delete_all()
+    max_increments = backends._MAX_INCREMENTS
+    try:
+        _check_backend(backend)
+
+        # Boxes too large for a single $inc of the document write the whole cube instead, as a single new version.
+        backends._MAX_INCREMENTS = 4
+        c_id = backend.store({'dimension': 3, 'cube': {'1': {'1': {'1': 1}}}, 'index': b'\x01'})
+        ok_(backend.add_range(c_id, 1, 1, 1, 2, 1, 3, 2))
+        cube = backend.get(c_id)
+        eq_(cube['cube'], {'1': {'1': {'1': 3, '2': 2, '3': 2}, '2': {'1': 2, '2': 2, '3': 2}}})
+        eq_(cube['version'], 2)
+        ok_('index' not in cube)
+    finally:
+        backends._MAX_INCREMENTS = max_increments
+        backend.delete_all()
+
+
+def test_mongo_slab_backend():
+    """
+    Tests the slab per document MongoDB backend, concurrent conditional updates included.
+    """
+    backend = MongoSlabBackend(persistence_conf)
+    backend.delete_all()
+    try:
+        _check_backend(backend)
+
+        # Only non-empty slabs are stored, one document each.
+        c_id = backend.store({'dimension': 5, 'cube': {'1': {'1': {'1': 1}}, '4': {'2': {'3': 4}, '5': {'5': 5}}}})
+        eq_(backend.slabs.count_documents({}), 2)
+        assert 'cube' not in backend.collection.find_one({})
+
+        backend.update_elements(c_id, {(4, 1, 1): 2, (5, 5, 5): 3})
+        eq_(backend.slabs.count_documents({}), 3)
+        eq_(backend.get_slabs(c_id, 4, 5)['cube'], {'4': {'1': {'1': 2}, '2': {'3': 4}, '5': {'5': 5}},
+                                                     '5': {'5': {'5': 3}}})
+
+        # Of two conditional updates that expect the same version, only the one that claims it first is written.
+        write_slabs = backend._write_slabs
+
+        def write_slabs_after_another_update(cube_id, by_slab):
+            backend._write_slabs = write_slabs
+            assert_raises(VersionMismatch, backend.update_elements, c_id, {(1, 1, 1): 9}, expected_versions={2})
+            write_slabs(cube_id, by_slab)
+
+        backend._write_slabs = write_slabs_after_another_update
+        ok_(backend.update_elements(c_id, {(1, 1, 1): 8}, expected_versions={2}))
+        eq_(backend.get_slabs(c_id, 1, 1), {'_id': c_id, 'dimension': 5, 'version': 3, 'cube': {'1': {'1': {'1': 8}}}})
+    finally:
+        backend.delete_all()
+
+
+def test_mongo_slab_migration():
+    """
+    Tests that cubes stored by the MongoDB backend are read, updated and moved by the slab one.
+    """
+    legacy, backend = MongoBackend(persistence_conf), MongoSlabBackend(persistence_conf)
+    backend.delete_all()
+    max_increments = backends._MAX_INCREMENTS
+    try:
+        cube = {'1': {'1': {'1': 1}}, '3': {'2': {'1': 6}}}
+        c_id = legacy.store({'dimension': 3, 'cube': cube})
+
+        # Cubes in the old layout are read and updated as they are, and they're version 0 if stored before cubes had
+        # versions.
+        backend.collection.update_one({}, {'$unset': {'version': True}})
+        eq_(backend.get(c_id)['cube'], cube)
+        eq_(backend.get(c_id)['version'], 0)
+        assert_raises(VersionMismatch, backend.update_elements, c_id, {(2, 2, 2): 2}, expected_versions={1})
+        ok_(backend.update_elements(c_id, {(2, 2, 2): 2}, expected_versions={0}))
+        ok_(backend.add_range(c_id, 3, 3, 2, 2, 1, 2, 1))
+        eq_(backend.get_metadata(c_id)['version'], 2)
+        cube['2'] = {'2': {'2': 2}}
+        cube['3'] = {'2': {'1': 7, '2': 1}}
+        eq_(backend.get_slabs(c_id, 2, 3)['cube'], {'2': {'2': {'2': 2}}, '3': {'2': {'1': 7, '2': 1}}})
+
+        eq_(backend.migrate(), 1)
+        eq_(backend.migrate(), 0)
+
+        assert 'cube' not in backend.collection.find_one({})
+        eq_(backend.slabs.count_documents({}), 3)
+        eq_(backend.get(c_id)['cube'], cube)
+        eq_([c['cube'] for c in backend.get_all()], [cube])
+
+        # Cubes in the old layout are moved to slabs before boxes too large to increase in place are added.
+        other_id = legacy.store({'dimension': 2, 'cube': {'1': {'1': {'1': 1}}}})
+        backends._MAX_INCREMENTS = 4
+        ok_(backend.add_range(other_id, 1, 2, 1, 2, 1, 2, 1))
+        eq_(backend.collection.count_documents({'cube': {'$exists': True}}), 0)
+        eq_(backend.get(other_id)['cube'], {'1': {'1': {'1': 2, '2': 1}, '2': {'1': 1, '2': 1}},
+                                            '2': {'1': {'1': 1, '2': 1}, '2': {'1': 1, '2': 1}}})
+        eq_(backend.get_metadata(other_id)['version'], 2)
+    finally:
+        backends._MAX_INCREMENTS = max_increments
+        backend.delete_all()
+
+
+def test_mongo_slab_migration_with_updates():
+    """
+    Tests that updates made to a cube while it's moved to slabs are not lost.
+    """
+    legacy, backend = MongoBackend(persistence_conf), MongoSlabBackend(persistence_conf)
+    backend.delete_all()
+    try:
+        c_id = legacy.store({'dimension': 3, 'cube': {'1': {'1': {'1': 1}}}})
+        insert_slabs = backend._insert_slabs
+        updates = [{(2, 2, 2): 2}]
+
+        def insert_slabs_and_update(cube_id, cube):
+            # The cube is updated in the old layout after being read, while it's being moved.
+            insert_slabs(cube_id, cube)
+            if updates:
+                ok_(backend.update_elements(c_id, updates.pop()))
+
+        backend._insert_slabs = insert_slabs_and_update
+
+        eq_(backend.migrate(), 1)
+        assert 'cube' not in backend.collection.find_one({})
+        eq_(backend.get(c_id)['cube'], {'1': {'1': {'1': 1}}, '2': {'2': {'2': 2}}})
+        eq_(backend.get_metadata(c_id)['version'], 2)
+    finally:
+        backend.delete_all()
@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+from nose.tools import *
+from batch import run_operation
+from data.cube import Cube
+
+_ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_run_operation():
+    """
+    Tests that batch operations update and query the cube, and that malformed ones are rejected.
+    """
+    cube = Cube(4)
+
+    eq_(run_operation(cube, 'UPDATE 2 2 2 4\n'), None)
+    eq_(run_operation(cube, 'QUERY 1 1 1 3 3 3\n'), 4)
+    eq_(run_operation(cube, 'QUERY 1 1 1 1 1 1'), 0)
+
+    assert_raises(ValueError, run_operation, cube, 'DELETE 1 1 1')
+    assert_raises(AssertionError, run_operation, cube, 'QUERY 1 1 1')
+
+
+def test_command_line():
+    """
+    Tests that the command line runs every test case of the input, with any engine and in parallel.
+    """
+    # Two test cases.
+    input_data = ('2\n'
+                  '4 3\nUPDATE 2 2 2 4\nQUERY 1 1 1 3 3 3\nQUERY 1 1 1 1 1 1\n'
+                  '2 2\nUPDATE 2 2 2 1\nQUERY 1 1 1 2 2 2\n')
+
+    for arguments in (['--engine', 'sparse'], ['--engine', 'fenwick'], ['--processes', '2']):
+        output = subprocess.check_output([sys.executable, 'batch.py'] + arguments,
+                                         input=input_data.encode('utf8'), cwd=_ROOT_DIR)
+        eq_(output.decode('utf8'), '4\n0\n1\n')
@@ -0,0 +1,54 @@
+import json
+import os
+import tempfile
+from nose.tools import *
+import metrics
+from benchmark import generate_workload, main
+from data.cube import query_cache
+
+
+def test_generate_workload():
+    """
+    Tests that workloads are reproducible and their operations stay within the cube.
+    """
+    workload = generate_workload(10, 200, update_ratio=0.25, box_size='small', seed=1)
+
+    # Same seed, same workload.
+    eq_(workload, generate_workload(10, 200, update_ratio=0.25, box_size='small', seed=1))
+    eq_(len(workload), 200)
+
+    for operation, arguments in workload:
+        if operation == 'QUERY':
+            x1, x2, y1, y2, z1, z2 = arguments
+            assert 1 <= x1 <= x2 <= 10 and 1 <= y1 <= y2 <= 10 and 1 <= z1 <= z2 <= 10
+            assert x2 - x1 < 1 and y2 - y1 < 1 and z2 - z1 < 1  # Small boxes are at most a tenth of the cube.
+        else:
+            eq_(operation, 'UPDATE')
+            eq_(len(arguments), 4)
+
+
+def test_report():
+    """
+    Tests that the benchmark reports the results of every engine and restores the settings it changes.
+    """
+    max_entries, metrics_enabled = query_cache.max_entries, metrics.enabled
+    handle, output = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    try:
+        main(['--dimension', '5', '--operations', '50', '--engines', 'sparse', 'fenwick', '--output', output])
+
+        with open(output) as f:
+            report = json.load(f)
+
+        eq_(sorted(report['engines']), ['fenwick', 'sparse'])
+        for result in report['engines'].values():
+            eq_(result['operations'], 50)
+            assert result['ops_per_sec'] > 0
+            assert result['p50_us'] <= result['p99_us']
+            assert result['peak_memory_bytes'] > 0
+
+        # Settings changed for the benchmark are restored.
+        eq_(query_cache.max_entries, max_entries)
+        eq_(metrics.enabled, metrics_enabled)
+    finally:
+        os.remove(output)
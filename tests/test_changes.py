@@ -0,0 +1,49 @@
+from nose.tools import *
+from persistence.changes import ChangeLog
+
+
+def test_changes_since():
+    """
+    Tests that the changes since a version are coalesced, and only available for the last versions.
+    """
+    changes = ChangeLog(max_versions=3)
+    changes.add('a', 2, {(1, 1, 1): 1, (2, 2, 2): 2})
+    changes.add('a', 3, {(1, 1, 1): 5})
+
+    # Updates are coalesced, the last value wins.
+    eq_(changes.since('a', 1), {(1, 1, 1): 5, (2, 2, 2): 2})
+    eq_(changes.since('a', 2), {(1, 1, 1): 5})
+    eq_(changes.since('a', 3), {})
+
+    # Only the last versions are kept.
+    changes.add('a', 4, {(3, 3, 3): 3})
+    changes.add('a', 5, {(4, 4, 4): 4})
+    eq_(changes.since('a', 1), None)
+    eq_(changes.since('a', 2), {(1, 1, 1): 5, (3, 3, 3): 3, (4, 4, 4): 4})
+
+    eq_(changes.since('b', 1), None)
+
+
+def test_history_starts_over():
+    """
+    Tests that the history of a cube starts over after a gap in its versions, and is kept for the latest cubes only.
+    """
+    changes = ChangeLog(max_cubes=1)
+    changes.add('a', 2, {(1, 1, 1): 1})
+
+    # A version that doesn't follow the latest one means some updates weren't recorded.
+    changes.add('a', 5, {(2, 2, 2): 2})
+    eq_(changes.since('a', 1), None)
+    eq_(changes.since('a', 4), {(2, 2, 2): 2})
+
+    changes.discard('a')
+    eq_(changes.since('a', 4), None)
+
+    # Only the histories of the cubes updated most recently are kept.
+    changes.add('a', 2, {(1, 1, 1): 1})
+    changes.add('b', 2, {(1, 1, 1): 1})
+    eq_(changes.since('a', 1), None)
+    eq_(changes.since('b', 1), {(1, 1, 1): 1})
+
+    changes.clear()
+    eq_(changes.since('b', 1), None)
@@ -0,0 +1,183 @@
+import http.client
+import json
+import os
+import socket
+import time
+import persistence.cube as cube_persistence
+from multiprocessing import get_context
+from threading import Thread
+from nose.tools import *
+from werkzeug.serving import make_server
+from cluster import Router, _serve_worker, serve, worker_for
+from config.config import persistence_conf
+
+
+def test_cubes_stick_to_workers():
+    """
+    Tests that every request about a cube goes to the same worker.
+    """
+    router = Router('127.0.0.1', [4243, 4244, 4245])
+    cube_id = '575cf0a57d09db2bf185dea9'
+    worker = worker_for(cube_id, 3)
+
+    # Every request about the same cube goes to the same worker.
+    eq_(router.targets('GET', '/cubes/%s' % cube_id), [worker])
+    eq_(router.targets('PUT', '/cubes/%s' % cube_id), [worker])
+    eq_(router.targets('POST', '/cubes/%s/queries' % cube_id), [worker])
+
+
+def test_collection_requests():
+    """
+    Tests that requests about every cube go to the workers that must see them.
+    """
+    router = Router('127.0.0.1', [4243, 4244, 4245])
+
+    # New cubes are created by every worker in turn.
+    eq_([router.targets('POST', '/cubes') for _ in range(4)], [[0], [1], [2], [0]])
+
+    # All workers must know cubes are gone, and all of them write their buffers.
+    eq_(router.targets('DELETE', '/cubes'), [0, 1, 2])
+    eq_(router.targets('POST', '/cubes/flush'), [0, 1, 2])
+    eq_(router.targets('GET', '/cubes'), [0])
+
+
+def test_flush_before_listing():
+    """
+    Tests that listing cubes in write-behind mode flushes the buffers of the other workers first.
+    """
+    router = Router('127.0.0.1', [4243, 4244, 4245], write_behind=True)
+
+    # The worker that lists cubes writes its own buffer, but the others must write theirs first.
+    eq_(router.flush_targets('GET', '/cubes'), [1, 2])
+    eq_(router.flush_targets('GET', '/cubes/575cf0a57d09db2bf185dea9'), [])
+    eq_(router.flush_targets('POST', '/cubes'), [])
+
+    eq_(Router('127.0.0.1', [4243, 4244, 4245]).flush_targets('GET', '/cubes'), [])
+
+
+def test_process_backends_are_rejected():
+    """
+    Tests that the cluster refuses backends that keep cubes in the memory of a process.
+    """
+    backend = persistence_conf['backend']
+    persistence_conf['backend'] = 'memory'
+
+    try:
+        # Cubes created by a worker would not be found by the others.
+        assert_raises(AssertionError, serve, '127.0.0.1', 4242, 2)
+    finally:
+        persistence_conf['backend'] = backend
+
+
+def test_cluster():
+    """
+    Tests that a cluster of workers behind the router serves every cube, whatever worker created it.
+    """
+    backend = os.environ.get('CUBES_BACKEND')
+    os.environ['CUBES_BACKEND'] = 'sqlite'  # Inherited by the workers, which share the database file.
+
+    ports = [_free_port(), _free_port()]
+    context = get_context('spawn')
+    workers = [context.Process(target=_serve_worker_with_write_behind, args=('127.0.0.1', port), daemon=True)
+               for port in ports]
+    server = make_server('127.0.0.1', 0, Router('127.0.0.1', ports, write_behind=True), threaded=True)
+
+    try:
+        for worker in workers:
+            worker.start()
+
+        for port in ports:
+            _wait_for(port)
+
+        Thread(target=server.serve_forever, daemon=True).start()
+        _request(server.server_port, 'DELETE', '/cubes')
+
+        # Every cube is found whatever worker created it.
+        cube_ids = [_request(server.server_port, 'POST', '/cubes', {'dimension': 4})[1]['data'] for _ in range(4)]
+
+        for cube_id in cube_ids:
+            eq_(_request(server.server_port, 'GET', '/cubes/%s' % cube_id)[0], 200)
+
+        # Updates buffered by any worker are in the list of cubes.
+        for cube_id in cube_ids:
+            eq_(_request(server.server_port, 'PUT', '/cubes/%s' % cube_id, {'x': 1, 'y': 2, 'z': 3, 'value': 7})[0],
+                200)
+
+        status, body = _request(server.server_port, 'GET', '/cubes')
+        eq_(status, 200)
+        eq_(sorted(cube['_id'] for cube in body['data']), sorted(cube_ids))
+        ok_(all(cube['cube'] == {'1': {'2': {'3': 7}}} for cube in body['data']))
+
+        # Streamed responses make it through whole.
+        status, body = _request(server.server_port, 'GET', '/cubes?format=ndjson', raw=True)
+        eq_(status, 200)
+        eq_(sorted(json.loads(line)['_id'] for line in body.splitlines()), sorted(cube_ids))
+
+        eq_(_request(server.server_port, 'DELETE', '/cubes')[0], 200)
+        eq_(_request(server.server_port, 'GET', '/cubes/%s' % cube_ids[0])[0], 404)
+    finally:
+        server.shutdown()
+
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+
+        if backend is None:
+            del os.environ['CUBES_BACKEND']
+        else:
+            os.environ['CUBES_BACKEND'] = backend
+
+
+# ===============================
+# Private helper functions.
+# ===============================
+def _serve_worker_with_write_behind(host, port):
+    """
+    Runs the API in a worker process, buffering element updates until they're flushed on request.
+    """
+    cube_persistence._write_behind = True
+    cube_persistence._flush_interval = 3600
+    _serve_worker(host, port)
+
+
+def _free_port():
+    """
+    :return: Port of the loopback interface nothing listens on.
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(port, timeout=30):
+    """
+    Waits until something listens on a port of the loopback interface.
+    """
+    deadline = time.time() + timeout
+
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def _request(port, method, path, body=None, raw=False):
+    """
+    Sends a request to a port of the loopback interface.
+    :return: Status and body of the response, decoded from JSON unless raw.
+    """
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+
+    try:
+        connection.request(method, path, body=json.dumps(body) if body is not None else None,
+                           headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        content = response.read().decode('utf8')
+
+        return response.status, content if raw else json.loads(content)
+    finally:
+        connection.close()
@@ -0,0 +1,51 @@
+import os
+import subprocess
+import sys
+from nose.tools import *
+from config import config
+
+# Maximum time, in seconds, importing the application may take. Importing it must not connect to database.
+_IMPORT_BUDGET = 1.5
+
+_PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_import_is_fast_and_does_not_connect():
+    """
+    Tests that importing the application is fast and doesn't connect to database.
+    """
+    script = ('import sys, time\n'
+              'start = time.perf_counter()\n'
+              'import application\n'
+              'print(time.perf_counter() - start, "pymongo" in sys.modules)\n')
+    output = subprocess.check_output([sys.executable, '-c', script], cwd=_PROJECT_DIR, universal_newlines=True)
+    elapsed, pymongo_imported = output.split()
+
+    ok_(float(elapsed) < _IMPORT_BUDGET, 'Importing the application took %ss' % elapsed)
+    eq_(pymongo_imported, 'False')
+
+
+def test_client_is_created_once_per_process():
+    """
+    Tests that the MongoDB client is shared within a process, and created again by forked ones.
+    """
+    client = config.get_client()
+    ok_(config.get_client() is client)
+    eq_(config.collection.name, config.persistence_conf['collection'])
+
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:
+        # The client inherited from the parent is not used.
+        inherited = config._client is None
+        fresh = config.get_client() is not client and config._client_pid == os.getpid()
+        os.write(write_end, b'1' if inherited and fresh else b'0')
+        os._exit(0)
+
+    os.close(write_end)
+    os.waitpid(pid, 0)
+    eq_(os.read(read_end, 1), b'1')
+    os.close(read_end)
+
+    ok_(config.get_client() is client)
@@ -1,68 +1,291 @@
+import copy
+import io
 import os
-from data.cube import Cube
+import random
+from unittest import SkipTest
+from nose.tools import eq_, ok_
+from batch import run
+from data import engines
+from data.cube import Cube, instantiate_from_raw_data, query_cache
+from data.engines import ENGINES
 
 
 def test_cube():
     """
     Tests the update and query behaviors of the cube.
     """
+    _check_cube_engine(None)
+
+
+def test_cube_dict_engine():
+    """
+    Tests the update and query behaviors of a cube backed by nested dicts.
+    """
+    _check_cube_engine('dict')
+
+
+def test_cube_fenwick_engine():
+    """
+    Tests the update and query behaviors of a cube backed by a Fenwick tree.
+    """
+    _check_cube_engine('fenwick')
+
+
+def test_cube_numpy_engine():
+    """
+    Tests the update and query behaviors of a cube backed by NumPy.
+    """
+    _skip_without_numpy()
+    _check_cube_engine('numpy')
+
+
+def test_cube_prefix_engine():
+    """
+    Tests the update and query behaviors of a cube backed by a table of prefix sums.
+    """
+    _skip_without_numpy()  # Without NumPy every query after an update rebuilds the whole table, which takes a while.
+    _check_cube_engine('prefix')
+
+
+def test_prefix_engine_index():
+    """
+    Tests that the table of prefix sums is the same with and without NumPy, and survives an export.
+    """
+    _skip_without_numpy()
+    random.seed(7)
+    cube = Cube(7, engine='prefix')
+    for _ in range(60):
+        cube.update(*[random.randint(1, 7) for _ in range(3)] + [random.randint(-1000, 1000)])
+
+    # The table is only exported once built, and never for empty cubes.
+    eq_(cube.export_index(), None)
+    eq_(Cube(7, engine='prefix').export_index(build=True), None)
+    index = cube.export_index(build=True)
+
+    # Build it again in pure Python.
+    numpy, engines.numpy = engines.numpy, None
+    try:
+        pure_python_cube = Cube(7, cube.cube, engine='prefix')
+        eq_(pure_python_cube.export_index(build=True), index)
+    finally:
+        engines.numpy = numpy
+
+    loaded_cube = instantiate_from_raw_data({'dimension': 7, 'cube': cube.cube, 'index': index}, engine='prefix')
+    eq_(loaded_cube.query(2, 6, 1, 7, 3, 5), cube.query(2, 6, 1, 7, 3, 5))
+
+
+def test_update_and_query_many():
+    """
+    Tests that batch updates and queries match the point by point ones, before and after going dense.
+    """
+    _skip_without_numpy()
+    random.seed(42)
+    dimension = 6
+
+    for engine in ENGINES:
+        cube = Cube(dimension, engine=engine)
+        expected = Cube(dimension)
+
+        for _ in range(4):
+            points = [[random.randint(1, dimension) for _ in range(50)] for _ in range(3)]
+            values = [random.randint(-10 ** 9, 10 ** 9) for _ in range(50)]
+            cube.update_many(*(points + [values]))
+            for x, y, z, value in zip(*(points + [values])):
+                expected.update(x, y, z, value)
+
+            boxes = []
+            for _ in range(20):
+                x1, x2, y1, y2, z1, z2 = (random.randint(1, dimension) for _ in range(6))
+                boxes.append((min(x1, x2), max(x1, x2), min(y1, y2), max(y1, y2), min(z1, z2), max(z1, z2)))
+
+            eq_(cube.query_many(boxes), [expected.query(*box) for box in boxes])
+            eq_(cube.cube, expected.cube)
+
+
+def test_engines_keep_zeros():
+    """
+    Tests that points explicitly set to 0 are kept by every engine, so they're listed like with the original
+    nested dicts.
+    """
+    for engine in ENGINES:
+        if engine == 'numpy' and engines.numpy is None:
+            continue
+
+        cube = Cube(3, {'1': {'1': {'1': 0, '2': 5}}}, engine=engine)
+        eq_(cube.cube, {'1': {'1': {'1': 0, '2': 5}}})
+
+        cube.update(1, 1, 2, 0)
+        eq_(cube.cube, {'1': {'1': {'1': 0, '2': 0}}})
+        eq_(cube.query(1, 3, 1, 3, 1, 3), 0)
+
+
+def test_sparse_engine_slabs():
+    """
+    Tests that the sparse engine sums every slab the cheapest way, probing the points of the box in slabs with many
+    points stored and visiting the points stored in the others.
+    """
+    random.seed(7)
+    dimension = 10
+    cube, expected = Cube(dimension), Cube(dimension, engine='dict')
+
+    # Slab 2 is full, slab 5 has a few points and the others are empty.
+    for y in range(1, dimension + 1):
+        for z in range(1, dimension + 1):
+            for c in (cube, expected):
+                c.update(2, y, z, y * z)
+    for _ in range(5):
+        y, z, value = random.randint(1, dimension), random.randint(1, dimension), random.randint(-100, 100)
+        for c in (cube, expected):
+            c.update(5, y, z, value)
+
+    for box in [(1, 10, 3, 4, 3, 4), (1, 10, 1, 10, 1, 10), (2, 5, 2, 9, 1, 10), (6, 10, 1, 10, 1, 10)]:
+        eq_(cube.query(*box), expected.query(*box))
+
+    # 4 probes in slab 2, plus the (up to) 5 points of slab 5.
+    ok_(cube._engine.cells_scanned(1, 10, 3, 4, 3, 4) <= 8)
+    eq_(cube._engine.cells_scanned(6, 10, 1, 10, 1, 10), 0)
+
+
+def test_slab_points():
+    """
+    Tests that every engine lists the elements of a range of slabs, explicit zeros included, like the whole cube does.
+    """
+    raw = {'1': {'1': {'1': 3}}, '2': {'2': {'1': 0, '3': 4}}, '3': {'3': {'3': -1}}, '4': {'1': {'4': 2}}}
+
+    for engine in ENGINES:
+        if engine == 'numpy' and engines.numpy is None:
+            continue
+
+        cube = Cube(4, copy.deepcopy(raw), engine=engine)
+        eq_(sorted(cube.slab_points(2, 3)), [(2, 2, 1, 0), (2, 2, 3, 4), (3, 3, 3, -1)])
+        eq_(cube.slab_points(4, 4), [(4, 1, 4, 2)])
+        eq_(sorted(cube.slab_points(1, 4)), sorted(cube.points()))
+
+
+def test_query_cache():
+    """
+    Tests that repeated queries are answered from the query cache until the cube changes.
+    """
+    cube = Cube(10)
+    cube.update(1, 2, 3, 42)
+    eq_(cube.version, 1)
+
+    hits = query_cache.stats()['hits']
+    eq_(cube.query(1, 10, 1, 10, 1, 10), 42)
+    eq_(cube.query(1, 10, 1, 10, 1, 10), 42)
+    eq_(cube.query_many([(1, 10, 1, 10, 1, 10), (2, 10, 1, 10, 1, 10)]), [42, 0])
+    eq_(query_cache.stats()['hits'], hits + 2)
+
+    # A new version of the cube doesn't see results of the old one.
+    cube.update(10, 10, 10, 8)
+    eq_(cube.version, 2)
+    eq_(cube.query(1, 10, 1, 10, 1, 10), 50)
+    eq_(query_cache.stats()['hits'], hits + 2)
+
+
+def _skip_without_numpy():
+    """
+    Skips the current test if NumPy isn't installed.
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise SkipTest('NumPy is not installed')
+
+
+def _check_cube_engine(engine):
+    """
+    Runs the HackerRank input through a cube using the given storage engine and compares its output with the expected
+    one.
+    """
     parent_dir = os.path.dirname(os.path.abspath(__file__))
 
     # Names of the files used to perform the test
     input_filename = "%s/test_cube_input" % parent_dir
-    output_filename = "%s/test_cube_output" % parent_dir
     expected_output_filename = "%s/test_cube_expected_output" % parent_dir
 
-    out = open(output_filename, "w")
+    out = io.StringIO()
     with open(input_filename, "r") as in_data:
-        TESTS = None
-        cube_dimension = None
-        remaining_tests = None
-        cube = None
-        output_lines = []
-        for line in in_data:
-            if not TESTS:
-                TESTS = int(line)
-                continue
-
-            if not cube_dimension or not remaining_tests:
-                cube_dimension, remaining_tests = line.split(" ")
-                cube_dimension = int(cube_dimension)
-                remaining_tests = int(remaining_tests)
-
-                cube = Cube(dimension=cube_dimension)
-                continue
-
-            if remaining_tests > 0:
-                remaining_tests -= 1
-                input = line.split(" ")
-
-                if input[0] == "UPDATE":
-                    x = int(input[1])
-                    y = int(input[2])
-                    z = int(input[3])
-                    value = int(input[4])
-                    cube.update(x, y, z, value)
-                else:
-                    x1 = int(input[1])
-                    y1 = int(input[2])
-                    z1 = int(input[3])
-                    x2 = int(input[4])
-                    y2 = int(input[5])
-                    z2 = int(input[6])
-                    output_lines.append("%d" % cube.query(x1, x2, y1, y2, z1, z2))
-
-        out.write("\n".join(output_lines))
-    out.flush()
-    out.close()
-
-    assert os.path.getsize(expected_output_filename) == os.path.getsize(output_filename), "File sizes don't match"
-
-    out = open(output_filename, "r")
-    expected_out = open(expected_output_filename, "r")
-    assert expected_out.read() == out.read(), "Output doesn't match"
-
-    # Flush and close.
-    expected_out.flush()
-    expected_out.close()
+        run(in_data, out, engine=engine)
+
+    with open(expected_output_filename, "r") as expected_out:
+        # Every result is followed by a line break, even the last one.
+        assert expected_out.read() + "\n" == out.getvalue(), "Output doesn't match"
+
+
+def test_engines_round_trip():
+    """
+    Tests that every engine reads and writes the same dict representation of a cube.
+    """
+    _skip_without_numpy()
+    raw_cube = {'1': {'2': {'3': 42}}, '4': {'4': {'1': -7, '4': 0}}}
+
+    for engine in ENGINES:
+        cube = Cube(4, copy.deepcopy(raw_cube), engine=engine)
+        assert cube.cube == raw_cube, 'Engine %s lost data' % engine
+        assert cube.query(1, 4, 1, 4, 1, 4) == 35, 'Engine %s summed wrong' % engine
+
+        cube.update(1, 2, 3, 2)
+        assert cube.query(1, 1, 1, 4, 1, 4) == 2, 'Engine %s did not replace value' % engine
+
+
+def test_cube_range_engine():
+    """
+    Tests the update and query behaviors of a cube backed by range-update Fenwick trees.
+    """
+    _check_cube_engine('range')
+
+
+def test_add_range():
+    """
+    Tests that box adds match adding to every element of the box one by one, with every engine.
+    """
+    _skip_without_numpy()
+    random.seed(3)
+    dimension = 5
+
+    for engine in ENGINES:
+        cube = Cube(dimension, {'2': {'2': {'2': 7}}}, engine=engine)
+        expected = {(2, 2, 2): 7}
+
+        for _ in range(30):
+            x1, x2, y1, y2, z1, z2 = (random.randint(1, dimension) for _ in range(6))
+            box = (min(x1, x2), max(x1, x2), min(y1, y2), max(y1, y2), min(z1, z2), max(z1, z2))
+            delta = random.randint(-100, 100)
+
+            version = cube.version
+            cube.add_range(*box, delta)
+            eq_(cube.version - version, 1)  # A box add is a single new version, whatever its size.
+
+            for x, y, z, value in cube.box_points(*box):
+                expected[(x, y, z)] = expected.get((x, y, z), 0) + delta
+                assert value == expected[(x, y, z)], 'Engine %s added wrong' % engine
+
+            # Single element updates still replace the element.
+            x, y, z = (random.randint(1, dimension) for _ in range(3))
+            cube.update(x, y, z, 1)
+            expected[(x, y, z)] = 1
+
+            eq_(cube.query(*box), sum(value for (x, y, z), value in expected.items()
+                                      if box[0] <= x <= box[1] and box[2] <= y <= box[3] and box[4] <= z <= box[5]))
+
+        eq_({(x, y, z): value for x, y, z, value in cube.points() if value},
+            {point: value for point, value in expected.items() if value})
+
+
+def test_range_engine_round_trip():
+    """
+    Tests that a cube backed by the range engine rebuilds the same trees when loaded from its dict representation.
+    """
+    random.seed(5)
+    cube = Cube(8, engine='range')
+    for _ in range(20):
+        x1, x2, y1, y2, z1, z2 = (random.randint(1, 8) for _ in range(6))
+        cube.add_range(min(x1, x2), max(x1, x2), min(y1, y2), max(y1, y2), min(z1, z2), max(z1, z2),
+                       random.randint(-5, 5))
+
+    loaded = instantiate_from_raw_data({'dimension': 8, 'cube': cube.cube}, engine='range')
+    eq_(loaded.cube, cube.cube)
 
+    boxes = [(1, 8, 1, 8, 1, 8), (2, 5, 3, 3, 1, 7), (8, 8, 8, 8, 8, 8)]
+    eq_(loaded.query_many(boxes), cube.query_many(boxes))
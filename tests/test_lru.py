@@ -0,0 +1,46 @@
+from nose.tools import *
+from data.lru import LRUCache
+
+
+def test_evicts_least_recently_used():
+    """
+    Tests that the least recently used entry is evicted once the cache is full.
+    """
+    cache = LRUCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+
+    # 'a' becomes the most recently used, so 'b' is the one evicted.
+    eq_(cache.get('a'), 1)
+    cache.put('c', 3)
+
+    eq_(cache.get('b'), None)
+    eq_(cache.get('c'), 3)
+    eq_(cache.stats()['evictions'], 1)
+    eq_(cache.stats()['hits'], 2)
+    eq_(cache.stats()['misses'], 1)
+
+
+def test_evicts_by_size():
+    """
+    Tests that entries are evicted once their total size goes over the limit.
+    """
+    cache = LRUCache(max_entries=None, max_bytes=10, sizeof=len)
+    cache.put('a', 'xxxx')
+    cache.put('b', 'xxxx')
+    cache.put('c', 'xxxx')
+
+    # Only two values fit in 10 bytes.
+    eq_(len(cache), 2)
+    assert 'a' not in cache
+    eq_(cache.stats()['bytes'], 8)
+
+
+def test_disabled():
+    """
+    Tests that a cache without entries caches nothing.
+    """
+    cache = LRUCache(max_entries=0)
+    cache.put('a', 1)
+
+    eq_(cache.get('a'), None)
@@ -0,0 +1,81 @@
+import time
+from nose.tools import *
+import metrics
+from data.cube import Cube
+
+
+def test_render_prometheus_text():
+    """
+    Tests that metrics are rendered in the Prometheus text format.
+    """
+    registry = metrics.Registry()
+    counter = registry.register(metrics.Counter('things_total', 'Things seen.', ['kind']))
+    histogram = registry.register(metrics.Histogram('latency_seconds', 'Latency.', buckets=(0.1, 1)))
+    registry.register(metrics.Gauge('size', 'Size.', lambda: {(): 3}))
+
+    counter.inc(('a"b',))
+    counter.inc(('a"b',), 2)
+    histogram.observe(0.1)
+    histogram.observe(0.5)
+    histogram.observe(7)
+
+    eq_(registry.render(), '# HELP latency_seconds Latency.\n'
+                           '# TYPE latency_seconds histogram\n'
+                           'latency_seconds_bucket{le="0.1"} 1\n'
+                           'latency_seconds_bucket{le="1"} 2\n'
+                           'latency_seconds_bucket{le="+Inf"} 3\n'
+                           'latency_seconds_sum 7.6\n'
+                           'latency_seconds_count 3\n'
+                           '# HELP size Size.\n'
+                           '# TYPE size gauge\n'
+                           'size 3\n'
+                           '# HELP things_total Things seen.\n'
+                           '# TYPE things_total counter\n'
+                           'things_total{kind="a\\"b"} 3\n')
+
+
+def test_timer_labels_phases_with_route():
+    """
+    Tests that timed phases are labelled with the route of the current request.
+    """
+    metrics.set_route('/test')
+    before = metrics.phases.count(('/test', 'compute'))
+
+    with metrics.timer('compute'):
+        pass
+
+    eq_(metrics.phases.count(('/test', 'compute')), before + 1)
+
+
+def test_cells_scanned():
+    """
+    Tests that every query counts the cells scanned by the engine of the cube.
+    """
+    cube = Cube(10)
+    cube.update(1, 1, 1, 1)
+    before = metrics.cells_scanned.count(('sparse',))
+
+    # The sparse engine visits the only point stored rather than the 1000 points of the box.
+    cube.query(1, 10, 1, 10, 1, 10)
+    eq_(metrics.cells_scanned.count(('sparse',)), before + 1)
+    eq_(cube._engine.cells_scanned(1, 10, 1, 10, 1, 10), 1)
+
+
+def test_sampling_profiler():
+    """
+    Tests that the sampling profiler collects the stacks of running threads.
+    """
+    profiler = metrics.SamplingProfiler(interval=0.001)
+    profiler.start()
+
+    deadline = time.perf_counter() + 5
+    while profiler.samples < 5 and time.perf_counter() < deadline:
+        time.sleep(0.01)
+
+    profiler.stop()
+
+    # This very test shows up in the stacks sampled.
+    assert 'test_sampling_profiler' in profiler.folded()
+
+    profiler.reset()
+    eq_(profiler.folded(), '')
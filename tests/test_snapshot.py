@@ -0,0 +1,102 @@
+import os
+import tempfile
+from unittest import SkipTest
+from nose.tools import *
+from data import snapshot
+from data.cube import Cube
+from data.engines import numpy
+
+
+def test_sparse_round_trip():
+    """
+    Tests that sparse snapshots keep every element, int64 limits included.
+    """
+    cube = Cube(10)
+    cube.update(1, 1, 1, 5)
+    cube.update(10, 10, 10, -(2 ** 63))
+    cube.update(3, 7, 2, 2 ** 63 - 1)
+
+    data = snapshot.dumps(cube)
+
+    # Header plus 16 bytes per element.
+    eq_(len(data), 16 + 3 * 16)
+
+    loaded = snapshot.loads(data)
+    eq_(loaded.dimension, 10)
+    eq_(loaded.cube, cube.cube)
+
+
+def test_dense_round_trip():
+    """
+    Tests that dense snapshots can be loaded with any engine.
+    """
+    cube = Cube(3, engine='dict')
+    for x in range(1, 4):
+        for y in range(1, 4):
+            for z in range(1, 4):
+                cube.update(x, y, z, x * y)
+
+    data = snapshot.dumps(cube)
+    eq_(len(data), 16 + 27 * 8)
+
+    for engine in ['sparse', 'fenwick', 'prefix']:
+        eq_(snapshot.loads(data, engine=engine).query(1, 3, 1, 3, 1, 3), 108)
+
+
+def test_load_file():
+    """
+    Tests that a cube dumped to a file is loaded back.
+    """
+    cube = Cube(20)
+    cube.update(4, 5, 6, 7)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'cube.snapshot')
+        snapshot.dump(cube, path)
+
+        loaded = snapshot.load(path)
+        eq_(loaded.query(1, 20, 1, 20, 1, 20), 7)
+
+
+def test_load_dense_file_without_copying():
+    """
+    Tests that the NumPy engine loads dense snapshot files without copying them, and its updates don't modify them.
+    """
+    if numpy is None:
+        raise SkipTest('NumPy is not installed')
+
+    cube = Cube(4, engine='numpy')
+    cube.update_many(*zip(*[(x, y, z, x + y + z) for x in range(1, 5) for y in range(1, 5) for z in range(1, 5)]))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'cube.snapshot')
+        snapshot.dump(cube, path)
+
+        loaded = snapshot.load(path, engine='numpy')
+        eq_(loaded.query(1, 4, 1, 4, 1, 4), cube.query(1, 4, 1, 4, 1, 4))
+
+        # Loaded cubes can be updated, without the file being modified.
+        loaded.update(1, 1, 1, 100)
+        eq_(snapshot.load(path).query(1, 1, 1, 1, 1, 1), 3)
+
+
+def test_invalid_snapshots():
+    """
+    Tests that empty, foreign and truncated snapshots are rejected.
+    """
+    data = snapshot.dumps(Cube(2))
+
+    assert_raises(ValueError, snapshot.loads, b'')
+    assert_raises(ValueError, snapshot.loads, b'NOPE' + data[4:])
+    assert_raises(ValueError, snapshot.loads, data + b'\x00')
+
+
+def test_dimension():
+    """
+    Tests that the dimension of a cube is read out of the header of its snapshot.
+    """
+    data = snapshot.dumps(Cube(42))
+
+    eq_(snapshot.dimension(data[:snapshot.HEADER_SIZE]), 42)
+    assert_raises(ValueError, snapshot.dimension, data[:4])
+    assert_raises(ValueError, snapshot.dimension, b'NOPE' + data[4:])
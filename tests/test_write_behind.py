@@ -0,0 +1,42 @@
+from nose.tools import *
+from persistence.write_behind import WriteBuffer
+
+
+def test_coalesces_updates():
+    """
+    Tests that buffered updates of the same element are coalesced, the last value wins.
+    """
+    buffer = WriteBuffer(max_elements=3)
+
+    ok_(not buffer.add('a', {(1, 1, 1): 1, (2, 2, 2): 2}))
+    ok_(not buffer.add('a', {(1, 1, 1): 5}))
+    eq_(len(buffer), 2)
+
+    # Full once the third distinct element comes in.
+    ok_(buffer.add('b', {(1, 1, 1): 1}))
+    eq_(sorted(buffer.ids()), ['a', 'b'])
+
+    eq_(buffer.versions('a'), 2)
+    eq_(buffer.take('a'), ({(1, 1, 1): 5, (2, 2, 2): 2}, 2))
+    eq_(buffer.take('a'), ({}, 0))
+    eq_(len(buffer), 1)
+
+
+def test_restore_keeps_newer_updates():
+    """
+    Tests that restoring updates that failed to be written doesn't overwrite newer ones.
+    """
+    buffer = WriteBuffer()
+    buffer.add('a', {(1, 1, 1): 1, (2, 2, 2): 2})
+    taken, versions = buffer.take('a')
+
+    # An update arrives while the taken ones are being written, and the write fails.
+    buffer.add('a', {(1, 1, 1): 9})
+    buffer.restore('a', taken, versions)
+
+    eq_(buffer.take('a'), ({(1, 1, 1): 9, (2, 2, 2): 2}, 2))
+
+    buffer.add('b', {(1, 1, 1): 1})
+    buffer.clear()
+    eq_(len(buffer), 0)
+    ok_('b' not in buffer)
@@ -1,3 +1,5 @@
+import persistence.cube as cube_persistence
+from config.config import persistence_conf
 from persistence.cube import *
 from data.cube import Cube
 from nose.tools import *
@@ -72,6 +74,251 @@ def test_update_cube():
     eq_(42, raw_cube['cube']['1']['2']['3'])
 
 
+@with_setup(teardown=teardown_func)
+def test_update_element():
+    # Insert a cube with a 42 at (1,2,3).
+    cube = Cube(dimension=10)
+    cube.update(1, 2, 3, 42)
+    cube_id = store(cube)
+
+    # Put a 7 at (1,2,4) without touching the rest of the cube.
+    updated = update_element(cube_id, 1, 2, 4, 7)
+
+    eq_(updated, True)
+    raw_cube = get(cube_id)
+    eq_({'1': {'2': {'3': 42, '4': 7}}}, raw_cube['cube'])
+    eq_(10, get_dimension(cube_id))
+
+    # Out of range coordinates are rejected.
+    assert_raises(AssertionError, update_element, cube_id, 11, 1, 1, 7)
+
+
+@with_setup(teardown=teardown_func)
+def test_add_range():
+    cube = Cube(dimension=4)
+    cube.update(1, 1, 1, 5)
+    cube_id = store(cube)
+
+    # A box add is a single new version, whatever its size.
+    eq_(add_range(cube_id, 1, 2, 1, 1, 1, 2, 3), True)
+    eq_(get_version(cube_id), 2)
+    eq_(get(cube_id)['cube'], {'1': {'1': {'1': 8, '2': 3}}, '2': {'1': {'1': 3, '2': 3}}})
+    eq_(get_cube(cube_id).query(1, 4, 1, 4, 1, 4), 17)
+
+    # Big boxes are written the same way, without reading the cube. Elements back to 0 are kept, unless the backend
+    # stores dense snapshots.
+    max_range_elements = cube_persistence.MAX_RANGE_ELEMENTS
+    cube_persistence.MAX_RANGE_ELEMENTS = 10
+    cube_persistence._cubes.clear()
+    try:
+        eq_(add_range(cube_id, 1, 4, 1, 4, 1, 4, -3), True)
+        eq_(cube_persistence._cubes.peek(cube_id), None)
+    finally:
+        cube_persistence.MAX_RANGE_ELEMENTS = max_range_elements
+
+    raw_cube = get(cube_id)
+    row = raw_cube['cube']['1']['1']
+    eq_((row['1'], row.get('2', 0), row['3'], row['4']), (5, 0, -3, -3))
+    eq_(raw_cube['cube']['4']['4']['4'], -3)
+    eq_(get_cube(cube_id).query(1, 4, 1, 4, 1, 4), 17 - 3 * 64)
+
+    # Invalid boxes are rejected, and missing cubes are not updated.
+    assert_raises(AssertionError, add_range, cube_id, 2, 1, 1, 1, 1, 1, 1)
+    eq_(add_range('575cf0a57d09db2bf185dea9', 1, 1, 1, 1, 1, 1, 1), False)
+
+
+@with_setup(teardown=teardown_func)
+def test_versions():
+    cube_id = store(Cube(dimension=4))
+    eq_(get_version(cube_id), 1)
+
+    # Every write increases the version by one.
+    update_element(cube_id, 1, 1, 1, 5)
+    update_elements(cube_id, [(1, 1, 1, 6), (2, 2, 2, 1)])
+    update(cube_id, Cube(dimension=4))
+    add_range(cube_id, 1, 2, 1, 2, 1, 2, 1)
+    eq_(get_version(cube_id), 5)
+
+    # Cached versions are the ones in database.
+    cube_persistence._versions.clear()
+    eq_(get_version(cube_id), 5)
+    eq_(get_metadata(cube_id)['version'], 5)
+
+    # Conditional updates only go ahead if the cube is at one of the expected versions.
+    eq_(update_element(cube_id, 1, 1, 1, 2, expected_versions={4, 5}), True)
+    with assert_raises(VersionMismatch) as context:
+        update_element(cube_id, 1, 1, 1, 3, expected_versions={5})
+    eq_(context.exception.version, 6)
+    eq_(get(cube_id)['cube']['1']['1']['1'], 2)
+
+    # Versions are checked by the backend, so writes of other processes are seen.
+    cube_persistence._backend.update_elements(cube_id, {(2, 2, 2): 2})
+    with assert_raises(VersionMismatch) as context:
+        update_element(cube_id, 1, 1, 1, 3, expected_versions={6})
+    eq_(context.exception.version, 7)
+    eq_(update_element(cube_id, 1, 1, 1, 3, expected_versions={7}), True)
+    eq_(get_version(cube_id), 8)
+    eq_(get_cube(cube_id).query(1, 2, 1, 2, 1, 2), 11)
+
+    eq_(update_element('575cf0a57d09db2bf185dea9', 1, 1, 1, 1, expected_versions={1}), False)
+    eq_(get_version('575cf0a57d09db2bf185dea9'), None)
+
+    delete(cube_id)
+    eq_(get_version(cube_id), None)
+
+
+@with_setup(teardown=teardown_func)
+def test_versions_write_behind():
+    cube_persistence._write_behind = True
+    try:
+        cube_id = store(Cube(dimension=10))
+
+        # Buffered updates are new versions already, even if read from database.
+        update_element(cube_id, 1, 1, 1, 5)
+        update_element(cube_id, 1, 1, 1, 7)
+        eq_(get_version(cube_id), 3)
+        cube_persistence._versions.clear()
+        eq_(get_version(cube_id), 3)
+
+        # Conditional updates are written right away, after the buffered ones.
+        update_element(cube_id, 2, 2, 2, 1, expected_versions={3})
+        eq_(get_metadata(cube_id)['version'], 4)
+        eq_(get(cube_id)['cube'], {'1': {'1': {'1': 7}}, '2': {'2': {'2': 1}}})
+
+        update_element(cube_id, 3, 3, 3, 1)
+        flush()
+        eq_(get_metadata(cube_id)['version'], 5)
+    finally:
+        cube_persistence._write_behind = False
+
+
+@with_setup(teardown=teardown_func)
+def test_get_changes():
+    cube_id = store(Cube(dimension=4))
+    eq_(get_changes(cube_id, 1), (1, {}, False))
+
+    update_element(cube_id, 1, 1, 1, 5)
+    update_elements(cube_id, [(1, 1, 1, 6), (2, 2, 2, 1)])
+    add_range(cube_id, 4, 4, 4, 4, 3, 4, 2)
+    eq_(get_changes(cube_id, 1), (4, {(1, 1, 1): 6, (2, 2, 2): 1, (4, 4, 3): 2, (4, 4, 4): 2}, False))
+    eq_(get_changes(cube_id, 3), (4, {(4, 4, 3): 2, (4, 4, 4): 2}, False))
+    eq_(get_changes(cube_id, 4), (4, {}, False))
+
+    # Once the updates since a version are unknown, the whole cube is returned.
+    cube = Cube(dimension=4)
+    cube.update(3, 3, 3, 3)
+    update(cube_id, cube)
+    update_element(cube_id, 1, 1, 1, 1)
+    eq_(get_changes(cube_id, 5), (6, {(1, 1, 1): 1}, False))
+    eq_(get_changes(cube_id, 4), (6, {(1, 1, 1): 1, (3, 3, 3): 3}, True))
+
+    eq_(get_changes('575cf0a57d09db2bf185dea9', 1), None)
+
+
+@with_setup(teardown=teardown_func)
+def test_get_cube_cached():
+    # Insert a cube.
+    cube = Cube(dimension=10)
+    cube.update(1, 2, 3, 42)
+    cube_id = store(cube)
+
+    # First retrieval goes to database, the second one doesn't.
+    hits = cache_stats()['hits']
+    cached_cube = get_cube(cube_id)
+    eq_(cached_cube.query(1, 10, 1, 10, 1, 10), 42)
+    assert get_cube(cube_id) is cached_cube
+    eq_(cache_stats()['hits'], hits + 1)
+
+    # Updates are written through to the cached cube.
+    update_element(cube_id, 10, 10, 10, 8)
+    eq_(get_cube(cube_id).query(1, 10, 1, 10, 1, 10), 50)
+
+    # Deleted cubes are gone from the cache as well.
+    delete(cube_id)
+    eq_(get_cube(cube_id), None)
+
+
+@with_setup(teardown=teardown_func)
+def test_get_slabs():
+    # Insert a cube with elements in three different slabs.
+    cube = Cube(dimension=10)
+    cube.update(1, 1, 1, 1)
+    cube.update(5, 2, 3, 5)
+    cube.update(9, 9, 9, 9)
+    cube_id = store(cube)
+
+    # Only the slabs asked for are retrieved.
+    raw_cube = get_slabs(cube_id, 4, 9)
+    eq_(raw_cube['dimension'], 10)
+    eq_(raw_cube['cube'], {'5': {'2': {'3': 5}}, '9': {'9': {'9': 9}}})
+
+    eq_(get_slabs(cube_id, 6, 8)['cube'], {})
+
+    # Metadata doesn't have elements at all.
+    metadata = get_metadata(cube_id)
+    eq_(metadata['dimension'], 10)
+    assert 'cube' not in metadata
+
+
+@with_setup(teardown=teardown_func)
+def test_store_index():
+    persistence_conf['persist_index'], persistence_conf['engine'] = True, 'prefix'
+    try:
+        # Empty cubes, and cubes whose index isn't built yet, are stored without one.
+        cube = Cube(dimension=5, engine='prefix')
+        assert 'index' not in get(store(cube))
+        cube.update(1, 2, 3, 42)
+        assert 'index' not in get(store(cube))
+
+        # Once built (e.g. by a query), the index is persisted along with the cube.
+        cube.query(1, 5, 1, 5, 1, 5)
+        cube_id = store(cube)
+        eq_(bytes(get(cube_id)['index']), cube.export_index())
+
+        # It's dropped as soon as an element changes.
+        update_element(cube_id, 5, 5, 5, 1)
+        assert 'index' not in get(cube_id)
+
+        # And built again and persisted by the next process to load the cube, unless it changed in the meantime.
+        cube_persistence._cubes.clear()
+        index = get_cube(cube_id).export_index()
+        eq_(bytes(get(cube_id)['index']), index)
+        eq_(cube_persistence._backend.store_index(cube_id, index, get_version(cube_id) - 1), False)
+
+        # So the process after that loads it along with the cube.
+        cube_persistence._cubes.clear()
+        cube = get_cube(cube_id)
+        eq_(cube.export_index(), index)
+        eq_(cube.query(1, 5, 1, 5, 1, 5), 43)
+    finally:
+        persistence_conf['persist_index'], persistence_conf['engine'] = False, 'sparse'
+
+
+@with_setup(teardown=teardown_func)
+def test_write_behind():
+    cube_persistence._write_behind = True
+    try:
+        cube_id = store(Cube(dimension=10))
+        eq_(get_cube(cube_id).query(1, 10, 1, 10, 1, 10), 0)
+
+        # Updates are applied to the cached cube right away, but not written yet.
+        update_element(cube_id, 1, 1, 1, 5)
+        update_element(cube_id, 1, 1, 1, 7)
+        update_element(cube_id, 2, 2, 2, 3)
+        eq_(get_cube(cube_id).query(1, 10, 1, 10, 1, 10), 10)
+        eq_(cube_persistence._backend.get(cube_id)['cube'], {})
+
+        # Reading from the backend flushes them first, coalesced.
+        eq_(get(cube_id)['cube'], {'1': {'1': {'1': 7}}, '2': {'2': {'2': 3}}})
+        eq_(flush(), 0)
+
+        update_element(cube_id, 3, 3, 3, 1)
+        eq_(flush(), 1)
+        eq_(get_slabs(cube_id, 3, 3)['cube'], {'3': {'3': {'3': 1}}})
+    finally:
+        cube_persistence._write_behind = False
+
+
 @with_setup(teardown=teardown_func)
 def test_delete_cube():
     # Insert a cube.